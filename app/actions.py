@@ -0,0 +1,206 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+import asyncio
+
+from sqlalchemy import update
+
+from .config import settings
+from .gmail_client import (
+    BATCH_MODIFY_LIMIT,
+    batch_modify_messages,
+    ensure_label,
+    get_labels_map,
+)
+from .models import Email
+
+
+class _Pending:
+    """Net effect of every action matched for one email during a run."""
+
+    def __init__(self, email: Email):
+        self.email = email
+        self.add: Set[str] = set()
+        self.remove: Set[str] = set()
+        self.updates: Dict[str, Any] = {}
+
+    def merge(self, add: Set[str], remove: Set[str], updates: Dict[str, Any]) -> None:
+        # Same outcome as applying each ruleset's modify call in order
+        self.remove = (self.remove - add) | remove
+        self.add = (self.add | add) - self.remove
+        self.updates.update(updates)
+
+
+@contextmanager
+def _kept_on_commit(session) -> Iterator[None]:
+    """Keep loaded emails from expiring at each chunk's commit.
+
+    Expired emails would be reloaded one SELECT at a time when a later chunk
+    updates them.
+    """
+    expire = getattr(session, "expire_on_commit", None)
+    if expire is None:
+        yield
+        return
+    session.expire_on_commit = False
+    try:
+        yield
+    finally:
+        session.expire_on_commit = expire
+
+
+class ActionBatch:
+    """Collect rule actions for a run and send them with messages.batchModify.
+
+    Emails sharing the same net add/remove label sets are grouped, and each
+    group goes out in chunks of up to 1000 ids. The labels map is fetched
+    once and missing labels are created once per run.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = BATCH_MODIFY_LIMIT,
+        labels_map: Optional[Dict[str, str]] = None,
+    ):
+        self.chunk_size = min(chunk_size, BATCH_MODIFY_LIMIT)
+        self._labels_map = labels_map
+        self._pending: Dict[str, _Pending] = {}
+
+    @property
+    def labels_map(self) -> Dict[str, str]:
+        if self._labels_map is None:
+            self._labels_map = get_labels_map()
+        return self._labels_map
+
+    def plan(self, actions: List[Dict[str, Any]]) -> Tuple[Set, Set, Dict]:
+        """Resolve actions to (label ids to add, label ids to remove, updates)."""
+        labels_map = self.labels_map
+        add_ids, remove_ids = set(), set()
+        state_updates = {}
+
+        for act in actions:
+            t = act.get("type")
+            if t == "mark_as_read":
+                # remove UNREAD
+                if "UNREAD" in labels_map:
+                    remove_ids.add(labels_map["UNREAD"])
+                state_updates["is_read"] = True
+            elif t == "mark_as_unread":
+                if "UNREAD" in labels_map:
+                    add_ids.add(labels_map["UNREAD"])
+                state_updates["is_read"] = False
+            elif t == "move_message":
+                target_label = act.get("label") or settings.DEFAULT_MOVE_LABEL
+                add_ids.add(ensure_label(target_label, labels_map))
+                # emulate move: remove INBOX if present
+                if "INBOX" in labels_map:
+                    remove_ids.add(labels_map["INBOX"])
+            else:
+                raise ValueError(f"Unknown action type: {t}")
+
+        return add_ids, remove_ids, state_updates
+
+    def add(self, email: Email, actions: List[Dict[str, Any]]) -> None:
+        add_ids, remove_ids, updates = self.plan(actions)
+        pending = self._pending.get(email.id)
+        if pending is None:
+            pending = self._pending[email.id] = _Pending(email)
+        pending.merge(add_ids, remove_ids, updates)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @staticmethod
+    def _local_values(pending: _Pending) -> Dict[str, Any]:
+        values = dict(pending.updates)
+        if pending.add or pending.remove:
+            # update labels list in our local model (id-only to keep it simple)
+            current_ids = set((pending.email.labels or {}).get("ids", []))
+            current_ids.update(pending.add)
+            current_ids.difference_update(pending.remove)
+            values["labels"] = {"ids": sorted(current_ids)}
+        return values
+
+    def _apply_locally(self, pending: _Pending) -> Dict[str, Any]:
+        values = self._local_values(pending)
+        for k, v in values.items():
+            setattr(pending.email, k, v)
+        return values
+
+    def _chunks(self) -> Iterator[Tuple[frozenset, frozenset, List[_Pending]]]:
+        """Take pending changes as (add, remove, up to `chunk_size` emails)."""
+        groups: Dict[Tuple[frozenset, frozenset], List[_Pending]] = {}
+        for pending in self._pending.values():
+            key = (frozenset(pending.add), frozenset(pending.remove))
+            groups.setdefault(key, []).append(pending)
+        self._pending = {}
+
+        for (add, remove), members in groups.items():
+            for start in range(0, len(members), self.chunk_size):
+                yield add, remove, members[start : start + self.chunk_size]
+
+    def _commit_chunk(self, session, chunk: List[_Pending], bulk: bool) -> None:
+        rows = [{"id": p.email.id, **self._apply_locally(p)} for p in chunk]
+        rows = [row for row in rows if len(row) > 1]
+        if bulk and rows:
+            session.execute(update(Email), rows)
+        session.commit()
+
+    def flush(self, session, bulk: bool = False) -> int:
+        """Send pending changes to Gmail and mirror them in the database.
+
+        Local rows are committed only after the batchModify call covering
+        them succeeded. With `bulk`, the emails need not belong to `session`
+        and are written with one UPDATE by primary key per chunk. Returns the
+        number of emails updated.
+        """
+        updated = 0
+        with _kept_on_commit(session):
+            for add, remove, chunk in self._chunks():
+                if add or remove:
+                    batch_modify_messages(
+                        [p.email.id for p in chunk],
+                        add_labels=sorted(add),
+                        remove_labels=sorted(remove),
+                    )
+                self._commit_chunk(session, chunk, bulk)
+                updated += len(chunk)
+        return updated
+
+    async def flush_async(self, session, client, bulk: bool = False) -> int:
+        """Like `flush`, with every batchModify call sent concurrently.
+
+        `client` is an `AsyncGmailClient`; each chunk is committed as soon
+        as its own call returns.
+        """
+
+        async def send(add, remove, chunk):
+            if add or remove:
+                await client.batch_modify(
+                    [p.email.id for p in chunk], sorted(add), sorted(remove)
+                )
+            return chunk
+
+        updated = 0
+        with _kept_on_commit(session):
+            for done in asyncio.as_completed([send(*c) for c in self._chunks()]):
+                chunk = await done
+                self._commit_chunk(session, chunk, bulk)
+                updated += len(chunk)
+        return updated
+
+
+def apply_actions(email: Email, actions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Apply one email's actions in Gmail now; return its local updates.
+
+    The per-email form of `ActionBatch`, kept for existing callers: the
+    caller sets the returned values on `email` and commits them.
+    """
+    batch = ActionBatch()
+    batch.add(email, actions)
+    ((add, remove, (pending,)),) = batch._chunks()
+    if add or remove:
+        batch_modify_messages(
+            [email.id], add_labels=sorted(add), remove_labels=sorted(remove)
+        )
+    return batch._local_values(pending)
@@ -0,0 +1,246 @@
+from __future__ import annotations
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence
+import asyncio
+
+from . import metrics
+from .config import settings
+from .gmail_client import (
+    BATCH_MODIFY_LIMIT,
+    MAX_PAGE_SIZE,
+    _shared_credentials,
+    message_get_params,
+)
+from .ratelimit import QuotaScheduler, get_scheduler, retry_after_seconds
+
+try:
+    import httpx
+except ImportError:  # optional: pip install httpx
+    httpx = None
+
+
+class GmailAPIError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Gmail API error {status}: {message}")
+        self.status = status
+
+
+def _default_token() -> str:
+    return _shared_credentials().token
+
+
+def _refreshed_token() -> str:
+    return _shared_credentials(refresh=True).token
+
+
+class AsyncGmailClient:
+    """asyncio Gmail REST client over one pooled httpx client.
+
+    At most `concurrency` requests are in flight. Quota pacing, AIMD
+    throttling and retries of rate-limited/5xx responses and dropped
+    connections are decided by the shared `QuotaScheduler`. A rejected token
+    is refreshed once, through `token_refresher` (by default a forced OAuth
+    refresh; with only a custom `token_provider`, that provider again).
+    """
+
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        token_provider: Optional[Callable[[], str]] = None,
+        token_refresher: Optional[Callable[[], str]] = None,
+        concurrency: Optional[int] = None,
+        scheduler: Optional[QuotaScheduler] = None,
+        http2: bool = False,
+        max_retries: Optional[int] = None,
+    ):
+        if httpx is None:
+            raise RuntimeError("The async Gmail client requires httpx")
+        concurrency = concurrency or settings.GMAIL_CONCURRENCY
+        self._token_provider = token_provider or _default_token
+        if token_refresher is None:
+            token_refresher = token_provider or _refreshed_token
+        self._token_refresher = token_refresher
+        self._token: Optional[str] = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.scheduler = scheduler or get_scheduler()
+        self.max_retries = (
+            settings.GMAIL_MAX_RETRIES if max_retries is None else max_retries
+        )
+        self._http = httpx.AsyncClient(
+            base_url=(base_url or settings.GMAIL_API_URL).rstrip("/"),
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=concurrency, max_keepalive_connections=concurrency
+            ),
+            timeout=30.0,
+        )
+
+    async def __aenter__(self) -> "AsyncGmailClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    async def _headers(self, refresh: bool = False) -> Dict[str, str]:
+        # Loading or refreshing credentials does blocking I/O
+        if refresh:
+            self._token = await asyncio.to_thread(self._token_refresher)
+        elif self._token is None:
+            self._token = await asyncio.to_thread(self._token_provider)
+        return {"Authorization": f"Bearer {self._token}"}
+
+    async def _backoff(self, attempt: int, status: int, *args) -> bool:
+        """Sleep before retry number `attempt + 1`; False if none is due."""
+        delay = None
+        if attempt < self.max_retries:
+            delay = self.scheduler.retry_delay(attempt, status, *args)
+        if delay is None:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    async def _request(
+        self,
+        api_method: str,
+        http_method: str,
+        path: str,
+        params=None,
+        json: Optional[Dict] = None,
+    ) -> Dict:
+        url = f"/users/{settings.GMAIL_USER_ID}{path}"
+        attempt = 0
+        refreshed = False
+        while True:
+            await asyncio.sleep(self.scheduler.reserve(api_method))
+            metrics.incr("gmail_api_calls", method=api_method)
+            try:
+                async with self._semaphore:
+                    with metrics.span("gmail.http"):
+                        resp = await self._http.request(
+                            http_method,
+                            url,
+                            params=params,
+                            json=json,
+                            headers=await self._headers(),
+                        )
+            except httpx.TransportError:
+                # A dropped connection or timeout is retried like a 503:
+                # backed off, without cutting the quota rate
+                if not await self._backoff(attempt, 503):
+                    raise
+                attempt += 1
+                continue
+            metrics.incr("gmail_bytes_downloaded", len(resp.content))
+            if resp.status_code == 401 and not refreshed:
+                await self._headers(refresh=True)
+                refreshed = True
+                continue
+            if resp.status_code >= 400:
+                if not await self._backoff(
+                    attempt,
+                    resp.status_code,
+                    retry_after_seconds(resp.headers.get("retry-after")),
+                    resp.status_code == 403 and b"ateLimitExceeded" in resp.content,
+                ):
+                    raise GmailAPIError(resp.status_code, resp.text)
+                attempt += 1
+                continue
+            self.scheduler.on_success()
+            return resp.json() if resp.content else {}
+
+    async def iter_messages(
+        self,
+        label_ids: Optional[Sequence[str]] = ("INBOX",),
+        query: Optional[str] = None,
+        max_results: Optional[int] = None,
+    ) -> AsyncIterator[Dict]:
+        """Async counterpart of `gmail_client.iter_messages`."""
+        remaining = max_results
+        page_token = None
+        while remaining is None or remaining > 0:
+            size = MAX_PAGE_SIZE if remaining is None else min(MAX_PAGE_SIZE, remaining)
+            params = [("maxResults", size)]
+            params += [("labelIds", label) for label in label_ids or []]
+            if query:
+                params.append(("q", query))
+            if page_token:
+                params.append(("pageToken", page_token))
+            results = await self._request("messages.list", "GET", "/messages", params)
+            page = results.get("messages", [])
+            for msg in page:
+                yield msg
+            if remaining is not None:
+                remaining -= len(page)
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                return
+
+    async def get_message(
+        self, message_id: str, missing_ok: bool = False, fmt: str = "full"
+    ) -> Optional[Dict]:
+        params = []
+        for key, value in message_get_params(fmt).items():
+            values = value if isinstance(value, list) else [value]
+            params += [(key, v) for v in values]
+        try:
+            return await self._request(
+                "messages.get", "GET", f"/messages/{message_id}", params
+            )
+        except GmailAPIError as exc:
+            if missing_ok and exc.status == 404:
+                return None
+            raise
+
+    async def get_messages(
+        self, message_ids: Sequence[str], missing_ok: bool = False, fmt: str = "full"
+    ) -> List[Dict]:
+        """Fetch messages concurrently, in the order of `message_ids`."""
+        msgs = await asyncio.gather(
+            *(self.get_message(mid, missing_ok, fmt) for mid in message_ids)
+        )
+        return [msg for msg in msgs if msg is not None]
+
+    async def modify_message(
+        self,
+        message_id: str,
+        add_labels: Optional[list] = None,
+        remove_labels: Optional[list] = None,
+    ) -> Dict:
+        body = {"addLabelIds": add_labels or [], "removeLabelIds": remove_labels or []}
+        return await self._request(
+            "messages.modify", "POST", f"/messages/{message_id}/modify", json=body
+        )
+
+    async def batch_modify(
+        self,
+        message_ids: List[str],
+        add_labels: Optional[list] = None,
+        remove_labels: Optional[list] = None,
+    ) -> Dict:
+        if len(message_ids) > BATCH_MODIFY_LIMIT:
+            raise ValueError(f"batchModify accepts at most {BATCH_MODIFY_LIMIT} ids")
+        body = {
+            "ids": list(message_ids),
+            "addLabelIds": add_labels or [],
+            "removeLabelIds": remove_labels or [],
+        }
+        return await self._request(
+            "messages.batchModify", "POST", "/messages/batchModify", json=body
+        )
+
+    async def labels_map(self) -> Dict[str, str]:
+        res = await self._request("labels.list", "GET", "/labels")
+        return {lbl["name"]: lbl["id"] for lbl in res.get("labels", [])}
+
+    async def ensure_label(self, name: str, labels_map: Dict[str, str]) -> str:
+        if name not in labels_map:
+            res = await self._request(
+                "labels.create",
+                "POST",
+                "/labels",
+                json={"name": name, "labelListVisibility": "labelShow"},
+            )
+            labels_map[name] = res["id"]
+        return labels_map[name]
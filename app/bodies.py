@@ -0,0 +1,97 @@
+from __future__ import annotations
+from html import unescape
+from html.parser import HTMLParser
+from typing import List, Optional, Tuple
+import re
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional: uv sync --extra zstd
+    zstandard = None
+
+from .config import BODY_CODECS, settings
+
+# First byte of a stored body names its codec, so changing BODY_COMPRESSION
+# leaves rows written under the old setting readable
+_CODEC_TAGS = {"zlib": b"z", "zstd": b"s"}
+
+_BLOCK_TAGS = {
+    "address", "article", "blockquote", "br", "div", "footer", "h1", "h2",
+    "h3", "h4", "h5", "h6", "header", "hr", "li", "p", "pre", "section",
+    "table", "td", "th", "tr",
+}  # fmt: skip
+_SKIPPED_TAGS = {"head", "script", "style", "template", "title"}
+_SPACES = re.compile(r"[ \t\r\f\v\xa0]+")
+_BLANK_LINES = re.compile(r"\n\s*\n+")
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIPPED_TAGS:
+            self.skipping += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_TAGS:
+            self.skipping = max(self.skipping - 1, 0)
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+
+def html_to_text(html: str) -> str:
+    """Readable text of an HTML body: tags, scripts and styles dropped,
+    entities decoded, one line per block element."""
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    text = unescape("".join(parser.parts))
+    lines = (_SPACES.sub(" ", line).strip() for line in text.split("\n"))
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+def compress_body(text: str, codec: str) -> bytes:
+    if codec == "zlib":
+        return _CODEC_TAGS["zlib"] + zlib.compress(text.encode("utf-8"), 6)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("BODY_COMPRESSION=zstd requires zstandard")
+        data = zstandard.ZstdCompressor(level=3).compress(text.encode("utf-8"))
+        return _CODEC_TAGS["zstd"] + data
+    raise ValueError(f"Unknown body compression {codec!r}; choose from {BODY_CODECS}")
+
+
+def decompress_body(data: bytes) -> str:
+    tag, payload = data[:1], data[1:]
+    if tag == _CODEC_TAGS["zlib"]:
+        raw = zlib.decompress(payload)
+    elif tag == _CODEC_TAGS["zstd"]:
+        if zstandard is None:
+            raise RuntimeError("Reading zstd-compressed bodies requires zstandard")
+        raw = zstandard.ZstdDecompressor().decompress(payload)
+    else:
+        raise ValueError(f"Unknown stored body codec tag {tag!r}")
+    return raw.decode("utf-8")
+
+
+def prepare_body(text: str) -> Tuple[str, Optional[str], Optional[bytes]]:
+    """Apply `BODY_MAX_CHARS` and `BODY_COMPRESSION` to a fetched body.
+
+    Returns the text rules see and the values of the `body` and `body_z`
+    columns; exactly one of the two is set.
+    """
+    if settings.BODY_MAX_CHARS:
+        text = text[: settings.BODY_MAX_CHARS]
+    if settings.BODY_COMPRESSION == "none":
+        return text, text, None
+    return text, None, compress_body(text, settings.BODY_COMPRESSION)
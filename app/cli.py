@@ -1,32 +1,240 @@
+from datetime import datetime
+from typing import List, Optional
+import json
+import logging
+import os
+
 import typer
-from .fetch_emails import init_db as initialize_db, fetch_and_store
-from .process_rules import process_rules
-from .rules_engine import load_rules
-from .gmail_client import get_credentials
+from . import metrics
+from .config import settings
+from .ratelimit import get_scheduler
+
+# Commands import what they use when they run: Gmail, SQLAlchemy and the
+# database engine are not loaded for --help or the offline `rules` commands.
+# See `benchmarks.run startup` for the import-time budget.
 
 app = typer.Typer(help="Mail Helper App CLI")
+rules_app = typer.Typer(help="Check rules offline (no Gmail or database access)")
+app.add_typer(rules_app, name="rules")
+
+ENGINE_HELP = "Rule matching engine: compiled, indexed, columnar or planned"
+
+
+@app.callback()
+def main():
+    """Check settings before any command runs."""
+    try:
+        settings.validate()
+    except ValueError as exc:
+        typer.echo(f"Invalid settings: {exc}", err=True)
+        raise typer.Exit(1)
+
+
+def _echo_quota() -> None:
+    stats = get_scheduler().stats
+    typer.echo(
+        f"Gmail: {sum(stats.calls.values())} calls, {stats.units} quota units, "
+        f"{stats.retries} retries ({stats.throttled} rate-limited), "
+        f"{stats.paced_seconds + stats.backoff_seconds:.1f}s throttled."
+    )
+
+
+def _profile_option():
+    return typer.Option(
+        False, "--profile", help="Print time per stage and run counters at the end"
+    )
+
+
+def _metrics_file_option():
+    return typer.Option(
+        None,
+        "--metrics-file",
+        help="Write run metrics in Prometheus text format (default: from .env)",
+    )
+
+
+def _start_metrics(profile: bool, metrics_file: Optional[str]) -> Optional[str]:
+    metrics_file = metrics_file or settings.METRICS_FILE or None
+    if profile or metrics_file:
+        # Before rules are loaded, so their conditions are compiled counting
+        metrics.enable()
+    return metrics_file
+
+
+def _finish(profile: bool, metrics_file: Optional[str]) -> None:
+    _echo_quota()
+    if profile:
+        typer.echo("")
+        for line in metrics.report():
+            typer.echo(line)
+    if metrics_file:
+        metrics.write_textfile(metrics_file)
+
+
+def parse_now(value: Optional[str]) -> Optional[datetime]:
+    """`--now` as a naive UTC datetime (the form `received_at` is stored in)."""
+    if value is None:
+        return None
+    from .rules_engine import parse_utc
+
+    try:
+        return parse_utc(value)
+    except ValueError:
+        raise typer.BadParameter(
+            "expected an ISO 8601 time, e.g. 2024-06-01T00:00:00", param_hint="--now"
+        )
 
 
 @app.command()
 def auth():
     """Run OAuth and save token."""
+    from .gmail_client import get_credentials
+
     get_credentials()
     typer.echo("Authenticated and token saved.")
 
 
 @app.command()
-def init_db():
+def init_db(
+    search_indexes: bool = typer.Option(
+        False,
+        "--search-indexes",
+        help="Also create pg_trgm indexes used by SQL rule evaluation",
+    ),
+    fulltext: bool = typer.Option(
+        False,
+        "--fulltext",
+        help="Also add a tsvector column with a GIN index (PostgreSQL)",
+    ),
+):
     """Create tables."""
-    initialize_db()  # Corrected to call the function
+    from .fetch_emails import init_db as initialize_db
+
+    initialize_db(search_indexes=search_indexes, fulltext=fulltext)
     typer.echo("Database initialized.")
 
 
 @app.command()
 def fetch(
     max_results: int = typer.Option(50, help="How many emails to fetch from INBOX"),
+    batch_size: int = typer.Option(
+        None,
+        min=1,
+        max=100,
+        help="Messages per Gmail batch request (default: from .env)",
+    ),
+    all_messages: bool = typer.Option(
+        False, "--all", help="Page through every matching message (no limit)"
+    ),
+    query: Optional[str] = typer.Option(
+        None, help="Gmail search query, e.g. 'after:2024/01/01 -in:chats'"
+    ),
+    labels: Optional[List[str]] = typer.Option(
+        None,
+        "--label",
+        help="Label id filter, repeatable (default: INBOX, or none with --all)",
+    ),
+    incremental: bool = typer.Option(
+        False,
+        "--incremental",
+        help="Only sync changes since the last stored historyId",
+    ),
+    use_async: bool = typer.Option(
+        False,
+        "--async",
+        help="Fetch with concurrent, rate-limited requests (requires httpx)",
+    ),
+    fmt: str = typer.Option(
+        "auto",
+        "--format",
+        help="Message format: full, metadata (no bodies) or auto (from the rules)",
+    ),
+    rules_path: str = typer.Option(
+        "rules/rules.json", help="Rules deciding the format with --format auto"
+    ),
+    parse_workers: int = typer.Option(
+        None,
+        min=1,
+        help="Processes decoding message payloads (default: from .env)",
+    ),
+    profile: bool = _profile_option(),
+    metrics_file: Optional[str] = _metrics_file_option(),
 ):
-    count = fetch_and_store(max_results=max_results)
-    typer.echo(f"Fetched {count} message metadata.")
+    import asyncio
+
+    from .fetch_emails import (
+        choose_format,
+        fetch_and_store,
+        fetch_and_store_async,
+        sync_incremental,
+    )
+    from .gmail_client import MESSAGE_FORMATS, client_session
+    from .rules_engine import load_rules
+
+    metrics_file = _start_metrics(profile, metrics_file)
+    if not labels:
+        labels = None if all_messages else ["INBOX"]
+    if fmt == "auto":
+        # Without a rules file we cannot tell whether bodies are needed
+        fmt = (
+            choose_format(load_rules(rules_path))
+            if os.path.exists(rules_path)
+            else "full"
+        )
+    elif fmt not in MESSAGE_FORMATS:
+        raise typer.BadParameter(
+            f"choose from auto, {', '.join(MESSAGE_FORMATS)}", param_hint="--format"
+        )
+    if incremental and use_async:
+        raise typer.BadParameter(
+            "cannot be combined with --incremental", param_hint="--async"
+        )
+    if batch_size is not None and use_async:
+        # --async sends concurrent messages.get calls, not batch requests
+        raise typer.BadParameter(
+            "cannot be combined with --batch-size", param_hint="--async"
+        )
+    if incremental:
+        with client_session():
+            stats = sync_incremental(batch_size=batch_size, label_ids=labels, fmt=fmt)
+        mode = "full resync" if stats.full_resync else "incremental"
+        typer.echo(
+            f"Synced ({mode}): {stats.fetched} fetched "
+            f"({stats.inserted} new, {stats.updated} updated), "
+            f"{stats.relabelled} relabelled, {stats.deleted} deleted."
+        )
+        _finish(profile, metrics_file)
+        return
+    if use_async:
+        stats = asyncio.run(
+            fetch_and_store_async(
+                max_results=None if all_messages else max_results,
+                label_ids=labels,
+                query=query,
+                fmt=fmt,
+                parse_workers=parse_workers,
+            )
+        )
+        typer.echo(
+            f"Fetched {stats.fetched} messages "
+            f"({stats.inserted} new, {stats.updated} updated)."
+        )
+        _finish(profile, metrics_file)
+        return
+    with client_session():
+        stats = fetch_and_store(
+            max_results=None if all_messages else max_results,
+            batch_size=batch_size,
+            label_ids=labels,
+            query=query,
+            fmt=fmt,
+            parse_workers=parse_workers,
+        )
+    typer.echo(
+        f"Fetched {stats.fetched} messages "
+        f"({stats.inserted} new, {stats.updated} updated)."
+    )
+    _finish(profile, metrics_file)
 
 
 @app.command()
@@ -37,11 +245,284 @@ def process(
         "--stop-after-first-match/--allow-multiple",
         help="Stop after first matching rule (default: from .env)",
     ),
+    engine: str = typer.Option(
+        "compiled",
+        help=ENGINE_HELP,
+    ),
+    pushdown: bool = typer.Option(
+        True,
+        "--pushdown/--no-pushdown",
+        help="Filter candidate emails in SQL before matching in Python",
+    ),
+    workers: int = typer.Option(
+        1, min=1, help="Match rules in this many worker processes"
+    ),
+    stream: bool = typer.Option(
+        False,
+        "--stream",
+        help="Read emails through a server-side cursor in chunks",
+    ),
+    explain: bool = typer.Option(
+        False,
+        "--explain",
+        help="Show which rules are served by an index, without applying them",
+    ),
+    plan: bool = typer.Option(
+        False,
+        "--plan",
+        help="Show the planner's index probes and condition order, without "
+        "applying rules",
+    ),
+    use_async: bool = typer.Option(
+        False,
+        "--async",
+        help="Send label changes concurrently, rate-limited (requires httpx)",
+    ),
+    use_cache: bool = typer.Option(
+        False,
+        "--use-cache",
+        help="Only evaluate new or changed emails and rules (cached results)",
+    ),
+    now: Optional[str] = typer.Option(
+        None,
+        "--now",
+        help="Evaluate date rules as of this UTC time (ISO 8601; default: now)",
+    ),
+    profile: bool = _profile_option(),
+    metrics_file: Optional[str] = _metrics_file_option(),
 ):
+    import asyncio
+
+    from .db import get_session
+    from .gmail_client import client_session
+    from .process_rules import MATCH_ENGINES, process_rules, process_rules_async
+    from .rules_engine import load_rules
+    from .sql_rules import explain_rulesets
+
+    if engine not in MATCH_ENGINES:
+        raise typer.BadParameter(
+            f"choose from {', '.join(MATCH_ENGINES)}", param_hint="--engine"
+        )
+    if use_cache and (workers > 1 or stream):
+        raise typer.BadParameter(
+            "cannot be combined with --workers or --stream", param_hint="--use-cache"
+        )
+    run_at = parse_now(now)
+    metrics_file = _start_metrics(profile, metrics_file)
     rulesets = load_rules(rules_path)
     typer.echo(f"Loaded {len(rulesets)} rulesets from {rules_path}")
-    matched = process_rules(rulesets, stop_after_first_match=stop_after_first_match)
+    if explain:
+        session = get_session()
+        try:
+            plans = explain_rulesets(session, rulesets, run_at)
+        finally:
+            session.close()
+        for i, plan in enumerate(plans, start=1):
+            detail = f" via {', '.join(plan.indexes)}" if plan.indexes else ""
+            typer.echo(
+                f"#{i} {plan.ruleset.predicate}: {plan.pushed}/"
+                f"{len(plan.ruleset.rules)} conditions in SQL -> {plan.access}{detail}"
+            )
+        return
+    if plan:
+        from .planner import gather_stats, plan_rulesets
+
+        session = get_session()
+        try:
+            stats = gather_stats(session)
+        finally:
+            session.close()
+        typer.echo(f"Statistics from {len(stats.sample)} of {stats.rows} emails")
+        for i, rs_plan in enumerate(plan_rulesets(rulesets, stats, run_at), start=1):
+            probes = " or ".join(f"{f} = {v!r}" for f, v in rs_plan.index_keys)
+            typer.echo(
+                f"#{i} {rs_plan.ruleset.predicate}: "
+                + (f"index probe {probes}" if probes else "checked for every email")
+            )
+            for c in rs_plan.conditions:
+                typer.echo(
+                    f"    {c.cond.field} {c.cond.predicate} {c.cond.value!r}: "
+                    f"selectivity {c.selectivity:.3f}, cost {c.cost:.1f}"
+                )
+        return
+    if use_async:
+        if workers > 1 or stream:
+            raise typer.BadParameter(
+                "cannot be combined with --workers or --stream", param_hint="--async"
+            )
+        matched = asyncio.run(
+            process_rules_async(
+                rulesets,
+                stop_after_first_match=stop_after_first_match,
+                engine=engine,
+                pushdown=pushdown,
+                use_cache=use_cache,
+                now=run_at,
+            )
+        )
+        typer.echo(f"Applied rules to {matched} matching emails.")
+        _finish(profile, metrics_file)
+        return
+    with client_session():
+        matched = process_rules(
+            rulesets,
+            stop_after_first_match=stop_after_first_match,
+            engine=engine,
+            pushdown=pushdown,
+            workers=workers,
+            stream=stream,
+            use_cache=use_cache,
+            now=run_at,
+        )
     typer.echo(f"Applied rules to {matched} matching emails.")
+    _finish(profile, metrics_file)
+
+
+@app.command()
+def watch(
+    rules_path: str = typer.Option("rules/rules.json", help="Path to rules JSON"),
+    host: str = typer.Option("127.0.0.1", help="Address of the push endpoint"),
+    port: int = typer.Option(8080, help="Port of the push endpoint"),
+    push: bool = typer.Option(
+        True, "--push/--no-push", help="Serve the Pub/Sub push endpoint"
+    ),
+    topic: Optional[str] = typer.Option(
+        None, help="Pub/Sub topic for users.watch (default: from .env)"
+    ),
+    poll_interval: float = typer.Option(
+        None, min=1, help="Sync at least this often, in seconds (default: from .env)"
+    ),
+    labels: Optional[List[str]] = typer.Option(
+        None, "--label", help="Label id filter, repeatable (default: INBOX)"
+    ),
+    fmt: str = typer.Option(
+        "auto",
+        "--format",
+        help="Message format: full, metadata (no bodies) or auto (from the rules)",
+    ),
+    stop_after_first_match: bool = typer.Option(
+        None,
+        "--stop-after-first-match/--allow-multiple",
+        help="Stop after first matching rule (default: from .env)",
+    ),
+    engine: str = typer.Option(
+        "compiled",
+        help=ENGINE_HELP,
+    ),
+    use_cache: bool = typer.Option(
+        False,
+        "--use-cache",
+        help="Only evaluate new or changed emails and rules (cached results)",
+    ),
+):
+    """Sync and apply rules on every Gmail push notification (or poll)."""
+    from .gmail_client import MESSAGE_FORMATS, client_session
+    from .process_rules import MATCH_ENGINES
+    from .watch import Watcher, serve
+
+    if engine not in MATCH_ENGINES:
+        raise typer.BadParameter(
+            f"choose from {', '.join(MATCH_ENGINES)}", param_hint="--engine"
+        )
+    if fmt != "auto" and fmt not in MESSAGE_FORMATS:
+        raise typer.BadParameter(
+            f"choose from auto, {', '.join(MESSAGE_FORMATS)}", param_hint="--format"
+        )
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    watcher = Watcher(
+        rules_path,
+        label_ids=labels or ["INBOX"],
+        fmt=fmt,
+        engine=engine,
+        stop_after_first_match=stop_after_first_match,
+        use_cache=use_cache,
+        topic=topic,
+        poll_interval=poll_interval,
+    )
+    with client_session():
+        serve(watcher, host, port if push else None)
+
+
+def _load_rules_or_exit(rules_path: str):
+    from .rules_engine import load_rules
+
+    try:
+        return load_rules(rules_path)
+    except (OSError, ValueError, TypeError) as exc:
+        typer.echo(f"Invalid rules: {exc}", err=True)
+        raise typer.Exit(1)
+
+
+@rules_app.command("validate")
+def rules_validate(
+    rules_path: str = typer.Argument("rules/rules.json", help="Path to rules JSON"),
+):
+    """Check that every ruleset compiles and every action type is known."""
+    from .rules_engine import ACTION_TYPES
+
+    rulesets = _load_rules_or_exit(rules_path)
+    problems = [
+        f"Ruleset #{i}: unknown action type {act.get('type')!r}"
+        for i, rs in enumerate(rulesets, start=1)
+        for act in rs.actions
+        if act.get("type") not in ACTION_TYPES
+    ]
+    for problem in problems:
+        typer.echo(problem, err=True)
+    if problems:
+        raise typer.Exit(1)
+    conditions = sum(len(rs.rules) for rs in rulesets)
+    typer.echo(f"OK: {len(rulesets)} rulesets, {conditions} conditions in {rules_path}")
+
+
+@rules_app.command("test")
+def rules_test(
+    email_json: str = typer.Option(
+        ...,
+        "--email-json",
+        help="JSON email (or list) keyed by rule fields: from, to, subject, "
+        "message, snippet, received",
+    ),
+    rules_path: str = typer.Option("rules/rules.json", help="Path to rules JSON"),
+    stop_after_first_match: bool = typer.Option(
+        None,
+        "--stop-after-first-match/--allow-multiple",
+        help="Stop after first matching rule (default: from .env)",
+    ),
+    now: Optional[str] = typer.Option(
+        None,
+        "--now",
+        help="Evaluate date rules as of this UTC time (ISO 8601; default: now)",
+    ),
+):
+    """Show which rulesets match an email, and the actions they would apply."""
+    from .rules_engine import CompiledMatcher, EmailRecord
+
+    rulesets = _load_rules_or_exit(rules_path)
+    matcher = CompiledMatcher(rulesets, parse_now(now))
+    try:
+        with open(email_json, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = [data]
+        emails = [EmailRecord.from_json(d, matcher.now) for d in data]
+    except (OSError, ValueError, TypeError, AttributeError) as exc:
+        raise typer.BadParameter(str(exc), param_hint="--email-json")
+    if stop_after_first_match is None:
+        stop_after_first_match = settings.STOP_AFTER_FIRST_MATCH
+    for n, email in enumerate(emails, start=1):
+        matches = list(matcher.iter_matches(email))
+        if stop_after_first_match:
+            matches = matches[:1]
+        typer.echo(f"Email {n} ({email.subject!r}): {len(matches)} matching rulesets")
+        for i in matches:
+            actions = ", ".join(
+                act.get("type", "?") + (f" {act['label']}" if act.get("label") else "")
+                for act in rulesets[i].actions
+            )
+            typer.echo(f"  #{i + 1} {rulesets[i].predicate}: {actions or 'no actions'}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+from __future__ import annotations
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from itertools import compress, islice, repeat
+from operator import contains, eq
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from . import metrics
+from .models import Email
+from .rules_engine import (
+    DATE_PREDICATES,
+    CompiledMatcher,
+    RuleCondition,
+    RuleSet,
+    date_cutoff,
+    loads_bodies,
+    text_getter,
+)
+
+EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def epoch_us(dt: datetime) -> int:
+    """Naive UTC `dt` as integer microseconds, so comparisons stay exact."""
+    return (dt - EPOCH) // _MICROSECOND
+
+
+def _downloads_body(e: Email) -> bool:
+    return e.body is None and getattr(e, "body_z", None) is None
+
+
+class EmailColumns:
+    """A columnar snapshot of `emails` for the fields rules read.
+
+    Rows are ordered by `received_at` (emails without one last), so every
+    date condition selects a contiguous range of rows (found by bisecting
+    the int64 `received` column). Texts are lowercased
+    once, as `text_getter` would return them; a field's column is built the
+    first time a condition reads it.
+
+    A mask is an int holding one byte (0 or 1) per row, row 0 being the most
+    significant, so `&`, `|` and `^` combine masks across all rows at once.
+    """
+
+    def __init__(self, emails: Sequence[Email]):
+        dated = [e for e in emails if isinstance(e.received_at, datetime)]
+        dated.sort(key=lambda e: e.received_at)
+        undated = [e for e in emails if not isinstance(e.received_at, datetime)]
+        self.rows = dated + undated
+        self.received = array("q", [epoch_us(e.received_at) for e in dated])
+        self.size = len(self.rows)
+        self.all = self.range_mask(0, self.size)
+        self._texts: Dict[str, List[str]] = {}
+
+    def texts(self, field: str) -> List[str]:
+        if field not in self._texts:
+            get = text_getter(field)
+            self._texts[field] = [get(e) for e in self.rows]
+        return self._texts[field]
+
+    def bytes_mask(self, flags) -> int:
+        """Mask from an iterable of booleans, one per row."""
+        return int.from_bytes(bytes(flags), "big")
+
+    def range_mask(self, start: int, stop: int) -> int:
+        """Mask of rows `start` to `stop - 1`."""
+        return int.from_bytes(
+            bytes(start) + b"\x01" * (stop - start) + bytes(self.size - stop), "big"
+        )
+
+    def indexes(self, mask: int) -> Iterator[int]:
+        """Row numbers set in `mask`, ascending."""
+        return compress(range(self.size), mask.to_bytes(self.size, "big"))
+
+
+class ColumnarMatcher:
+    """Evaluate every condition as one mask over a snapshot of many emails.
+
+    `match_batch` builds an `EmailColumns` snapshot, computes each distinct
+    condition once across all rows (substring tests run in C over plain
+    strings instead of ORM attributes), and combines the masks per ruleset.
+    Date conditions use the cutoffs of `date_cutoff` against one `now`,
+    so results are the (email, ruleset) pairs `email_matches` gives.
+    `iter_matches` checks one email the regular compiled way.
+    """
+
+    def __init__(self, rulesets: List[RuleSet], now: Optional[datetime] = None):
+        self.rulesets = rulesets
+        self.compiled = CompiledMatcher(rulesets, now)
+        self.now = self.compiled.now
+        self.reads_message = any(
+            cond.field.lower() == "message" for rs in rulesets for cond in rs.rules
+        )
+
+    def iter_matches(self, email: Email) -> Iterator[int]:
+        return self.compiled.iter_matches(email)
+
+    def _condition_mask(self, cols: EmailColumns, cond: RuleCondition) -> int:
+        if cond.predicate in DATE_PREDICATES:
+            cutoff = epoch_us(date_cutoff(cond.predicate, int(cond.value), self.now))
+            if cond.predicate == "GreaterThanDays":
+                return cols.range_mask(0, bisect_right(cols.received, cutoff))
+            if cond.predicate == "GreaterThanMonths":
+                return cols.range_mask(0, bisect_left(cols.received, cutoff))
+            start = bisect_right(cols.received, cutoff)
+            return cols.range_mask(start, len(cols.received))
+        texts = cols.texts(cond.field.lower())
+        t = str(cond.value).lower()
+        if cond.predicate in ("Contains", "DoesNotContain"):
+            mask = cols.bytes_mask(map(contains, texts, repeat(t)))
+        else:
+            mask = cols.bytes_mask(map(eq, texts, repeat(t)))
+        if cond.predicate.startswith("DoesNot"):
+            mask ^= cols.all
+        return mask
+
+    def _ruleset_masks(self, cols: EmailColumns) -> List[int]:
+        cache: Dict[Tuple[str, str, str], int] = {}
+        masks = []
+        for rs in self.rulesets:
+            mask = cols.all if rs.predicate == "All" else 0
+            for cond in rs.rules:
+                key = (cond.field.lower(), cond.predicate, str(cond.value).lower())
+                if key not in cache:
+                    cache[key] = self._condition_mask(cols, cond)
+                if rs.predicate == "All":
+                    mask &= cache[key]
+                else:
+                    mask |= cache[key]
+            masks.append(mask)
+        metrics.incr("columnar_condition_masks", len(cache))
+        return masks
+
+    def match_batch(self, emails: Sequence[Email], stop_flag: bool) -> List[List[int]]:
+        """Matching ruleset indexes for each of `emails`, in file order.
+
+        With `stop_flag`, only the first matching ruleset of each email.
+        Emails whose body is still to be downloaded (see `lazy_bodies`) are
+        matched one by one, so bodies are only fetched when a rule needs them.
+        """
+        results: List[List[int]] = [[] for _ in emails]
+        position = {id(e): n for n, e in enumerate(emails)}
+        batch = list(emails)
+        if self.reads_message and loads_bodies():
+            # compressed bodies (`body_z`) are local and decompressed in the batch
+            batch = [e for e in emails if not _downloads_body(e)]
+            for e in emails:
+                if _downloads_body(e):
+                    found = self.compiled.iter_matches(e)
+                    results[position[id(e)]] = list(
+                        islice(found, 1) if stop_flag else found
+                    )
+        cols = EmailColumns(batch)
+        order = [position[id(e)] for e in cols.rows]
+        remaining = cols.all
+        for i, mask in enumerate(self._ruleset_masks(cols)):
+            if stop_flag:
+                mask &= remaining
+                remaining ^= mask
+            for row in cols.indexes(mask):
+                results[order[row]].append(i)
+        return results
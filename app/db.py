@@ -1,10 +1,62 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 
 from .config import settings
 
-engine = create_engine(settings.DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+# Both are created on first use, so importing the models (or commands that
+# never touch the database) does not load a driver or build a pool
+SessionLocal = None
+
+
+def _unicode_lower(value):
+    return value.lower() if isinstance(value, str) else value
+
+
+def _sqlite_pragmas(dbapi_conn, _record) -> None:
+    # SQLite's lower() (and so ILIKE) only folds ASCII; fold the way the
+    # Python matchers do so pushed-down conditions agree with them
+    dbapi_conn.create_function("lower", 1, _unicode_lower, deterministic=True)
+    cursor = dbapi_conn.cursor()
+    # WAL lets readers (e.g. --workers processes) run while a writer commits,
+    # and with it synchronous=NORMAL only syncs at checkpoints, not per commit
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+    # rule_evaluations rows go with their email (ON DELETE CASCADE)
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def create_db_engine(url: str):
+    """An engine for `url`; SQLite files get the embedded profile.
+
+    SQLite connections run in WAL mode with `synchronous=NORMAL`, memory-map
+    up to `SQLITE_MMAP_SIZE` bytes of the file, wait for a busy writer
+    instead of failing at once and use a Unicode-aware `lower()`.
+    """
+    if make_url(url).get_backend_name() == "sqlite":
+        engine = create_engine(url, connect_args={"timeout": 30})
+        event.listen(engine, "connect", _sqlite_pragmas)
+        return engine
+    return create_engine(url, pool_pre_ping=True)
+
+
+def get_engine():
+    """The engine for `DATABASE_URL`, created on first use.
+
+    Also available as `db.engine`; assigning that attribute replaces it.
+    """
+    global engine
+    if "engine" not in globals():
+        engine = create_db_engine(settings.DATABASE_URL)
+    return engine
+
+
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class Base(DeclarativeBase):
@@ -12,4 +64,9 @@ class Base(DeclarativeBase):
 
 
 def get_session():
+    global SessionLocal
+    if SessionLocal is None:
+        SessionLocal = sessionmaker(
+            bind=get_engine(), autoflush=False, autocommit=False
+        )
     return SessionLocal()
@@ -0,0 +1,193 @@
+from __future__ import annotations
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+import hashlib
+import json
+
+from sqlalchemy import (
+    and_,
+    delete,
+    exists,
+    false,
+    func,
+    insert,
+    or_,
+    select,
+    tuple_,
+)
+
+from . import metrics
+from .models import Email, RuleEvaluation
+from .rules_engine import RuleSet, ruleset_valid_until
+
+# Keys per IN (...) list when reading or replacing cache rows
+CHUNK_SIZE = 500
+
+
+def content_hash(
+    from_email: Optional[str],
+    to_email: Optional[str],
+    subject: Optional[str],
+    snippet: Optional[str],
+    body: Optional[str],
+    received_at,
+) -> str:
+    """sha256 over every field a rule can read.
+
+    A body that was not fetched (None) hashes differently from an empty
+    one, so a later full fetch counts as changed content.
+    """
+    h = hashlib.sha256()
+    body_part = "-" if body is None else "b:" + body
+    for part in (from_email, to_email, subject, snippet, str(received_at), body_part):
+        h.update((part or "").encode("utf-8", "surrogatepass"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+def email_hash(e: Email) -> str:
+    return content_hash(
+        e.from_email, e.to_email, e.subject, e.snippet, e.body, e.received_at
+    )
+
+
+def rule_fingerprint(rs: RuleSet) -> str:
+    """Identify a ruleset by its conditions and actions, not its position."""
+    data = {
+        "predicate": rs.predicate,
+        "rules": [[c.field, c.predicate, c.value] for c in rs.rules],
+        "actions": rs.actions,
+    }
+    text = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class EvaluationCache:
+    """Persisted (email, content hash, ruleset fingerprint) -> result table.
+
+    `stale_clause` selects only emails missing a valid result for some
+    ruleset: new or changed emails, new or edited rules, and results a date
+    condition may have flipped since (`valid_until`). Without
+    stop-after-first-match, results that matched but were never applied
+    (shadowed under that setting) also keep an email stale, so switching it
+    off still applies them.
+    """
+
+    def __init__(self, rulesets: Sequence[RuleSet], now: Optional[datetime] = None):
+        self.rulesets = list(rulesets)
+        self.fingerprints = [rule_fingerprint(rs) for rs in self.rulesets]
+        self.now = now or datetime.utcnow()
+        self._valid: Dict[Tuple[str, str], Tuple[bool, bool]] = {}
+        self._pending: Dict[Tuple[str, str], Dict] = {}
+
+    def stale_clause(self, stop_flag: bool = False):
+        """Emails lacking a valid result for some ruleset, or owed an action.
+
+        With `stop_flag`, a matched ruleset shadowed by one already applied
+        is not owed anything, so it leaves the email fresh.
+        """
+        fingerprints = set(self.fingerprints)
+        r = RuleEvaluation
+        valid = (
+            r.email_id == Email.id,
+            r.content_hash == Email.content_hash,
+            r.rule_fingerprint.in_(fingerprints),
+            or_(r.valid_until.is_(None), r.valid_until > self.now),
+        )
+        if stop_flag:
+            fresh = select(func.count()).select_from(r).where(*valid)
+            owed = and_(
+                exists().where(*valid, r.matched),
+                ~exists().where(*valid, r.applied),
+            )
+        else:
+            fresh = (
+                select(func.count())
+                .select_from(r)
+                .where(*valid, or_(~r.matched, r.applied))
+            )
+            owed = false()
+        return or_(
+            Email.content_hash.is_(None),
+            fresh.scalar_subquery() < len(fingerprints),
+            owed,
+        )
+
+    def load(self, session, emails: Sequence[Email]) -> None:
+        """Read the cached results still valid for `emails`."""
+        hashes = {e.id: e.content_hash for e in emails}
+        ids = list(hashes)
+        r = RuleEvaluation
+        for start in range(0, len(ids), CHUNK_SIZE):
+            stmt = select(
+                r.email_id, r.rule_fingerprint, r.content_hash, r.matched, r.applied
+            ).where(
+                r.email_id.in_(ids[start : start + CHUNK_SIZE]),
+                r.rule_fingerprint.in_(set(self.fingerprints)),
+                or_(r.valid_until.is_(None), r.valid_until > self.now),
+            )
+            for email_id, fp, digest, matched, applied in session.execute(stmt):
+                if digest == hashes[email_id]:
+                    self._valid[(email_id, fp)] = (matched, applied)
+
+    def select(self, email: Email, matcher, stop_flag: bool) -> List[int]:
+        """Indexes of the rulesets whose actions `email` still needs.
+
+        Cached results are reused; if any ruleset lacks one, `matcher`
+        evaluates them all so the email is fully cached afterwards.
+        """
+        if email.content_hash is None:
+            # Rows stored before hashing existed; saved with the session
+            email.content_hash = email_hash(email)
+        cached = [self._valid.get((email.id, fp)) for fp in self.fingerprints]
+        misses = sum(1 for c in cached if c is None)
+        metrics.incr("eval_cache_hits", len(cached) - misses)
+        metrics.incr("eval_cache_misses", misses)
+        if misses:
+            found = set(matcher.iter_matches(email))
+            results = []
+            for i, c in enumerate(cached):
+                applied = c is not None and c[1]
+                results.append((i in found, applied))
+                if c is None:
+                    self._record(email, i, i in found, applied)
+        else:
+            results = cached
+
+        matches = [i for i, (matched, _) in enumerate(results) if matched]
+        if stop_flag:
+            matches = matches[:1]
+        todo = [i for i in matches if not results[i][1]]
+        for i in todo:
+            self._record(email, i, True, True)
+            metrics.incr("rule_matches", ruleset=str(i + 1))
+        return todo
+
+    def _record(self, email: Email, i: int, matched: bool, applied: bool) -> None:
+        key = (email.id, self.fingerprints[i])
+        self._valid[key] = (matched, applied)
+        self._pending[key] = {
+            "email_id": email.id,
+            "rule_fingerprint": self.fingerprints[i],
+            "content_hash": email.content_hash,
+            "matched": matched,
+            "applied": applied,
+            "valid_until": ruleset_valid_until(self.rulesets[i], email, self.now),
+            "evaluated_at": self.now,
+        }
+
+    def write(self, session) -> None:
+        """Replace the cache rows of everything evaluated or applied.
+
+        Call once the actions went through, so a failed run is redone.
+        """
+        rows = list(self._pending.values())
+        r = RuleEvaluation
+        for start in range(0, len(rows), CHUNK_SIZE):
+            chunk = rows[start : start + CHUNK_SIZE]
+            keys = [(row["email_id"], row["rule_fingerprint"]) for row in chunk]
+            session.execute(
+                delete(r).where(tuple_(r.email_id, r.rule_fingerprint).in_(keys))
+            )
+            session.execute(insert(r), chunk)
+        self._pending.clear()
@@ -1,67 +1,504 @@
+from dataclasses import dataclass, field
 from datetime import datetime
-from .db import get_session, Base, engine
-from .models import Email
-from .gmail_client import list_messages, get_message, parse_headers, extract_plain_text
+from email.utils import parsedate_to_datetime
+from typing import (
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
+import asyncio
+import queue
+import threading
 
+from sqlalchemy import case, func, literal_column, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
-def init_db():
+from . import metrics
+from .config import settings
+from .db import get_session, get_engine, Base
+from .bodies import prepare_body
+from .eval_cache import content_hash
+from .models import Email, SyncState
+from .rules_engine import RuleSet
+from .indexes import create_search_indexes
+from .async_gmail import AsyncGmailClient
+from .gmail_client import (
+    HistoryExpired,
+    get_profile,
+    iter_history_pages,
+    iter_messages,
+    iter_message_batches,
+    parse_headers,
+    extract_plain_text,
+)
+
+# Fetched batches allowed to wait for the database before the fetcher pauses
+PIPELINE_DEPTH = 2
+
+# Messages per task sent to a parse worker
+PARSE_CHUNK = 10
+
+_DONE = object()
+
+
+@dataclass
+class FetchStats:
+    fetched: int = 0
+    inserted: int = 0
+    updated: int = 0
+    relabelled: int = 0
+    deleted: int = 0
+    full_resync: bool = False
+    # ids of messages added since the checkpoint (incremental syncs only)
+    new_ids: List[str] = field(default_factory=list)
+
+
+class _Failure:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def init_db(search_indexes: bool = False, fulltext: bool = False):
     print("Creating database tables...")
+    engine = get_engine()
     print("Using engine:", engine)
     Base.metadata.create_all(engine)
+    if engine.dialect.name == "postgresql":
+        # Tables created before bodies became optional
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE emails ALTER COLUMN body DROP NOT NULL"))
+            conn.execute(
+                text(
+                    "ALTER TABLE emails ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)"
+                )
+            )
+            conn.execute(
+                text("ALTER TABLE emails ADD COLUMN IF NOT EXISTS body_z BYTEA")
+            )
+    if search_indexes or fulltext:
+        print("Creating search indexes...")
+        create_search_indexes(engine, fulltext=fulltext)
+
+
+def choose_format(rulesets: Sequence[RuleSet]) -> str:
+    """The cheapest messages.get format that covers every rule's fields.
+
+    Only `Message` conditions read the body; without one, `metadata` is
+    enough and bodies are fetched later only if a rule needs them.
+    """
+    needs_body = any(
+        cond.field.lower() == "message" for rs in rulesets for cond in rs.rules
+    )
+    return "full" if needs_body else "metadata"
+
+
+def parse_message(msg: Dict, with_body: bool = True) -> Dict:
+    """Turn a Gmail message resource into column values for `Email`.
+
+    Without `with_body` (a `format=metadata` resource) `body` is None,
+    meaning "not fetched yet" rather than empty. A fetched body is capped
+    and maybe compressed into `body_z` (see `bodies.prepare_body`); the
+    content hash covers the text rules will see.
+    """
+    headers = parse_headers(msg["payload"].get("headers", []))
+    date_raw = headers.get("date", "")
+    # Parse RFC2822 date
+    received_at = parsedate_to_datetime(date_raw) if date_raw else datetime.utcnow()
+
+    label_ids = msg.get("labelIds", [])
+    body = body_column = body_z = None
+    if with_body:
+        body, body_column, body_z = prepare_body(
+            extract_plain_text(msg.get("payload", {})) or ""
+        )
+    row = {
+        "id": msg["id"],
+        "thread_id": msg.get("threadId", ""),
+        "from_email": headers.get("from", ""),
+        "to_email": headers.get("to", ""),
+        "subject": headers.get("subject", ""),
+        "snippet": msg.get("snippet", "") or "",
+        "body": body_column,
+        "body_z": body_z,
+        "received_at": received_at,
+        "is_read": "UNREAD" not in label_ids,
+        "labels": {"ids": label_ids},
+    }
+    row["content_hash"] = content_hash(
+        row["from_email"],
+        row["to_email"],
+        row["subject"],
+        row["snippet"],
+        body,
+        received_at,
+    )
+    return row
+
+
+def upsert_emails(session, rows: List[Dict]) -> Tuple[int, int]:
+    """Write `rows` with one INSERT ... ON CONFLICT DO UPDATE.
+
+    Returns `(inserted, updated)`. PostgreSQL reports `xmax = 0` for rows
+    that were freshly inserted rather than updated; SQLite has no such
+    column, so there the ids already stored are counted first. A NULL (not
+    fetched) body never overwrites a stored one, plain or compressed.
+    """
+    # ON CONFLICT cannot touch the same row twice in one statement
+    rows = list({row["id"]: row for row in rows}.values())
+    if not rows:
+        return 0, 0
+    sqlite = session.get_bind().dialect.name == "sqlite"
+    stmt = (sqlite_insert if sqlite else pg_insert)(Email).values(rows)
+    set_ = {col: stmt.excluded[col] for col in rows[0] if col != "id"}
+    if "body" in set_:
+        new, old = stmt.excluded, Email
+        # A fetched body replaces the stored one, whichever column either is in
+        fetched = new.body.isnot(None) | new.body_z.isnot(None)
+        set_["body"] = case((fetched, new.body), else_=old.body)
+        set_["body_z"] = case((fetched, new.body_z), else_=old.body_z)
+        if "content_hash" in set_:
+            # The kept body is part of the stored hash
+            kept = ~fetched & (old.body.isnot(None) | old.body_z.isnot(None))
+            set_["content_hash"] = case(
+                (kept, old.content_hash), else_=new.content_hash
+            )
+    stmt = stmt.on_conflict_do_update(index_elements=[Email.id], set_=set_)
+    if sqlite:
+        ids = [row["id"] for row in rows]
+        stored = session.scalar(
+            select(func.count()).select_from(Email).where(Email.id.in_(ids))
+        )
+        session.execute(stmt)
+        return len(rows) - stored, stored
+    flags = session.execute(stmt.returning(literal_column("xmax = 0"))).scalars().all()
+    inserted = sum(1 for flag in flags if flag)
+    return inserted, len(flags) - inserted
+
+
+def _prefetch(items: Iterable, depth: int) -> Iterator:
+    """Drive `items` from a background thread through a bounded queue.
+
+    Lets the Gmail side (list + fetch) run ahead of the database side while
+    holding at most `depth` results in memory.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except BaseException as exc:
+            put(_Failure(exc))
+            return
+        put(_DONE)
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+
+@contextmanager
+def parse_pool(
+    workers: Optional[int] = None,
+) -> Iterator[Optional[ProcessPoolExecutor]]:
+    """Processes for `parse_messages`, or None for parsing in this process.
+
+    Workers are started right away: forking once the prefetch thread is
+    running could copy locks it holds.
+    """
+    workers = workers or settings.PARSE_WORKERS
+    if workers <= 1:
+        yield None
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(int, range(workers)))
+        yield pool
+
+
+def parse_messages(
+    msgs: List[Dict], with_body: bool, pool: Optional[ProcessPoolExecutor] = None
+) -> List[Dict]:
+    """`parse_message` over a batch; MIME decoding is CPU-bound, so a pool
+    spreads large backfills across cores."""
+    with metrics.span("fetch.parse"):
+        if pool is None:
+            return [parse_message(msg, with_body=with_body) for msg in msgs]
+        return list(
+            pool.map(parse_message, msgs, repeat(with_body), chunksize=PARSE_CHUNK)
+        )
 
 
-def fetch_and_store(max_results: int = 100):
+def _store_messages(
+    session,
+    ids: Iterable[str],
+    batch_size: int,
+    stats: FetchStats,
+    missing_ok: bool = False,
+    fmt: str = "full",
+    parse_workers: Optional[int] = None,
+) -> FetchStats:
+    with parse_pool(parse_workers) as pool:
+        batches = _prefetch(
+            iter_message_batches(
+                ids, batch_size=batch_size, missing_ok=missing_ok, fmt=fmt
+            ),
+            PIPELINE_DEPTH,
+        )
+        return _store_batches(session, batches, stats, fmt == "full", pool)
+
+
+def _store_batches(
+    session,
+    batches: Iterable[List[Dict]],
+    stats: FetchStats,
+    with_body: bool,
+    pool: Optional[ProcessPoolExecutor],
+) -> FetchStats:
+    rows: List[Dict] = []
+    for batch in batches:
+        rows.extend(parse_messages(batch, with_body, pool))
+        stats.fetched += len(batch)
+        if len(rows) >= settings.UPSERT_CHUNK_SIZE:
+            _write_rows(session, rows, stats)
+            rows = []
+    if rows:
+        _write_rows(session, rows, stats)
+    return stats
+
+
+def _write_rows(session, rows: List[Dict], stats: FetchStats) -> None:
+    with metrics.span("db.upsert"):
+        inserted, updated = upsert_emails(session, rows)
+        # Commit per chunk so a failure later in the run keeps earlier chunks
+        session.commit()
+    metrics.incr("emails_upserted", inserted, result="inserted")
+    metrics.incr("emails_upserted", updated, result="updated")
+    stats.inserted += inserted
+    stats.updated += updated
+
+
+def fetch_and_store(
+    max_results: Optional[int] = 100,
+    batch_size: Optional[int] = None,
+    label_ids: Optional[Sequence[str]] = ("INBOX",),
+    query: Optional[str] = None,
+    fmt: str = "full",
+    parse_workers: Optional[int] = None,
+) -> FetchStats:
+    """Stream messages from Gmail into the database.
+
+    Pipeline: list (paged) -> batch fetch -> parse -> bulk upsert, with one
+    commit per upsert chunk. `max_results=None` pages through every matching
+    message; `fmt="metadata"` stores headers only (see `choose_format`).
+    With `parse_workers > 1` (default: `PARSE_WORKERS`), payloads are
+    decoded in a process pool.
+    """
+    batch_size = batch_size or settings.FETCH_BATCH_SIZE
     session = get_session()
     try:
-        msgs = list_messages(max_results=max_results)
-        for m in msgs:
-            msg = get_message(m["id"])
-            headers = parse_headers(msg["payload"].get("headers", []))
-            frm = headers.get("from", "")
-            to = headers.get("to", "")
-            subject = headers.get("subject", "")
-            date_raw = headers.get("date", "")
-            # Parse RFC2822 date
-            from email.utils import parsedate_to_datetime
-
-            received_at = (
-                parsedate_to_datetime(date_raw) if date_raw else datetime.utcnow()
+        ids = (
+            m["id"]
+            for m in iter_messages(
+                label_ids=label_ids, query=query, max_results=max_results
             )
+        )
+        return _store_messages(
+            session, ids, batch_size, FetchStats(), fmt=fmt, parse_workers=parse_workers
+        )
+    finally:
+        session.close()
 
-            snippet = msg.get("snippet", "") or ""
-            body = extract_plain_text(msg.get("payload", {})) or ""
-
-            label_ids = msg.get("labelIds", [])
-            is_read = "UNREAD" not in label_ids
-
-            # Upsert-like behavior
-            existing = session.get(Email, m["id"])
-            if existing:
-                existing.thread_id = msg.get("threadId", "")
-                existing.from_email = frm
-                existing.to_email = to
-                existing.subject = subject
-                existing.snippet = snippet
-                existing.body = body
-                existing.received_at = received_at
-                existing.is_read = is_read
-                existing.labels = {"ids": label_ids}
-            else:
-                session.add(
-                    Email(
-                        id=m["id"],
-                        thread_id=msg.get("threadId", ""),
-                        from_email=frm,
-                        to_email=to,
-                        subject=subject,
-                        snippet=snippet,
-                        body=body,
-                        received_at=received_at,
-                        is_read=is_read,
-                        labels={"ids": label_ids},
-                    )
+
+async def _achunks(items: AsyncIterator, size: int) -> AsyncIterator[List]:
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def fetch_and_store_async(
+    max_results: Optional[int] = 100,
+    label_ids: Optional[Sequence[str]] = ("INBOX",),
+    query: Optional[str] = None,
+    fmt: str = "full",
+    parse_workers: Optional[int] = None,
+) -> FetchStats:
+    """`fetch_and_store` on `AsyncGmailClient`.
+
+    Each chunk of `UPSERT_CHUNK_SIZE` ids is fetched with concurrent
+    messages.get calls while the previous chunk is parsed and written in a
+    worker thread, one chunk at a time, so the event loop keeps fetching.
+    """
+    stats = FetchStats()
+    session = get_session()
+    writing: Optional[asyncio.Future] = None
+
+    def write(msgs: List[Dict]) -> None:
+        stats.fetched += len(msgs)
+        _write_rows(session, parse_messages(msgs, fmt == "full", pool), stats)
+
+    async def write_next(msgs: List[Dict]) -> None:
+        nonlocal writing
+        if writing is not None:
+            await writing
+        writing = asyncio.ensure_future(asyncio.to_thread(write, msgs))
+
+    try:
+        with parse_pool(parse_workers) as pool:
+            async with AsyncGmailClient() as client:
+                stubs = client.iter_messages(
+                    label_ids=label_ids, query=query, max_results=max_results
                 )
+                pending = None
+                async for chunk in _achunks(stubs, settings.UPSERT_CHUNK_SIZE):
+                    task = asyncio.create_task(
+                        client.get_messages([m["id"] for m in chunk], fmt=fmt)
+                    )
+                    if pending is not None:
+                        await write_next(await pending)
+                    pending = task
+                if pending is not None:
+                    await write_next(await pending)
+                if writing is not None:
+                    await writing
+        return stats
+    finally:
+        if writing is not None and not writing.done():
+            # Let the session's last write finish before closing it
+            await asyncio.wait([writing])
+        session.close()
+
+
+def _save_history_id(session, history_id: str) -> None:
+    state = session.get(SyncState, settings.GMAIL_USER_ID)
+    if state is None:
+        session.add(SyncState(user_id=settings.GMAIL_USER_ID, history_id=history_id))
+    else:
+        state.history_id = history_id
+        state.updated_at = datetime.utcnow()
+    session.commit()
+
+
+def _full_resync(session, label_ids, batch_size: int, fmt: str) -> FetchStats:
+    # Take the checkpoint first so changes made during the resync are replayed
+    history_id = get_profile()["historyId"]
+    ids = (m["id"] for m in iter_messages(label_ids=label_ids, max_results=None))
+    stats = _store_messages(
+        session, ids, batch_size, FetchStats(full_resync=True), fmt=fmt
+    )
+    _save_history_id(session, history_id)
+    return stats
+
+
+def _collect_history(start_history_id: str):
+    """Reduce history records to the net set of added/relabelled/deleted ids."""
+    added: Dict[str, List[str]] = {}
+    relabelled: Dict[str, List[str]] = {}
+    deleted: set = set()
+    history_id = start_history_id
+    for page in iter_history_pages(start_history_id):
+        history_id = page.get("historyId", history_id)
+        for record in page.get("history", []):
+            for item in record.get("messagesAdded", []):
+                msg = item["message"]
+                added[msg["id"]] = msg.get("labelIds", [])
+                deleted.discard(msg["id"])
+            for key in ("labelsAdded", "labelsRemoved"):
+                for item in record.get(key, []):
+                    msg = item["message"]
+                    if msg["id"] in added:
+                        added[msg["id"]] = msg.get("labelIds", [])
+                    else:
+                        relabelled[msg["id"]] = msg.get("labelIds", [])
+            for item in record.get("messagesDeleted", []):
+                mid = item["message"]["id"]
+                added.pop(mid, None)
+                relabelled.pop(mid, None)
+                deleted.add(mid)
+    return added, relabelled, deleted, history_id
+
+
+def sync_incremental(
+    batch_size: Optional[int] = None,
+    label_ids: Optional[Sequence[str]] = ("INBOX",),
+    fmt: str = "full",
+) -> FetchStats:
+    """Apply only what changed since the last stored Gmail `historyId`.
+
+    New messages carrying one of `label_ids` are fetched in full, label
+    changes are applied to stored rows from the history records alone and
+    deleted messages are removed. Without a checkpoint, or once it has
+    aged out of Gmail's history window, this falls back to a full resync.
+    """
+    batch_size = batch_size or settings.FETCH_BATCH_SIZE
+    wanted = set(label_ids or [])
+    session = get_session()
+    try:
+        state = session.get(SyncState, settings.GMAIL_USER_ID)
+        if state is None:
+            return _full_resync(session, label_ids, batch_size, fmt)
+        try:
+            added, relabelled, deleted, history_id = _collect_history(state.history_id)
+        except HistoryExpired:
+            return _full_resync(session, label_ids, batch_size, fmt)
+
+        stats = FetchStats()
+        to_fetch = [
+            mid for mid, labels in added.items() if not wanted or wanted & set(labels)
+        ]
+        for mid, labels in relabelled.items():
+            existing = session.get(Email, mid)
+            if existing is not None:
+                existing.labels = {"ids": labels}
+                existing.is_read = "UNREAD" not in labels
+                stats.relabelled += 1
+            elif not wanted or wanted & set(labels):
+                # e.g. an archived message moved back into the inbox
+                to_fetch.append(mid)
+        for mid in deleted:
+            existing = session.get(Email, mid)
+            if existing is not None:
+                session.delete(existing)
+                stats.deleted += 1
         session.commit()
-        return len(msgs)
+
+        _store_messages(session, to_fetch, batch_size, stats, missing_ok=True, fmt=fmt)
+        stats.new_ids = to_fetch
+        _save_history_id(session, history_id)
+        return stats
     finally:
         session.close()
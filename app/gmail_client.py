@@ -1,19 +1,66 @@
 from __future__ import annotations
-from typing import List, Dict, Optional
+from contextlib import contextmanager
+from itertools import islice
+from typing import List, Dict, Iterable, Iterator, Optional, Sequence
+import base64
 import os
+import threading
+import time
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
 
+from . import metrics
+from .bodies import html_to_text
 from .config import settings
+from .ratelimit import RETRYABLE_STATUSES, get_scheduler, retry_after_seconds
 
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.readonly",
     "https://www.googleapis.com/auth/gmail.modify",
 ]
 
+# Gmail rejects batches larger than 100 sub-requests
+MAX_BATCH_SIZE = 100
+MAX_PAGE_SIZE = 500
+BATCH_MODIFY_LIMIT = 1000
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+# format=metadata returns only these headers (all that parse_message reads
+# besides the body) and the fields mask drops the rest of the resource
+METADATA_HEADERS = ["From", "To", "Subject", "Date"]
+METADATA_FIELDS = "id,threadId,labelIds,snippet,payload/headers"
+MESSAGE_FORMATS = ("full", "metadata")
+
+
+class HistoryExpired(Exception):
+    """The start historyId is outside Gmail's history window; resync fully."""
+
+
+class _CountingJsonModel(JsonModel):
+    """JsonModel that counts response bytes (batch sub-responses included)."""
+
+    def deserialize(self, content):
+        metrics.incr("gmail_bytes_downloaded", len(content))
+        return super().deserialize(content)
+
+
+# Process-wide client state: credentials are shared by every thread, while each
+# thread builds its own service (httplib2 transports are not thread-safe).
+_lock = threading.Lock()
+_local = threading.local()
+_credentials: Optional[Credentials] = None
+_services: list = []
+_generation = 0
+
+
+def _save_token(creds: Credentials) -> None:
+    with open(settings.GMAIL_TOKEN_PATH, "w") as token:
+        token.write(creds.to_json())
+
 
 def get_credentials() -> Credentials:
     creds = None
@@ -27,36 +74,347 @@ def get_credentials() -> Credentials:
                 settings.GMAIL_CREDENTIALS_PATH, SCOPES
             )
             creds = flow.run_local_server(port=0)
-        with open(settings.GMAIL_TOKEN_PATH, "w") as token:
-            token.write(creds.to_json())
+        _save_token(creds)
     return creds
 
 
+def _shared_credentials(refresh: bool = False) -> Credentials:
+    """The process-wide credentials, refreshed once they expire.
+
+    `refresh` renews the token even while it still looks valid locally,
+    for when the API has just rejected it.
+    """
+    global _credentials
+    with _lock:
+        if _credentials is None:
+            with metrics.span("gmail.oauth"):
+                _credentials = get_credentials()
+        elif (refresh or not _credentials.valid) and _credentials.refresh_token:
+            with metrics.span("gmail.oauth"):
+                _credentials.refresh(Request())
+                _save_token(_credentials)
+        return _credentials
+
+
 def get_service():
-    creds = get_credentials()
-    return build("gmail", "v1", credentials=creds, cache_discovery=False)
+    """Return this thread's Gmail service, building it on first use."""
+    creds = _shared_credentials()
+    cached = getattr(_local, "service", None)
+    if cached is not None and cached[0] == _generation:
+        return cached[1]
+    with metrics.span("gmail.discovery"):
+        service = build(
+            "gmail",
+            "v1",
+            credentials=creds,
+            cache_discovery=False,
+            model=_CountingJsonModel(),
+        )
+    with _lock:
+        _services.append(service)
+        _local.service = (_generation, service)
+    return service
+
+
+def open_client():
+    """Load credentials and build the calling thread's service up front."""
+    return get_service()
+
+
+def close_client() -> None:
+    """Drop cached credentials and close every service built since the last open."""
+    global _credentials, _generation
+    with _lock:
+        for service in _services:
+            service.close()
+        _services.clear()
+        _credentials = None
+        _generation += 1
+
+
+@contextmanager
+def client_session():
+    """Share one Gmail client for the duration of a command run."""
+    service = open_client()
+    try:
+        yield service
+    finally:
+        close_client()
+
+
+def _wait(seconds: float) -> None:
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+def _rate_limited(exc: HttpError) -> bool:
+    # Gmail reports per-user limits as 429 or as 403 rateLimitExceeded /
+    # userRateLimitExceeded
+    status = exc.resp.status
+    return status == 429 or (status == 403 and b"ateLimitExceeded" in exc.content)
+
+
+def _is_retryable(exc: Exception) -> bool:
+    return isinstance(exc, HttpError) and (
+        exc.resp.status in RETRYABLE_STATUSES or _rate_limited(exc)
+    )
+
+
+def _retry_delay(exc: HttpError, attempt: int) -> Optional[float]:
+    return get_scheduler().retry_delay(
+        attempt,
+        exc.resp.status,
+        retry_after_seconds(exc.resp.get("retry-after")),
+        _rate_limited(exc),
+    )
+
+
+def execute(request, method: str, max_retries: Optional[int] = None):
+    """Run one API request through the quota scheduler.
+
+    The call waits for its quota units first; rate-limited and 5xx
+    responses are retried with backoff up to `GMAIL_MAX_RETRIES` times.
+    """
+    scheduler = get_scheduler()
+    retries = settings.GMAIL_MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        _wait(scheduler.reserve(method))
+        metrics.incr("gmail_api_calls", method=method)
+        try:
+            with metrics.span("gmail.http"):
+                result = request.execute()
+        except HttpError as exc:
+            delay = _retry_delay(exc, attempt) if attempt < retries else None
+            if delay is None:
+                raise
+            _wait(delay)
+            attempt += 1
+            continue
+        scheduler.on_success()
+        return result
+
+
+def iter_messages(
+    label_ids: Optional[Sequence[str]] = ("INBOX",),
+    query: Optional[str] = None,
+    max_results: Optional[int] = None,
+    page_size: int = MAX_PAGE_SIZE,
+) -> Iterator[Dict]:
+    """Yield message stubs (`id`, `threadId`) page by page via `nextPageToken`.
+
+    `max_results=None` walks every page matching the label and query filters.
+    """
+    service = get_service()
+    remaining = max_results
+    page_token = None
+    while remaining is None or remaining > 0:
+        size = min(page_size, MAX_PAGE_SIZE)
+        if remaining is not None:
+            size = min(size, remaining)
+        kwargs = {"userId": settings.GMAIL_USER_ID, "maxResults": size}
+        if label_ids:
+            kwargs["labelIds"] = list(label_ids)
+        if query:
+            kwargs["q"] = query
+        if page_token:
+            kwargs["pageToken"] = page_token
+        results = execute(service.users().messages().list(**kwargs), "messages.list")
+        page = results.get("messages", [])
+        yield from page
+        if remaining is not None:
+            remaining -= len(page)
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return
 
 
 def list_messages(max_results: int = 100) -> List[Dict]:
+    return list(iter_messages(max_results=max_results))
+
+
+def get_profile() -> Dict:
     service = get_service()
-    results = (
+    return execute(
+        service.users().getProfile(userId=settings.GMAIL_USER_ID), "users.getProfile"
+    )
+
+
+def watch_mailbox(topic: str, label_ids: Optional[Sequence[str]] = None) -> Dict:
+    """Ask Gmail to publish mailbox changes to Pub/Sub `topic`.
+
+    Returns `historyId` and `expiration` (ms since the epoch); the watch
+    has to be renewed before it expires, at the latest after 7 days.
+    """
+    service = get_service()
+    body = {"topicName": topic}
+    if label_ids:
+        body["labelIds"] = list(label_ids)
+        body["labelFilterBehavior"] = "include"
+    return execute(
+        service.users().watch(userId=settings.GMAIL_USER_ID, body=body),
+        "users.watch",
+    )
+
+
+def iter_history_pages(start_history_id: str) -> Iterator[Dict]:
+    """Yield `users.history.list` pages recorded after `start_history_id`.
+
+    Every page carries the mailbox's current `historyId`; raises
+    `HistoryExpired` when Gmail no longer has history that far back.
+    """
+    service = get_service()
+    page_token = None
+    while True:
+        kwargs = {
+            "userId": settings.GMAIL_USER_ID,
+            "startHistoryId": start_history_id,
+            "historyTypes": HISTORY_TYPES,
+            "maxResults": MAX_PAGE_SIZE,
+        }
+        if page_token:
+            kwargs["pageToken"] = page_token
+        try:
+            page = execute(service.users().history().list(**kwargs), "history.list")
+        except HttpError as exc:
+            if exc.resp.status == 404:
+                raise HistoryExpired(start_history_id) from exc
+            raise
+        yield page
+        page_token = page.get("nextPageToken")
+        if not page_token:
+            return
+
+
+def message_get_params(fmt: str = "full") -> Dict:
+    """messages.get parameters for `fmt` ("full" or "metadata")."""
+    if fmt == "metadata":
+        return {
+            "format": "metadata",
+            "metadataHeaders": METADATA_HEADERS,
+            "fields": METADATA_FIELDS,
+        }
+    if fmt != "full":
+        raise ValueError(f"Unknown message format: {fmt}")
+    return {"format": "full"}
+
+
+def get_message(message_id: str, fmt: str = "full") -> Dict:
+    service = get_service()
+    return execute(
         service.users()
         .messages()
-        .list(userId=settings.GMAIL_USER_ID, labelIds=["INBOX"], maxResults=max_results)
-        .execute()
+        .get(userId=settings.GMAIL_USER_ID, id=message_id, **message_get_params(fmt)),
+        "messages.get",
     )
-    return results.get("messages", [])
 
 
-def get_message(message_id: str) -> Dict:
+def fetch_body(message_id: str) -> str:
+    """Download just the MIME payload of one message and return its text."""
     service = get_service()
-    # format=full to get payload and headers
-    return (
+    msg = execute(
         service.users()
         .messages()
-        .get(userId=settings.GMAIL_USER_ID, id=message_id, format="full")
-        .execute()
+        .get(
+            userId=settings.GMAIL_USER_ID,
+            id=message_id,
+            format="full",
+            fields="payload",
+        ),
+        "messages.get",
     )
+    return extract_plain_text(msg.get("payload", {}))
+
+
+def _get_messages_chunk(
+    service,
+    message_ids: List[str],
+    max_retries: int,
+    missing_ok: bool = False,
+    fmt: str = "full",
+) -> List[Dict]:
+    params = message_get_params(fmt)
+    scheduler = get_scheduler()
+    results: Dict[str, Dict] = {}
+    pending = list(message_ids)
+    attempt = 0
+    while pending:
+        errors: Dict[str, Exception] = {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                results[request_id] = response
+
+        batch = service.new_batch_http_request(callback=callback)
+        for message_id in pending:
+            batch.add(
+                service.users()
+                .messages()
+                .get(userId=settings.GMAIL_USER_ID, id=message_id, **params),
+                request_id=message_id,
+            )
+        # Every sub-request is charged as its own messages.get
+        _wait(scheduler.reserve("messages.get", len(pending)))
+        metrics.incr("gmail_api_calls", len(pending), method="messages.get")
+        with metrics.span("gmail.http"):
+            try:
+                batch.execute()
+            except HttpError as exc:
+                if not _is_retryable(exc):
+                    raise
+                # Gmail refused the whole batch (429, 5xx): retry all of it
+                for mid in pending:
+                    errors.setdefault(mid, exc)
+
+        if missing_ok:
+            for mid, exc in list(errors.items()):
+                if isinstance(exc, HttpError) and exc.resp.status == 404:
+                    del errors[mid]
+        fatal = [exc for exc in errors.values() if not _is_retryable(exc)]
+        if fatal:
+            raise fatal[0]
+        pending = [mid for mid in pending if mid in errors]
+        if not pending:
+            scheduler.on_success()
+        else:
+            if attempt >= max_retries:
+                raise errors[pending[0]]
+            # One backoff (and one rate cut) per round, led by a rate limit
+            failed = [errors[mid] for mid in pending]
+            worst = next((e for e in failed if _rate_limited(e)), failed[0])
+            _wait(_retry_delay(worst, attempt))
+            attempt += 1
+
+    return [results[mid] for mid in message_ids if mid in results]
+
+
+def iter_message_batches(
+    message_ids: Iterable[str],
+    batch_size: int = 50,
+    max_retries: Optional[int] = None,
+    missing_ok: bool = False,
+    fmt: str = "full",
+) -> Iterator[List[Dict]]:
+    """Fetch messages through Gmail batch requests, one chunk at a time.
+
+    Items failing with 429/5xx, or a whole batch call refused that way, are
+    retried with backoff; each chunk is yielded as soon as all of its
+    messages have been retrieved. `message_ids` is consumed lazily, so it
+    can be a generator over the whole mailbox. With `missing_ok`, messages
+    deleted in the meantime (404) are skipped. `fmt="metadata"` skips the
+    MIME payload (see `message_get_params`).
+    """
+    service = get_service()
+    size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    retries = settings.GMAIL_MAX_RETRIES if max_retries is None else max_retries
+    ids = iter(message_ids)
+    while True:
+        chunk = list(islice(ids, size))
+        if not chunk:
+            return
+        yield _get_messages_chunk(service, chunk, retries, missing_ok, fmt)
 
 
 def parse_headers(payload_headers: List[Dict]) -> Dict[str, str]:
@@ -67,43 +425,57 @@ def parse_headers(payload_headers: List[Dict]) -> Dict[str, str]:
 
 
 def extract_plain_text(payload: Dict) -> str:
-    # Walk parts to find text/plain
-    def walk(part):
-        if part.get("mimeType") == "text/plain" and "data" in part.get("body", {}):
-            import base64
+    """Text of the first text/plain part; without one, of the first text/html
+    part converted to text (unless `BODY_HTML_FALLBACK` is off)."""
+    found: Dict[str, str] = {}
 
-            return base64.urlsafe_b64decode(part["body"]["data"]).decode(
+    def walk(part) -> bool:
+        mime = part.get("mimeType")
+        data = part.get("body", {}).get("data")
+        if mime in ("text/plain", "text/html") and data and not found.get(mime):
+            found[mime] = base64.urlsafe_b64decode(data).decode(
                 "utf-8", errors="ignore"
             )
-        for p in part.get("parts", []) or []:
-            txt = walk(p)
-            if txt:
-                return txt
-        return ""
+            if found[mime] and mime == "text/plain":
+                return True
+        return any(walk(p) for p in part.get("parts", []) or [])
 
-    return walk(payload) or ""
+    walk(payload)
+    if found.get("text/plain"):
+        return found["text/plain"]
+    if found.get("text/html") and settings.BODY_HTML_FALLBACK:
+        return html_to_text(found["text/html"])
+    return ""
 
 
 def get_labels_map() -> Dict[str, str]:
     service = get_service()
-    res = service.users().labels().list(userId=settings.GMAIL_USER_ID).execute()
+    res = execute(
+        service.users().labels().list(userId=settings.GMAIL_USER_ID), "labels.list"
+    )
     return {lbl["name"]: lbl["id"] for lbl in res.get("labels", [])}
 
 
-def ensure_label(name: str) -> str:
-    service = get_service()
-    labels = get_labels_map()
+def ensure_label(name: str, labels_map: Optional[Dict[str, str]] = None) -> str:
+    """Return the id of label `name`, creating it if needed.
+
+    Pass a `labels_map` from `get_labels_map()` to skip the labels.list call;
+    a newly created label is added to it.
+    """
+    labels = get_labels_map() if labels_map is None else labels_map
     if name in labels:
         return labels[name]
-    res = (
+    service = get_service()
+    res = execute(
         service.users()
         .labels()
         .create(
             userId=settings.GMAIL_USER_ID,
             body={"name": name, "labelListVisibility": "labelShow"},
-        )
-        .execute()
+        ),
+        "labels.create",
     )
+    labels[name] = res["id"]
     return res["id"]
 
 
@@ -114,9 +486,31 @@ def modify_message(
 ):
     service = get_service()
     body = {"addLabelIds": add_labels or [], "removeLabelIds": remove_labels or []}
-    return (
+    return execute(
+        service.users()
+        .messages()
+        .modify(userId=settings.GMAIL_USER_ID, id=message_id, body=body),
+        "messages.modify",
+    )
+
+
+def batch_modify_messages(
+    message_ids: List[str],
+    add_labels: Optional[list] = None,
+    remove_labels: Optional[list] = None,
+):
+    """Apply one label change to up to `BATCH_MODIFY_LIMIT` messages."""
+    if len(message_ids) > BATCH_MODIFY_LIMIT:
+        raise ValueError(f"batchModify accepts at most {BATCH_MODIFY_LIMIT} ids")
+    service = get_service()
+    body = {
+        "ids": list(message_ids),
+        "addLabelIds": add_labels or [],
+        "removeLabelIds": remove_labels or [],
+    }
+    return execute(
         service.users()
         .messages()
-        .modify(userId=settings.GMAIL_USER_ID, id=message_id, body=body)
-        .execute()
+        .batchModify(userId=settings.GMAIL_USER_ID, body=body),
+        "messages.batchModify",
     )
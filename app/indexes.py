@@ -0,0 +1,49 @@
+from typing import List
+
+from sqlalchemy import text
+
+# Index expressions must match `sql_rules.field_expr` exactly for PostgreSQL
+# to use them: pg_trgm GIN indexes serve ILIKE '%...%' (Contains), and the
+# lower(...) B-tree indexes serve Equals.
+TRIGRAM_INDEXES = {
+    "ix_emails_from_trgm": "coalesce(from_email, '')",
+    "ix_emails_to_trgm": "coalesce(to_email, '')",
+    "ix_emails_subject_trgm": "coalesce(subject, '')",
+    "ix_emails_message_trgm": "coalesce(nullif(body, ''), snippet, '')",
+}
+LOWER_INDEXES = {
+    "ix_emails_from_lower": "lower(coalesce(from_email, ''))",
+    "ix_emails_to_lower": "lower(coalesce(to_email, ''))",
+    "ix_emails_subject_lower": "lower(coalesce(subject, ''))",
+}
+FULLTEXT_COLUMN = "body_tsv"
+
+
+def search_index_statements(fulltext: bool = False) -> List[str]:
+    statements = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"]
+    for name, expr in TRIGRAM_INDEXES.items():
+        statements.append(
+            f"CREATE INDEX IF NOT EXISTS {name} ON emails "
+            f"USING gin (({expr}) gin_trgm_ops)"
+        )
+    for name, expr in LOWER_INDEXES.items():
+        statements.append(f"CREATE INDEX IF NOT EXISTS {name} ON emails (({expr}))")
+    if fulltext:
+        statements += [
+            f"ALTER TABLE emails ADD COLUMN IF NOT EXISTS {FULLTEXT_COLUMN} tsvector "
+            "GENERATED ALWAYS AS "
+            "(to_tsvector('simple', coalesce(subject, '') || ' ' || "
+            "coalesce(nullif(body, ''), snippet, ''))) STORED",
+            f"CREATE INDEX IF NOT EXISTS ix_emails_{FULLTEXT_COLUMN} ON emails "
+            f"USING gin ({FULLTEXT_COLUMN})",
+        ]
+    return statements
+
+
+def create_search_indexes(engine, fulltext: bool = False) -> None:
+    """Create the pg_trgm (and optionally tsvector) indexes on `emails`."""
+    if engine.dialect.name != "postgresql":
+        raise RuntimeError("Search indexes require PostgreSQL")
+    with engine.begin() as conn:
+        for stmt in search_index_statements(fulltext):
+            conn.execute(text(stmt))
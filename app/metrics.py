@@ -0,0 +1,153 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+import os
+import tempfile
+import threading
+import time
+
+# Off unless a command asks for a report, so the hot paths pay one flag check
+enabled = False
+
+PROMETHEUS_PREFIX = "mailhelper"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Labels], float] = {}
+# name -> [calls, seconds]
+_spans: Dict[str, List[float]] = {}
+
+
+def enable(on: bool = True) -> None:
+    global enabled
+    enabled = on
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _spans.clear()
+
+
+def incr(name: str, value: float = 1, **labels: str) -> None:
+    """Add `value` to counter `name` (with optional string labels)."""
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time the block under stage `name`.
+
+    Spans are totals per name, so nested stages overlap (e.g. `gmail.http`
+    inside `process.match` when bodies are fetched on demand) and spans run
+    from several threads can add up to more than the wall time.
+    """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            totals = _spans.setdefault(name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+
+
+def counter(name: str, **labels: str) -> float:
+    return _counters.get((name, tuple(sorted(labels.items()))), 0)
+
+
+def snapshot() -> Dict:
+    """Picklable copy of everything recorded, for `merge` in another process."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "spans": {name: list(totals) for name, totals in _spans.items()},
+        }
+
+
+def merge(data: Dict) -> None:
+    """Add a worker process's `snapshot()` to this process's totals."""
+    with _lock:
+        for key, value in data["counters"].items():
+            _counters[key] = _counters.get(key, 0) + value
+        for name, (calls, seconds) in data["spans"].items():
+            totals = _spans.setdefault(name, [0, 0.0])
+            totals[0] += calls
+            totals[1] += seconds
+
+
+def _label_text(labels: Labels) -> str:
+    return ",".join(f"{k}={v}" for k, v in labels)
+
+
+def report() -> List[str]:
+    """Lines of the `--profile` table: stages by time, then counters."""
+    data = snapshot()
+    lines = [f"{'stage':<24}{'calls':>10}{'seconds':>12}"]
+    for name, (calls, seconds) in sorted(
+        data["spans"].items(), key=lambda item: -item[1][1]
+    ):
+        lines.append(f"{name:<24}{int(calls):>10}{seconds:>12.3f}")
+    lines.append("")
+    lines.append(f"{'counter':<48}{'value':>12}")
+    for (name, labels), value in sorted(data["counters"].items()):
+        label = f"{name}{{{_label_text(labels)}}}" if labels else name
+        lines.append(f"{label:<48}{value:>12.0f}")
+    return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def render_prometheus() -> str:
+    """Counters and stage timings in the Prometheus text exposition format."""
+    data = snapshot()
+    by_name: Dict[str, List[Tuple[Labels, float]]] = {}
+    for (name, labels), value in sorted(data["counters"].items()):
+        by_name.setdefault(name, []).append((labels, value))
+    spans = sorted(data["spans"].items())
+    by_name["stage_seconds"] = [((("stage", n),), t[1]) for n, t in spans]
+    by_name["stage_calls"] = [((("stage", n),), t[0]) for n, t in spans]
+
+    lines = []
+    for name, samples in by_name.items():
+        if not samples:
+            continue
+        metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        for labels, value in samples:
+            lines.append(f"{metric}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str) -> None:
+    """Write `render_prometheus()` for node_exporter's textfile collector.
+
+    The file is replaced atomically so a scrape never reads half of it.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(render_prometheus())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -1,9 +1,13 @@
-from sqlalchemy import String, DateTime, Boolean, Text
+from sqlalchemy import JSON, String, DateTime, Boolean, ForeignKey, LargeBinary, Text
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.dialects.postgresql import JSONB
 from datetime import datetime
+from typing import Optional
 from .db import Base
 
+# JSONB on PostgreSQL, JSON (text) on SQLite
+JSONType = JSON().with_variant(JSONB(), "postgresql")
+
 
 class Email(Base):
     __tablename__ = "emails"
@@ -14,9 +18,42 @@ class Email(Base):
     to_email: Mapped[str] = mapped_column(Text)
     subject: Mapped[str] = mapped_column(Text, default="")
     snippet: Mapped[str] = mapped_column(Text, default="")
-    body: Mapped[str] = mapped_column(Text, default="")
+    # NULL until fetched: `fetch --format metadata` stores headers only
+    body: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # The body compressed by app.bodies (BODY_COMPRESSION), `body` then NULL.
+    # Deferred: loaded only by queries whose rules read `Message`
+    body_z: Mapped[Optional[bytes]] = mapped_column(
+        LargeBinary, nullable=True, deferred=True
+    )
     received_at: Mapped[datetime] = mapped_column(DateTime, index=True)
     is_read: Mapped[bool] = mapped_column(Boolean, default=False, index=True)
     labels: Mapped[dict] = mapped_column(
-        JSONB, default=dict
+        JSONType, default=dict
     )  # {"ids": [...], "names": [...]}
+    # sha256 of the fields rules read (see eval_cache.content_hash)
+    content_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+
+
+class SyncState(Base):
+    __tablename__ = "sync_state"
+
+    user_id: Mapped[str] = mapped_column(String, primary_key=True)
+    history_id: Mapped[str] = mapped_column(String)  # last Gmail historyId seen
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class RuleEvaluation(Base):
+    """Cached result of one ruleset (by fingerprint) on one email's content."""
+
+    __tablename__ = "rule_evaluations"
+
+    email_id: Mapped[str] = mapped_column(
+        String, ForeignKey("emails.id", ondelete="CASCADE"), primary_key=True
+    )
+    rule_fingerprint: Mapped[str] = mapped_column(String(64), primary_key=True)
+    content_hash: Mapped[str] = mapped_column(String(64))
+    matched: Mapped[bool] = mapped_column(Boolean)
+    applied: Mapped[bool] = mapped_column(Boolean, default=False)
+    # a date condition may change the result from then on; NULL: never
+    valid_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    evaluated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
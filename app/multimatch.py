@@ -0,0 +1,189 @@
+from __future__ import annotations
+from collections import deque
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set
+
+from . import metrics
+from .models import Email
+from .rules_engine import (
+    DATE_PREDICATES,
+    RULESET_PREDICATES,
+    RuleSet,
+    compile_condition,
+    counted,
+    text_getter,
+)
+
+# Predicates answered from the per-field automaton scan
+SCANNED_PREDICATES = {"Contains", "DoesNotContain"}
+
+# Distinct patterns from which the automaton's pure-Python walk over a
+# field beats one C-level `in` check per pattern (measured on the benchmark
+# mailbox: about 100 for headers, 300 for bodies)
+AUTOMATON_MIN_PATTERNS = {"message": 300}
+DEFAULT_AUTOMATON_MIN_PATTERNS = 100
+
+
+class SubstringScan:
+    """`AhoCorasick`'s interface over one `in` check per pattern."""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = list(dict.fromkeys(patterns))
+        self._ids = {p: i for i, p in enumerate(self.patterns)}
+
+    def pattern_id(self, pattern: str) -> int:
+        return self._ids[pattern]
+
+    def find_all(self, text: str) -> Set[int]:
+        """Return the ids of every pattern occurring in `text`."""
+        return {i for i, p in enumerate(self.patterns) if p in text}
+
+
+class AhoCorasick:
+    """Aho-Corasick automaton reporting which of its patterns occur in a text.
+
+    Each text is walked one character at a time in Python, so it only pays
+    off over many patterns; see `AUTOMATON_MIN_PATTERNS`.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = []
+        self._ids: Dict[str, int] = {}
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[tuple] = [()]
+        for p in patterns:
+            self._add(p)
+        self._build()
+
+    def _add(self, pattern: str) -> int:
+        if pattern in self._ids:
+            return self._ids[pattern]
+        pid = self._ids[pattern] = len(self.patterns)
+        self.patterns.append(pattern)
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = self._goto[state][ch] = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = nxt
+        self._out[state] += (pid,)
+        return pid
+
+    def pattern_id(self, pattern: str) -> int:
+        return self._ids[pattern]
+
+    def _build(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                # Inherit matches ending at the longest proper suffix
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def find_all(self, text: str) -> Set[int]:
+        """Return the ids of every pattern occurring in `text`, in one pass."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set(out[0])  # the empty pattern occurs in every text
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+def field_scanner(field: str, patterns: List[str]):
+    """An `AhoCorasick` automaton over `patterns`, or a `SubstringScan`
+    when there are too few of them for `field` to pay off."""
+    threshold = AUTOMATON_MIN_PATTERNS.get(field, DEFAULT_AUTOMATON_MIN_PATTERNS)
+    if len(set(patterns)) < threshold:
+        return SubstringScan(patterns)
+    return AhoCorasick(patterns)
+
+
+class _FieldHits(dict):
+    """Per-email cache: field -> pattern ids found, scanned on first access."""
+
+    def __init__(self, matcher: IndexedMatcher, email: Email):
+        super().__init__()
+        self._matcher = matcher
+        self._email = email
+
+    def __missing__(self, field: str) -> Set[int]:
+        automaton = self._matcher.automata[field]
+        found = automaton.find_all(self._matcher.getters[field](self._email))
+        self[field] = found
+        return found
+
+
+Check = Callable[[Email, _FieldHits], bool]
+
+
+class IndexedMatcher:
+    """Evaluate all rulesets with one Aho-Corasick scan per email field.
+
+    `Contains`/`DoesNotContain` targets of every rule are indexed into one
+    automaton per field; each field of an email is scanned at most once and
+    every substring condition becomes a set lookup. Other predicates use the
+    regular compiled conditions (dates against one `now`, as in
+    `CompiledMatcher`), so results agree with `email_matches`.
+
+    The automaton walks text in pure Python, so on its own it only beats
+    `CompiledMatcher` from about 300 rules (and is 10x slower at 10). A
+    field with fewer than `AUTOMATON_MIN_PATTERNS` targets is scanned with
+    one `in` check per target instead; with that, on the benchmark mailbox
+    this engine is about as fast as `compiled` at 10 rules and 1.5x faster
+    from 100.
+    """
+
+    def __init__(self, rulesets: List[RuleSet], now: Optional[datetime] = None):
+        self.rulesets = rulesets
+        self.now = now or datetime.utcnow()
+        targets: Dict[str, List[str]] = {}
+        for rs in rulesets:
+            for cond in rs.rules:
+                if cond.predicate in SCANNED_PREDICATES:
+                    f = cond.field.lower()
+                    targets.setdefault(f, []).append(str(cond.value).lower())
+        self.automata = {f: field_scanner(f, ts) for f, ts in targets.items()}
+        self.getters = {f: text_getter(f) for f in targets}
+        self._plans = [self._compile(rs) for rs in rulesets]
+
+    def _check(self, cond) -> Check:
+        if cond.predicate not in SCANNED_PREDICATES:
+            match = compile_condition(cond, self.now)
+            return lambda e, hits: match(e)
+        f = cond.field.lower()
+        pid = self.automata[f].pattern_id(str(cond.value).lower())
+        if cond.predicate == "Contains":
+            return lambda e, hits: pid in hits[f]
+        return lambda e, hits: pid not in hits[f]
+
+    def _compile(self, rs: RuleSet) -> Check:
+        if rs.predicate not in RULESET_PREDICATES:
+            raise ValueError(f"Unknown ruleset predicate: {rs.predicate}")
+        conds = sorted(rs.rules, key=lambda c: c.predicate not in DATE_PREDICATES)
+        checks = [self._check(cond) for cond in conds]
+        if metrics.enabled:
+            checks = [counted(check) for check in checks]
+        if rs.predicate == "All":
+            return lambda e, hits: all(check(e, hits) for check in checks)
+        return lambda e, hits: any(check(e, hits) for check in checks)
+
+    def iter_matches(self, email: Email) -> Iterator[int]:
+        """Yield the index of every matching ruleset, in file order."""
+        hits = _FieldHits(self, email)
+        for i, plan in enumerate(self._plans):
+            if plan(email, hits):
+                yield i
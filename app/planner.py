@@ -0,0 +1,275 @@
+from __future__ import annotations
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from sqlalchemy import func, select
+
+from . import metrics
+from .config import settings
+from .models import Email
+from .rules_engine import (
+    DATE_PREDICATES,
+    FIELDS,
+    RULESET_PREDICATES,
+    EmailRecord,
+    Matcher,
+    RuleCondition,
+    RuleSet,
+    compile_condition,
+    counted,
+    text_getter,
+)
+
+# Most common values kept per field, as in PostgreSQL's pg_stats
+MCV_SIZE = 100
+
+# Guesses used without statistics (an empty table or no sample)
+DEFAULT_SELECTIVITY = {
+    "Equals": 0.05,
+    "DoesNotEqual": 0.95,
+    "Contains": 0.1,
+    "DoesNotContain": 0.9,
+}
+DEFAULT_DATE_SELECTIVITY = 0.5
+DEFAULT_TEXT_LENGTH = {"message": 2000.0}
+
+# Relative costs: a fixed overhead per check, plus one unit per 64 characters
+# of text a substring search may read
+CHECK_COST = 1.0
+CHARS_PER_COST_UNIT = 64
+
+
+@dataclass
+class FieldStats:
+    avg_length: float
+    n_distinct: int
+    # lowercased value -> fraction of sampled rows
+    mcv: Dict[str, float]
+
+
+@dataclass
+class ColumnStats:
+    """Statistics of the `emails` table, from a sample of recent rows.
+
+    Equality selectivity comes from the most common values and the distinct
+    count; substring and date selectivity from evaluating the condition on
+    the sample itself.
+    """
+
+    rows: int = 0
+    sample: List[EmailRecord] = field(default_factory=list)
+    fields: Dict[str, FieldStats] = field(default_factory=dict)
+
+    @classmethod
+    def from_sample(cls, rows: int, sample: List[EmailRecord]) -> ColumnStats:
+        """Field statistics computed over `sample`, out of `rows` emails."""
+        stats = cls(rows=rows, sample=sample)
+        if not sample:
+            return stats
+        for f in FIELDS - {"received"}:
+            get = text_getter(f)
+            values = Counter(get(e) for e in sample)
+            stats.fields[f] = FieldStats(
+                avg_length=sum(len(v) * n for v, n in values.items()) / len(sample),
+                n_distinct=len(values),
+                mcv={
+                    v: n / len(sample)
+                    for v, n in values.most_common(MCV_SIZE)
+                    # values seen once say nothing about frequency
+                    if n > 1
+                },
+            )
+        return stats
+
+    def avg_length(self, f: str) -> float:
+        if f in self.fields:
+            return self.fields[f].avg_length
+        return DEFAULT_TEXT_LENGTH.get(f, 40.0)
+
+    def selectivity(self, cond: RuleCondition, now: datetime) -> float:
+        """Estimated fraction of emails for which `cond` holds."""
+        f = cond.field.lower()
+        if not self.sample:
+            if cond.predicate in DATE_PREDICATES:
+                return DEFAULT_DATE_SELECTIVITY
+            return DEFAULT_SELECTIVITY.get(cond.predicate, 0.5)
+        if cond.predicate in ("Equals", "DoesNotEqual") and f in self.fields:
+            eq = self._equals_selectivity(self.fields[f], str(cond.value).lower())
+            return eq if cond.predicate == "Equals" else 1 - eq
+        check = compile_condition(cond, now)
+        hits = sum(1 for e in self.sample if check(e))
+        # smoothed, so no estimate is exactly 0 or 1
+        return (hits + 0.5) / (len(self.sample) + 1)
+
+    def _equals_selectivity(self, stats: FieldStats, value: str) -> float:
+        if value in stats.mcv:
+            return stats.mcv[value]
+        rest = stats.n_distinct - len(stats.mcv)
+        if rest <= 0:
+            return 0.5 / (len(self.sample) + 1)
+        return max(1 - sum(stats.mcv.values()), 0) / rest
+
+    def cost(self, cond: RuleCondition) -> float:
+        """Relative cost of one check of `cond` on one email."""
+        if cond.predicate in DATE_PREDICATES:
+            return CHECK_COST
+        length = self.avg_length(cond.field.lower())
+        if cond.predicate in ("Equals", "DoesNotEqual"):
+            # a length mismatch ends the comparison right away
+            return CHECK_COST + 0.1 * length / CHARS_PER_COST_UNIT
+        return CHECK_COST + length / CHARS_PER_COST_UNIT
+
+
+def gather_stats(session, sample_size: Optional[int] = None) -> ColumnStats:
+    """Row count plus per-field statistics of the latest `sample_size` emails."""
+    sample_size = sample_size or settings.PLANNER_SAMPLE_SIZE
+    rows = session.scalar(select(func.count()).select_from(Email)) or 0
+    query = (
+        select(
+            Email.from_email,
+            Email.to_email,
+            Email.subject,
+            Email.snippet,
+            Email.body,
+            Email.received_at,
+        )
+        .order_by(Email.received_at.desc())
+        .limit(sample_size)
+    )
+    sample = [
+        EmailRecord(
+            from_email=r.from_email,
+            to_email=r.to_email,
+            subject=r.subject,
+            snippet=r.snippet,
+            body=r.body,
+            received_at=r.received_at,
+        )
+        for r in session.execute(query)
+    ]
+    return ColumnStats.from_sample(rows, sample)
+
+
+@dataclass
+class ConditionPlan:
+    cond: RuleCondition
+    selectivity: float
+    cost: float
+
+
+@dataclass
+class RulesetPlan:
+    ruleset: RuleSet
+    # (field, value) probes of the Equals hash index; empty: checked for all
+    index_keys: List[Tuple[str, str]]
+    conditions: List[ConditionPlan]
+
+
+def order_conditions(
+    rs: RuleSet, stats: ColumnStats, now: datetime
+) -> List[ConditionPlan]:
+    """Conditions of `rs` in the order that minimises expected cost.
+
+    For `All`, by cost / (1 - selectivity): cheap conditions that usually
+    fail go first. For `Any`, by cost / selectivity: cheap ones that usually
+    hold. Each check's result is independent of the others, so the order
+    never changes whether the ruleset matches.
+    """
+    plans = [
+        ConditionPlan(c, stats.selectivity(c, now), stats.cost(c)) for c in rs.rules
+    ]
+
+    def rank(p: ConditionPlan) -> float:
+        decides = 1 - p.selectivity if rs.predicate == "All" else p.selectivity
+        return p.cost / max(decides, 1e-9)
+
+    return sorted(plans, key=rank)
+
+
+def index_keys(rs: RuleSet, plans: List[ConditionPlan]) -> List[Tuple[str, str]]:
+    """Equals probes that together find every email `rs` can match.
+
+    An `All` ruleset needs its most selective header `Equals`; an `Any`
+    ruleset can only be indexed when all of its conditions are. `Message` is
+    never a key: probing it would read every email's body just to look it
+    up, so such rulesets are checked with their conditions in cost order.
+    """
+    equals = [
+        p
+        for p in plans
+        if p.cond.predicate == "Equals" and p.cond.field.lower() != "message"
+    ]
+    if rs.predicate == "All" and equals:
+        equals = [min(equals, key=lambda p: (p.selectivity, p.cost))]
+    elif rs.predicate != "Any" or not equals or len(equals) < len(plans):
+        return []
+    return sorted({(p.cond.field.lower(), str(p.cond.value).lower()) for p in equals})
+
+
+def plan_rulesets(
+    rulesets: List[RuleSet], stats: Optional[ColumnStats] = None, now=None
+) -> List[RulesetPlan]:
+    stats = stats or ColumnStats()
+    now = now or datetime.utcnow()
+    plans = []
+    for rs in rulesets:
+        conditions = order_conditions(rs, stats, now)
+        plans.append(RulesetPlan(rs, index_keys(rs, conditions), conditions))
+    return plans
+
+
+class PlannedMatcher:
+    """Match through an `Equals` hash index, with conditions cost-ordered.
+
+    Rulesets with an index key are only checked for emails whose field text
+    equals it: one dict lookup per indexed field finds them. All other
+    rulesets are checked for every email. Inside a ruleset, conditions run in
+    the order `order_conditions` estimates cheapest, from `stats` (defaults
+    without). Results are the same as `email_matches` against one `now`.
+    """
+
+    def __init__(
+        self,
+        rulesets: List[RuleSet],
+        now: Optional[datetime] = None,
+        stats: Optional[ColumnStats] = None,
+    ):
+        self.rulesets = rulesets
+        self.now = now or datetime.utcnow()
+        self.plans = plan_rulesets(rulesets, stats, self.now)
+        self.always: List[int] = []
+        self.index: Dict[str, Dict[str, List[int]]] = {}
+        for i, plan in enumerate(self.plans):
+            if not plan.index_keys:
+                self.always.append(i)
+            for f, value in plan.index_keys:
+                self.index.setdefault(f, {}).setdefault(value, []).append(i)
+        self.getters = {f: text_getter(f) for f in self.index}
+        self._checks = [self._compile(plan) for plan in self.plans]
+
+    def _compile(self, plan: RulesetPlan) -> Matcher:
+        rs = plan.ruleset
+        if rs.predicate not in RULESET_PREDICATES:
+            raise ValueError(f"Unknown ruleset predicate: {rs.predicate}")
+        checks = [compile_condition(p.cond, self.now) for p in plan.conditions]
+        if metrics.enabled:
+            checks = [counted(check) for check in checks]
+        if rs.predicate == "All":
+            return lambda e: all(check(e) for check in checks)
+        return lambda e: any(check(e) for check in checks)
+
+    def candidates(self, email: Email) -> List[int]:
+        """Indexes of the rulesets that can match `email`, in file order."""
+        found: Set[int] = set(self.always)
+        for f, table in self.index.items():
+            found.update(table.get(self.getters[f](email), ()))
+        metrics.incr("planner_rulesets_skipped", len(self.plans) - len(found))
+        return sorted(found)
+
+    def iter_matches(self, email: Email) -> Iterator[int]:
+        """Yield the index of every matching ruleset, in file order."""
+        for i in self.candidates(email):
+            if self._checks[i](email):
+                yield i
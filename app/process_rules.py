@@ -1,33 +1,482 @@
-from sqlalchemy import select
-from . import db
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice, repeat
+from sqlalchemy import select, update
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.attributes import set_committed_value
+from . import db, gmail_client, metrics
 from .models import Email
-from .rules_engine import email_matches, apply_actions
-from .rules_engine import RuleSet
-from typing import List
+from .multimatch import IndexedMatcher
+from .actions import ActionBatch
+from .async_gmail import AsyncGmailClient
+from .bodies import decompress_body, prepare_body
+from .columnar import ColumnarMatcher
+from .eval_cache import EvaluationCache
+from .planner import ColumnStats, PlannedMatcher, gather_stats
+from .rules_engine import CompiledMatcher
+from .rules_engine import RuleSet, lazy_bodies
+from .sql_rules import (
+    candidates_query,
+    emails_query,
+    pushdown_flags,
+    rule_columns,
+    unreadable_bodies,
+)
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 from .config import settings
 
+# Interchangeable matchers; all yield the same (email, ruleset) matches
+MATCH_ENGINES = {
+    "compiled": CompiledMatcher,
+    "indexed": IndexedMatcher,
+    "columnar": ColumnarMatcher,
+    "planned": PlannedMatcher,
+}
 
-def process_rules(rulesets: List[RuleSet], stop_after_first_match: bool | None = None):
+# Per-process state of pool workers, set once by _init_worker
+_worker_matcher = None
+
+
+class _BodyLoader:
+    """Provide bodies not stored as plain text, once a rule needs one.
+
+    Compressed bodies (`body_z`) are decompressed in memory only. Bodies
+    skipped by a metadata-only fetch are downloaded and set on the email,
+    so a session holding it stores them (capped and compressed as
+    configured) on commit; `write` stores bodies of emails read through
+    another session.
+    """
+
+    def __init__(self):
+        self.loaded: Dict[str, Tuple[Optional[str], Optional[bytes]]] = {}
+
+    def __call__(self, email: Email) -> str:
+        if email.body_z is not None:
+            text = decompress_body(email.body_z)
+            metrics.incr("bodies_decompressed")
+            # Kept for the next condition, without marking the row changed
+            set_committed_value(email, "body", text)
+            return text
+        text, body, body_z = prepare_body(gmail_client.fetch_body(email.id))
+        self.loaded[email.id] = (body, body_z)
+        if body_z is None:
+            email.body = text
+        else:
+            email.body_z = body_z
+            set_committed_value(email, "body", text)
+        return text
+
+    def write(self, session) -> None:
+        if self.loaded:
+            rows = [
+                {"id": mid, "body": body, "body_z": body_z}
+                for mid, (body, body_z) in self.loaded.items()
+            ]
+            session.execute(update(Email), rows)
+            self.loaded.clear()
+
+
+def _new_matcher(
+    engine: str,
+    rulesets: List[RuleSet],
+    now: Optional[datetime],
+    stats: Optional[ColumnStats] = None,
+):
+    """The matcher for `engine`; the planner also takes table statistics."""
+    if engine == "planned":
+        return PlannedMatcher(rulesets, now, stats)
+    return MATCH_ENGINES[engine](rulesets, now)
+
+
+def _engine_stats(session, engine: str) -> Optional[ColumnStats]:
+    return gather_stats(session) if engine == "planned" else None
+
+
+def _stop_flag(stop_after_first_match: bool | None) -> bool:
+    if stop_after_first_match is None:
+        return settings.STOP_AFTER_FIRST_MATCH
+    return stop_after_first_match
+
+
+def _emails_to_match(
+    session,
+    rulesets: List[RuleSet],
+    matcher,
+    stop_flag: bool,
+    pushdown: bool,
+    cache: Optional[EvaluationCache] = None,
+    email_ids: Optional[Sequence[str]] = None,
+):
+    """`select(Email)` of the emails `_match_all` checks."""
+    query = (
+        candidates_query(rulesets, matcher.now, *pushdown_flags(session, rulesets))
+        if pushdown
+        else emails_query(rulesets)
+    )
+    if email_ids is not None:
+        query = query.where(Email.id.in_(email_ids))
+    if cache is not None:
+        query = query.where(cache.stale_clause(stop_flag))
+    return query
+
+
+def _match_all(
+    session,
+    rulesets: List[RuleSet],
+    matcher,
+    stop_flag: bool,
+    pushdown: bool,
+    actions: ActionBatch,
+    cache: Optional[EvaluationCache] = None,
+    email_ids: Optional[Sequence[str]] = None,
+) -> int:
+    query = _emails_to_match(
+        session, rulesets, matcher, stop_flag, pushdown, cache, email_ids
+    )
+    with metrics.span("process.load"):
+        emails = session.scalars(query).all()
+        if cache is not None:
+            cache.load(session, emails)
+    matched = 0
+    with metrics.span("process.match"):
+        if cache is not None:
+            selected = [cache.select(e, matcher, stop_flag) for e in emails]
+        else:
+            selected = _match_batch(matcher, emails, stop_flag)
+        for e, indexes in zip(emails, selected):
+            for i in indexes:
+                actions.add(e, rulesets[i].actions)
+                matched += 1
+    metrics.incr("emails_scanned", len(emails))
+    return matched
+
+
+def _select_matches(matches: Iterator[int], stop_flag: bool) -> List[int]:
+    indexes = list(islice(matches, 1)) if stop_flag else list(matches)
+    if metrics.enabled:
+        for i in indexes:
+            metrics.incr("rule_matches", ruleset=str(i + 1))
+    return indexes
+
+
+def _match_batch(matcher, emails: Sequence[Email], stop_flag: bool) -> List[List[int]]:
+    """`_select_matches` for each email; the columnar engine does all at once."""
+    if not isinstance(matcher, ColumnarMatcher):
+        return [_select_matches(matcher.iter_matches(e), stop_flag) for e in emails]
+    selected = matcher.match_batch(emails, stop_flag)
+    if metrics.enabled:
+        for indexes in selected:
+            for i in indexes:
+                metrics.incr("rule_matches", ruleset=str(i + 1))
+    return selected
+
+
+def id_ranges(session, chunk_size: int) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Split `emails` into primary-key ranges `(lo, hi]` of `chunk_size` rows.
+
+    Boundaries are found by keyset pagination, so each step reads at most
+    `chunk_size` index entries; `None` means unbounded.
+    """
+    ranges = []
+    lo = None
+    while True:
+        stmt = select(Email.id).order_by(Email.id).offset(chunk_size - 1).limit(1)
+        if lo is not None:
+            stmt = stmt.where(Email.id > lo)
+        hi = session.scalars(stmt).first()
+        ranges.append((lo, hi))
+        if hi is None:
+            return ranges
+        lo = hi
+
+
+def _init_worker(
+    rulesets: List[RuleSet],
+    engine: str,
+    profile: bool,
+    now: datetime,
+    stats: Optional[ColumnStats],
+) -> None:
+    global _worker_matcher
+    # Connections inherited from the parent must not be shared after fork
+    db.get_engine().dispose(close=False)
+    gmail_client.close_client()
+    # Totals copied from the parent would be counted twice when merged back
+    metrics.enable(profile)
+    metrics.reset()
+    _worker_matcher = _new_matcher(engine, rulesets, now, stats)
+
+
+def _match_range(
+    bounds: Tuple[Optional[str], Optional[str]],
+    stop_flag: bool,
+    pushdown: bool,
+    flags: Tuple[bool, bool, bool] = (True, True, False),
+) -> Tuple[List[Tuple[str, List[int]]], Optional[Dict]]:
+    """Worker task: (email id, matching ruleset indexes) for one id range.
+
+    Also returns the task's metrics snapshot while metrics are enabled.
+    """
+    lo, hi = bounds
+    matcher = _worker_matcher
+    query = (
+        candidates_query(matcher.rulesets, matcher.now, *flags)
+        if pushdown
+        else emails_query(matcher.rulesets)
+    )
+    if lo is not None:
+        query = query.where(Email.id > lo)
+    if hi is not None:
+        query = query.where(Email.id <= hi)
     session = db.get_session()
     try:
-        emails = session.scalars(select(Email)).all()
+        with lazy_bodies(_BodyLoader()), metrics.span("process.match"):
+            emails = session.scalars(query.order_by(Email.id)).all()
+            selected = _match_batch(matcher, emails, stop_flag)
+        results = [(e.id, indexes) for e, indexes in zip(emails, selected) if indexes]
+        metrics.incr("emails_scanned", len(emails))
+        # keep bodies fetched on demand
+        session.commit()
+        if not metrics.enabled:
+            return results, None
+        snapshot = metrics.snapshot()
+        metrics.reset()
+        return results, snapshot
+    finally:
+        session.close()
+
+
+def _process_parallel(
+    session,
+    rulesets: List[RuleSet],
+    engine: str,
+    stop_flag: bool,
+    pushdown: bool,
+    workers: int,
+    now: datetime,
+) -> int:
+    ranges = id_ranges(session, settings.PROCESS_CHUNK_SIZE)
+    actions = ActionBatch()
+    matched = 0
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(
+            rulesets,
+            engine,
+            metrics.enabled,
+            now,
+            _engine_stats(session, engine),
+        ),
+    ) as pool:
+        flags = pushdown_flags(session, rulesets) if pushdown else (True, True, False)
+        results = pool.map(
+            _match_range, ranges, repeat(stop_flag), repeat(pushdown), repeat(flags)
+        )
+        # map() yields in range order, so writes happen in primary-key order
+        for range_results, worker_metrics in results:
+            if worker_metrics is not None:
+                metrics.merge(worker_metrics)
+            if not range_results:
+                continue
+            ids = [email_id for email_id, _ in range_results]
+            emails = {
+                e.id: e for e in session.scalars(select(Email).where(Email.id.in_(ids)))
+            }
+            for email_id, indexes in range_results:
+                for i in indexes:
+                    actions.add(emails[email_id], rulesets[i].actions)
+                    matched += 1
+    with metrics.span("actions.apply"):
+        actions.flush(session)
+    return matched
+
+
+def _process_streaming(
+    session,
+    rulesets: List[RuleSet],
+    matcher,
+    stop_flag: bool,
+    pushdown: bool,
+) -> int:
+    """Match over a server-side cursor, `PROCESS_CHUNK_SIZE` rows at a time.
+
+    Only the columns the rules read are loaded (so `body` stays deferred
+    without a `Message` rule). Each chunk's actions are written through a
+    second session, because committing would close the streaming cursor,
+    and the chunk is then dropped from the identity map.
+    """
+    query = (
+        candidates_query(rulesets, matcher.now, *pushdown_flags(session, rulesets))
+        if pushdown
+        else emails_query(rulesets)
+    )
+    query = query.options(load_only(*rule_columns(rulesets))).execution_options(
+        yield_per=settings.PROCESS_CHUNK_SIZE
+    )
+    writer = db.get_session()
+    loader = _BodyLoader()
+    try:
         matched = 0
-        stop_flag = (
-            settings.STOP_AFTER_FIRST_MATCH
-            if stop_after_first_match is None
-            else stop_after_first_match
+        actions = ActionBatch()
+        for chunk in session.scalars(query).partitions():
+            with lazy_bodies(loader), metrics.span("process.match"):
+                for e, indexes in zip(chunk, _match_batch(matcher, chunk, stop_flag)):
+                    for i in indexes:
+                        actions.add(e, rulesets[i].actions)
+                        matched += 1
+            metrics.incr("emails_scanned", len(chunk))
+            with metrics.span("actions.apply"):
+                loader.write(writer)
+                actions.flush(writer, bulk=True)
+                writer.commit()
+            # expunge_all() would invalidate the identity map the open
+            # result is still loading into
+            for e in chunk:
+                session.expunge(e)
+        return matched
+    finally:
+        writer.close()
+
+
+def process_rules(
+    rulesets: List[RuleSet],
+    stop_after_first_match: bool | None = None,
+    engine: str = "compiled",
+    pushdown: bool = True,
+    workers: int = 1,
+    stream: bool = False,
+    use_cache: bool = False,
+    now: Optional[datetime] = None,
+    email_ids: Optional[Sequence[str]] = None,
+):
+    """Apply `rulesets` to stored emails; returns the number of matches.
+
+    With `pushdown`, rule conditions are translated to SQL so only candidate
+    rows are loaded; every candidate is still checked by the Python matcher.
+    With `workers > 1`, id ranges are matched in a process pool and the
+    results are applied here, giving the same matches as a serial run.
+    With `stream`, rows are read through a server-side cursor in chunks
+    so memory use does not grow with the table. Bodies skipped by a
+    metadata-only fetch are downloaded (and stored) only for emails that
+    reach a `Message` condition. With `use_cache`, only emails lacking a
+    cached result for some ruleset are loaded, and actions already applied
+    for the same content and ruleset are not sent again (see
+    `EvaluationCache`). Date conditions, in SQL and in Python, are all
+    evaluated against one `now` (default: the current UTC time).
+    `email_ids` limits the run to those emails (e.g. just fetched ones).
+    """
+    if engine not in MATCH_ENGINES:
+        raise ValueError(f"Unknown match engine: {engine}")
+    if (use_cache or email_ids is not None) and (workers > 1 or stream):
+        raise ValueError(
+            "use_cache and email_ids cannot be combined with workers or stream"
         )
+    stop_flag = _stop_flag(stop_after_first_match)
+    now = now or datetime.utcnow()
+    session = db.get_session()
+    try:
+        if workers > 1:
+            return _process_parallel(
+                session, rulesets, engine, stop_flag, pushdown, workers, now
+            )
 
-        for e in emails:
-            for rs in rulesets:
-                if email_matches(e, rs):
-                    updates = apply_actions(e, rs.actions)
-                    for k, v in updates.items():
-                        setattr(e, k, v)
-                    matched += 1
-                    if stop_flag:
-                        break
+        matcher = _new_matcher(engine, rulesets, now, _engine_stats(session, engine))
+        if stream:
+            return _process_streaming(session, rulesets, matcher, stop_flag, pushdown)
+        actions = ActionBatch()
+        cache = EvaluationCache(rulesets, now) if use_cache else None
+        with lazy_bodies(_BodyLoader()):
+            matched = _match_all(
+                session,
+                rulesets,
+                matcher,
+                stop_flag,
+                pushdown,
+                actions,
+                cache,
+                email_ids,
+            )
+        with metrics.span("actions.apply"):
+            actions.flush(session)
+            if cache is not None:
+                cache.write(session)
+            session.commit()
+        return matched
+    finally:
+        session.close()
+
+
+async def _prefetch_bodies(session, client: AsyncGmailClient, query) -> None:
+    """Download the unfetched bodies among `query`'s emails concurrently.
+
+    Matching then finds them stored instead of `_BodyLoader` downloading
+    them one at a time through the blocking client, on the event loop.
+    """
+    unfetched = query.with_only_columns(Email.id).where(
+        Email.body.is_(None), Email.body_z.is_(None)
+    )
+    ids = session.scalars(unfetched).all()
+    for start in range(0, len(ids), settings.UPSERT_CHUNK_SIZE):
+        chunk = ids[start : start + settings.UPSERT_CHUNK_SIZE]
+        with metrics.span("process.prefetch"):
+            msgs = await client.get_messages(chunk)
+        rows = []
+        for msg in msgs:
+            text = gmail_client.extract_plain_text(msg.get("payload", {}))
+            _, body, body_z = prepare_body(text)
+            rows.append({"id": msg["id"], "body": body, "body_z": body_z})
+        session.execute(update(Email), rows)
         session.commit()
+
+
+async def process_rules_async(
+    rulesets: List[RuleSet],
+    stop_after_first_match: bool | None = None,
+    engine: str = "compiled",
+    pushdown: bool = True,
+    use_cache: bool = False,
+    now: Optional[datetime] = None,
+) -> int:
+    """`process_rules` applying actions through `AsyncGmailClient`.
+
+    Labels are listed (and missing move targets created) and bodies a
+    `Message` rule may read are downloaded concurrently before matching,
+    then all batchModify calls are sent concurrently.
+    """
+    if engine not in MATCH_ENGINES:
+        raise ValueError(f"Unknown match engine: {engine}")
+    stop_flag = _stop_flag(stop_after_first_match)
+    session = db.get_session()
+    try:
+        matcher = _new_matcher(engine, rulesets, now, _engine_stats(session, engine))
+        async with AsyncGmailClient() as client:
+            labels_map = await client.labels_map()
+            for rs in rulesets:
+                for act in rs.actions:
+                    if act.get("type") == "move_message":
+                        label = act.get("label") or settings.DEFAULT_MOVE_LABEL
+                        await client.ensure_label(label, labels_map)
+            actions = ActionBatch(labels_map=labels_map)
+            cache = EvaluationCache(rulesets, matcher.now) if use_cache else None
+            if unreadable_bodies(session, rulesets)[0]:
+                await _prefetch_bodies(
+                    session,
+                    client,
+                    _emails_to_match(
+                        session, rulesets, matcher, stop_flag, pushdown, cache
+                    ),
+                )
+            with lazy_bodies(_BodyLoader()):
+                matched = _match_all(
+                    session, rulesets, matcher, stop_flag, pushdown, actions, cache
+                )
+            with metrics.span("actions.apply"):
+                await actions.flush_async(session, client)
+                if cache is not None:
+                    cache.write(session)
+                session.commit()
         return matched
     finally:
         session.close()
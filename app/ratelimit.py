@@ -0,0 +1,148 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+from datetime import datetime, timezone
+import random
+import threading
+import time
+
+from .config import settings
+
+# Gmail per-user quota units charged for each API method
+QUOTA_UNITS = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "labels.list": 1,
+    "labels.create": 5,
+    "history.list": 2,
+    "users.getProfile": 1,
+    "users.watch": 100,
+}
+DEFAULT_UNITS = 5
+# Gmail's default per-user limit
+USER_UNITS_PER_SECOND = 250
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class QuotaStats:
+    calls: Dict[str, int] = field(default_factory=dict)
+    units: int = 0
+    retries: int = 0
+    throttled: int = 0  # rate-limit responses (429 / 403 *RateLimitExceeded)
+    paced_seconds: float = 0.0  # waited for quota before sending
+    backoff_seconds: float = 0.0  # waited before retrying
+
+
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header (delta seconds or an HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class QuotaScheduler:
+    """Paces Gmail calls by quota units and decides how to retry failures.
+
+    Calls reserve their unit cost against a budget refilled at the current
+    rate (bursting up to one second's worth); a reservation that overdraws
+    the budget is told how long to wait, so concurrent callers queue fairly.
+    The rate adapts AIMD-style: it is halved on every rate-limit response
+    and grows back by `increase` units/s per successful call, up to
+    `units_per_second`. Thread-safe; waiting is left to the caller so sync
+    and asyncio clients can share one scheduler.
+    """
+
+    def __init__(
+        self,
+        units_per_second: float = USER_UNITS_PER_SECOND,
+        min_rate: Optional[float] = None,
+        increase: Optional[float] = None,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 32.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_rate = units_per_second
+        self.rate = units_per_second
+        self.min_rate = min_rate or units_per_second / 50
+        self.increase = increase or units_per_second / 100
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.stats = QuotaStats()
+        self._clock = clock
+        self._budget = float(units_per_second)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, method: str, count: int = 1) -> float:
+        """Charge `count` calls of `method`; returns seconds to wait first."""
+        cost = QUOTA_UNITS.get(method, DEFAULT_UNITS) * count
+        with self._lock:
+            now = self._clock()
+            self._budget = min(
+                self.rate, self._budget + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._budget -= cost
+            wait = max(0.0, -self._budget / self.rate)
+            self.stats.calls[method] = self.stats.calls.get(method, 0) + count
+            self.stats.units += cost
+            self.stats.paced_seconds += wait
+        return wait
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def retry_delay(
+        self,
+        attempt: int,
+        status: int,
+        retry_after: Optional[float] = None,
+        rate_limited: bool = False,
+    ) -> Optional[float]:
+        """Seconds to wait before retry number `attempt + 1`, or None.
+
+        None means the failure is not retryable. Honors `retry_after` when
+        it asks for longer than the jittered exponential backoff.
+        """
+        rate_limited = rate_limited or status == 429
+        if not rate_limited and status not in RETRYABLE_STATUSES:
+            return None
+        # Full-jitter exponential backoff
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2**attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        with self._lock:
+            if rate_limited:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.stats.throttled += 1
+                # Drop any saved-up burst so the lower rate applies at once
+                self._budget = min(self._budget, 0.0)
+            self.stats.retries += 1
+            self.stats.backoff_seconds += delay
+        return delay
+
+
+_scheduler: Optional[QuotaScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> QuotaScheduler:
+    """The process-wide scheduler shared by every Gmail client."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = QuotaScheduler(settings.GMAIL_QUOTA_UNITS_PER_SECOND)
+        return _scheduler
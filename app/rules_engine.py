@@ -1,12 +1,15 @@
 from __future__ import annotations
-from dataclasses import dataclass
-from typing import List, Dict, Any
-from datetime import datetime
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional
+from datetime import datetime, timedelta, timezone
 from dateutil.relativedelta import relativedelta
 import json
-from .models import Email
-from .config import settings
-from .gmail_client import ensure_label, modify_message, get_labels_map
+from . import metrics
+
+if TYPE_CHECKING:
+    # Only for annotations: matching needs no database (see `rules test`)
+    from .models import Email
 
 STRING_PREDICATES = {"Contains", "DoesNotContain", "Equals", "DoesNotEqual"}
 DATE_PREDICATES = {
@@ -15,6 +18,14 @@ DATE_PREDICATES = {
     "LessThanMonths",
     "GreaterThanMonths",
 }
+FIELDS = {"from", "to", "subject", "message", "received"}
+RULESET_PREDICATES = {"All", "Any"}
+ACTION_TYPES = {"mark_as_read", "mark_as_unread", "move_message"}
+
+Matcher = Callable[["Email"], bool]
+
+# Set by `lazy_bodies`: returns the body of an email stored without one
+_body_loader: Optional[Callable[["Email"], str]] = None
 
 
 @dataclass
@@ -29,124 +40,320 @@ class RuleSet:
     predicate: str  # "All" or "Any"
     rules: List[RuleCondition]
     actions: List[Dict[str, Any]]
+    # Compiled form of `rules`, built on first use (see compile_ruleset);
+    # email_matches only reuses it when no condition depends on the time
+    _matcher: Optional[Matcher] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def __getstate__(self):
+        # Closures don't pickle; worker processes recompile on first use
+        state = self.__dict__.copy()
+        state["_matcher"] = None
+        return state
+
+
+def parse_utc(value: str) -> datetime:
+    """An ISO 8601 time as naive UTC, the form `received_at` is stored in."""
+    # fromisoformat() only accepts a "Z" suffix from Python 3.11
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+@dataclass
+class EmailRecord:
+    """The fields rules read, for matching without `models.Email` (or a database)."""
+
+    from_email: str = ""
+    to_email: str = ""
+    subject: str = ""
+    snippet: str = ""
+    body: Optional[str] = None
+    received_at: Optional[datetime] = None
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any], now: datetime) -> "EmailRecord":
+        """Build from rule field names: `from`, `to`, `subject`, `message`,
+        `snippet` and `received` (naive UTC ISO 8601; default: `now`).
+        """
+        unknown = set(data) - FIELDS - {"snippet"}
+        if unknown:
+            raise ValueError(f"Unknown email field(s): {', '.join(sorted(unknown))}")
+        received = data.get("received")
+        return cls(
+            from_email=data.get("from", ""),
+            to_email=data.get("to", ""),
+            subject=data.get("subject", ""),
+            snippet=data.get("snippet", ""),
+            body=data.get("message"),
+            received_at=parse_utc(received) if received else now,
+        )
 
 
 def load_rules(path: str) -> List[RuleSet]:
-    """Load one or more RuleSets from JSON."""
+    """Load one or more RuleSets from JSON.
 
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    Every ruleset is compiled here, so unknown fields or predicates fail at
+    load time rather than halfway through a run.
+    """
 
-    # If top-level is a dict → wrap into list for backward compatibility
-    if isinstance(data, dict):
-        data = [data]
+    with metrics.span("rules.load"):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
 
-    rulesets = []
-    for rs in data:
-        rules = [RuleCondition(**r) for r in rs.get("rules", [])]
-        rulesets.append(
-            RuleSet(
+        # If top-level is a dict → wrap into list for backward compatibility
+        if isinstance(data, dict):
+            data = [data]
+
+        rulesets = []
+        for i, rs in enumerate(data):
+            rules = [RuleCondition(**r) for r in rs.get("rules", [])]
+            ruleset = RuleSet(
                 predicate=rs.get("predicate", "All"),
                 rules=rules,
                 actions=rs.get("actions", []),
             )
-        )
-    return rulesets
+            try:
+                ruleset._matcher = compile_ruleset(ruleset)
+            except ValueError as exc:
+                raise ValueError(f"Ruleset #{i + 1} in {path}: {exc}") from exc
+            rulesets.append(ruleset)
+        return rulesets
+
 
+@contextmanager
+def lazy_bodies(loader: Callable[[Email], str]):
+    """Within the block, `Message` conditions call `loader(email)` for emails
+    whose body was not fetched (NULL) instead of falling back to the snippet.
+    """
+    global _body_loader
+    previous, _body_loader = _body_loader, loader
+    try:
+        yield
+    finally:
+        _body_loader = previous
 
-def _field_value(email: Email, field: str) -> Any:
+
+def loads_bodies() -> bool:
+    """Whether `Message` conditions currently download missing bodies."""
+    return _body_loader is not None
+
+
+def _message_text(e: Email) -> str:
+    body = e.body
+    if body is None and _body_loader is not None:
+        body = _body_loader(e)
+    return (body or e.snippet or "").lower()
+
+
+def text_getter(field: str) -> Callable[[Email], str]:
+    """Return a function producing the lowercased text of `field`."""
     f = field.lower()
     if f == "from":
-        return email.from_email or ""
+        return lambda e: (e.from_email or "").lower()
     if f == "to":
-        return email.to_email or ""
+        return lambda e: (e.to_email or "").lower()
     if f == "subject":
-        return email.subject or ""
+        return lambda e: (e.subject or "").lower()
     if f == "message":
-        return email.body or email.snippet or ""
+        return _message_text
     if f == "received":
-        return email.received_at
+        return lambda e: str(e.received_at).lower()
     raise ValueError(f"Unsupported field: {field}")
 
 
-def _match_string(val: str, predicate: str, target: str) -> bool:
-    v = (val or "").lower()
-    t = (target or "").lower()
-    if predicate == "Contains":
-        return t in v
-    if predicate == "DoesNotContain":
-        return t not in v
-    if predicate == "Equals":
-        return v == t
-    if predicate == "DoesNotEqual":
-        return v != t
-    raise ValueError(f"Unknown string predicate {predicate}")
+def _compile_string(cond: RuleCondition) -> Matcher:
+    get = text_getter(cond.field)
+    t = str(cond.value).lower()
+    if cond.predicate == "Contains":
+        return lambda e: t in get(e)
+    if cond.predicate == "DoesNotContain":
+        return lambda e: t not in get(e)
+    if cond.predicate == "Equals":
+        return lambda e: get(e) == t
+    if cond.predicate == "DoesNotEqual":
+        return lambda e: get(e) != t
+    raise ValueError(f"Unknown string predicate {cond.predicate}")
 
 
-def _match_date(dt: datetime, predicate: str, amount: int) -> bool:
-    now = datetime.utcnow()
+def date_cutoff(predicate: str, amount: int, now: datetime) -> datetime:
+    """The `received_at` instant at which a date predicate flips."""
     if predicate == "LessThanDays":
-        return (now - dt).days < int(amount)
+        return now - timedelta(days=amount)
+    if predicate == "GreaterThanDays":
+        # (now - dt).days > n  <=>  now - dt >= n + 1 days
+        return now - timedelta(days=amount + 1)
+    return now - relativedelta(months=amount)
+
+
+def date_holds(predicate: str, received_at: datetime, cutoff: datetime) -> bool:
+    """Whether a date predicate holds, given its `date_cutoff`."""
     if predicate == "GreaterThanDays":
-        return (now - dt).days > int(amount)
-    if predicate == "LessThanMonths":
-        # rough months via relativedelta
-        return (now - relativedelta(months=int(amount))) < dt
+        return received_at <= cutoff
     if predicate == "GreaterThanMonths":
-        return (now - relativedelta(months=int(amount))) > dt
-    raise ValueError(f"Unknown date predicate {predicate}")
-
-
-def email_matches(email: Email, rs: RuleSet) -> bool:
-    results = []
-    for cond in rs.rules:
-        val = _field_value(email, cond.field)
-        if cond.predicate in STRING_PREDICATES:
-            results.append(_match_string(str(val), cond.predicate, str(cond.value)))
-        elif cond.predicate in DATE_PREDICATES:
-            if not isinstance(val, datetime):
-                results.append(False)
-            else:
-                results.append(_match_date(val, cond.predicate, int(cond.value)))
-        else:
-            results.append(False)
-    return all(results) if rs.predicate == "All" else any(results)
-
-
-def apply_actions(email: Email, actions: List[Dict[str, Any]]) -> Dict[str, Any]:
-    labels_map = get_labels_map()
-    add_ids, remove_ids = [], []
-    state_updates = {}
-
-    for act in actions:
-        t = act.get("type")
-        if t == "mark_as_read":
-            # remove UNREAD
-            if "UNREAD" in labels_map:
-                remove_ids.append(labels_map["UNREAD"])
-            state_updates["is_read"] = True
-        elif t == "mark_as_unread":
-            if "UNREAD" in labels_map:
-                add_ids.append(labels_map["UNREAD"])
-            state_updates["is_read"] = False
-        elif t == "move_message":
-            target_label = act.get("label") or settings.DEFAULT_MOVE_LABEL
-            label_id = ensure_label(target_label)
-            add_ids.append(label_id)
-            # emulate move: remove INBOX if present
-            if "INBOX" in labels_map:
-                remove_ids.append(labels_map["INBOX"])
-        else:
-            raise ValueError(f"Unknown action type: {t}")
-
-    if add_ids or remove_ids:
-        modify_message(
-            email.id, add_labels=list(set(add_ids)), remove_labels=list(set(remove_ids))
-        )
-        # update labels list in our local model (id-only to keep it simple)
-        current_ids = set((email.labels or {}).get("ids", []))
-        current_ids.update(add_ids)
-        current_ids.difference_update(remove_ids)
-        state_updates["labels"] = {"ids": list(current_ids)}
+        return received_at < cutoff
+    return received_at > cutoff
+
+
+def _compile_date(cond: RuleCondition, now: datetime) -> Matcher:
+    if cond.field.lower() != "received":
+        raise ValueError(f"{cond.predicate} only applies to the Received field")
+    try:
+        amount = int(cond.value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{cond.predicate} needs a whole number, got {cond.value!r}")
+
+    # one cutoff per run turns the condition into a plain comparison
+    cutoff = date_cutoff(cond.predicate, amount, now)
+    if cond.predicate == "GreaterThanDays":
+
+        def match(e: Email) -> bool:
+            dt = e.received_at
+            return isinstance(dt, datetime) and dt <= cutoff
+
+    elif cond.predicate == "GreaterThanMonths":
+
+        def match(e: Email) -> bool:
+            dt = e.received_at
+            return isinstance(dt, datetime) and dt < cutoff
+
+    else:
+
+        def match(e: Email) -> bool:
+            dt = e.received_at
+            return isinstance(dt, datetime) and dt > cutoff
+
+    return match
+
+
+def date_flip_time(
+    cond: RuleCondition, received_at: datetime, now: datetime
+) -> Optional[datetime]:
+    """When date condition `cond` may next change its result for an email
+    received at `received_at`; None once the result is final.
+
+    `LessThan*` conditions end up False and `GreaterThan*` ones True, and
+    never change back. Month arithmetic clamps (Jan 31 + 1 month is Feb 28),
+    so the month estimate can be early but never late; an estimate already
+    past returns `now`, i.e. "recheck every time" until the result settles.
+    """
+    amount = int(cond.value)
+    less = cond.predicate.startswith("LessThan")
+    current = date_holds(
+        cond.predicate, received_at, date_cutoff(cond.predicate, amount, now)
+    )
+    if cond.predicate.endswith("Days"):
+        flip = received_at + timedelta(days=amount if less else amount + 1)
+    else:
+        flip = received_at + relativedelta(months=amount)
+    if current != less:
+        return None
+    return max(flip, now)
+
+
+def ruleset_valid_until(rs: RuleSet, email: Email, now: datetime) -> Optional[datetime]:
+    """Earliest time any date condition of `rs` may flip for `email`.
+
+    Conservative: a flip is reported even if it cannot change the ruleset's
+    overall result.
+    """
+    dt = email.received_at
+    if not isinstance(dt, datetime):
+        return None
+    flips = [
+        date_flip_time(cond, dt, now)
+        for cond in rs.rules
+        if cond.predicate in DATE_PREDICATES
+    ]
+    return min((t for t in flips if t is not None), default=None)
+
+
+def compile_condition(cond: RuleCondition, now: Optional[datetime] = None) -> Matcher:
+    """Compile one condition; date conditions are fixed against `now`."""
+    if cond.field.lower() not in FIELDS:
+        raise ValueError(f"Unsupported field: {cond.field}")
+    if cond.predicate in STRING_PREDICATES:
+        return _compile_string(cond)
+    if cond.predicate in DATE_PREDICATES:
+        return _compile_date(cond, now or datetime.utcnow())
+    raise ValueError(f"Unknown predicate: {cond.predicate}")
+
+
+def counted(check: Callable[..., bool]) -> Callable[..., bool]:
+    """Wrap a condition check to count its evaluations."""
+
+    def run(*args) -> bool:
+        metrics.incr("rule_conditions_evaluated")
+        return check(*args)
+
+    return run
+
+
+def compile_ruleset(rs: RuleSet, now: Optional[datetime] = None) -> Matcher:
+    """Resolve a RuleSet into a single short-circuiting predicate.
+
+    Date conditions become comparisons with cutoffs computed from `now`
+    (default: the current time) and are checked first, being the cheapest.
+    While metrics are enabled, evaluations are counted (rulesets compiled
+    before enabling them are not).
+    """
+    if rs.predicate not in RULESET_PREDICATES:
+        raise ValueError(f"Unknown ruleset predicate: {rs.predicate}")
+    now = now or datetime.utcnow()
+    conds = sorted(rs.rules, key=lambda c: c.predicate not in DATE_PREDICATES)
+    checks = [compile_condition(cond, now) for cond in conds]
+    if metrics.enabled:
+        checks = [counted(check) for check in checks]
+    if len(checks) == 1:
+        return checks[0]
+    if rs.predicate == "All":
+        return lambda e: all(check(e) for check in checks)
+    return lambda e: any(check(e) for check in checks)
+
+
+def email_matches(email: Email, rs: RuleSet, now: Optional[datetime] = None) -> bool:
+    """Check one ruleset, with date conditions against `now`.
+
+    `now` defaults to the current time at each call, so a ruleset held by a
+    long-running caller never sees stale cutoffs; only rulesets without date
+    conditions reuse their compiled predicate. To check many emails against
+    one snapshot, use `CompiledMatcher`.
+    """
+    if now is not None or any(c.predicate in DATE_PREDICATES for c in rs.rules):
+        return compile_ruleset(rs, now)(email)
+    if rs._matcher is None:
+        rs._matcher = compile_ruleset(rs)
+    return rs._matcher(email)
+
+
+class CompiledMatcher:
+    """Evaluate rulesets one by one with their compiled predicates.
+
+    All date conditions are compiled against one `now` (default: the
+    current time), so a run sees a single consistent snapshot.
+    """
+
+    def __init__(self, rulesets: List[RuleSet], now: Optional[datetime] = None):
+        self.rulesets = rulesets
+        self.now = now or datetime.utcnow()
+        self._checks = [compile_ruleset(rs, self.now) for rs in rulesets]
+
+    def iter_matches(self, email: Email) -> Iterator[int]:
+        """Yield the index of every matching ruleset, in file order."""
+        for i, check in enumerate(self._checks):
+            if check(email):
+                yield i
+
+
+def __getattr__(name):
+    # apply_actions moved to app.actions; imported on use so matching rules
+    # does not load the Gmail client
+    if name == "apply_actions":
+        from .actions import apply_actions
 
-    return state_updates
+        return apply_actions
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
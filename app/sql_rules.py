@@ -0,0 +1,278 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List, Optional, Tuple
+import re
+
+from sqlalchemy import ColumnElement, and_, exists, false, func, or_, select
+from sqlalchemy.orm import undefer
+
+from .models import Email
+from .rules_engine import (
+    DATE_PREDICATES,
+    STRING_PREDICATES,
+    RuleCondition,
+    RuleSet,
+    date_cutoff,
+)
+
+_INDEX_NODE = re.compile(r"Index(?: Only)? Scan (?:using|on) (\w+)")
+# SQLite's EXPLAIN QUERY PLAN: "SEARCH emails USING INDEX ix (...)"
+_SQLITE_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+# Columns each rule field reads; `id`, `labels` and `is_read` are always
+# needed to apply actions
+FIELD_COLUMNS = {
+    "from": [Email.from_email],
+    "to": [Email.to_email],
+    "subject": [Email.subject],
+    "message": [Email.body, Email.body_z, Email.snippet],
+    "received": [Email.received_at],
+}
+ACTION_COLUMNS = [Email.id, Email.labels, Email.is_read]
+
+
+def field_expr(field: str) -> Optional[ColumnElement]:
+    """SQL expression for the text a string predicate sees, or None.
+
+    Mirrors `rules_engine.text_getter`: NULLs read as "" and `Message` falls
+    back to the snippet when the body is empty. Compressed bodies (`body_z`,
+    with `body` NULL) are only readable in Python, like unfetched ones.
+    `Received` is matched against Python's `str(datetime)` and has no
+    portable SQL equivalent.
+    """
+    f = field.lower()
+    if f == "from":
+        return func.coalesce(Email.from_email, "")
+    if f == "to":
+        return func.coalesce(Email.to_email, "")
+    if f == "subject":
+        return func.coalesce(Email.subject, "")
+    if f == "message":
+        return func.coalesce(func.nullif(Email.body, ""), Email.snippet, "")
+    return None
+
+
+def rule_columns(rulesets: List[RuleSet]) -> list:
+    """The `Email` columns needed to evaluate `rulesets` and apply actions."""
+    columns = list(ACTION_COLUMNS)
+    for rs in rulesets:
+        for cond in rs.rules:
+            for col in FIELD_COLUMNS.get(cond.field.lower(), []):
+                if col not in columns:
+                    columns.append(col)
+    return columns
+
+
+def _like_pattern(target: str) -> str:
+    escaped = target.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _string_clause(expr: ColumnElement, predicate: str, t: str) -> ColumnElement:
+    if predicate == "Contains":
+        return expr.ilike(_like_pattern(t), escape="\\")
+    if predicate == "DoesNotContain":
+        return ~expr.ilike(_like_pattern(t), escape="\\")
+    if predicate == "Equals":
+        return func.lower(expr) == t
+    return func.lower(expr) != t
+
+
+def condition_clause(
+    cond: RuleCondition,
+    now: datetime,
+    unfetched_bodies: bool = False,
+    compressed_bodies: bool = False,
+    unicode_case: bool = True,
+) -> Optional[ColumnElement]:
+    """Translate one condition to SQL, or None when it must run in Python.
+
+    With `unfetched_bodies`, a `Message` condition also keeps rows whose
+    body was never fetched (`body` and `body_z` NULL); with
+    `compressed_bodies`, rows whose body is compressed. Only Python can
+    load and check either. Without `unicode_case` (see
+    `folds_unicode_case`), string conditions on non-ASCII targets stay in
+    Python.
+    """
+    if cond.predicate in STRING_PREDICATES:
+        expr = field_expr(cond.field)
+        if expr is None or not (unicode_case or str(cond.value).isascii()):
+            return None
+        clause = _string_clause(expr, cond.predicate, str(cond.value).lower())
+        if cond.field.lower() != "message":
+            return clause
+        kept = []
+        if unfetched_bodies:
+            kept.append(and_(Email.body.is_(None), Email.body_z.is_(None)))
+        if compressed_bodies:
+            kept.append(Email.body_z.isnot(None))
+        return or_(*kept, clause) if kept else clause
+    if cond.predicate in DATE_PREDICATES and cond.field.lower() == "received":
+        # same cutoffs and comparisons as rules_engine.date_holds
+        cutoff = date_cutoff(cond.predicate, int(cond.value), now)
+        if cond.predicate == "GreaterThanDays":
+            return Email.received_at <= cutoff
+        if cond.predicate == "GreaterThanMonths":
+            return Email.received_at < cutoff
+        return Email.received_at > cutoff
+    return None
+
+
+def ruleset_clause(
+    rs: RuleSet,
+    now: datetime,
+    unfetched_bodies: bool = False,
+    compressed_bodies: bool = False,
+    unicode_case: bool = True,
+) -> Optional[ColumnElement]:
+    """A filter selecting a superset of the emails `rs` can match.
+
+    `All` keeps every condition that translates (the rest is re-checked in
+    Python); `Any` is only pushed down when all of its conditions translate.
+    Returns None when no useful filter exists.
+    """
+    clauses = [
+        condition_clause(cond, now, unfetched_bodies, compressed_bodies, unicode_case)
+        for cond in rs.rules
+    ]
+    if rs.predicate == "All":
+        pushed = [c for c in clauses if c is not None]
+        return and_(*pushed) if pushed else None
+    if not clauses:
+        return false()
+    if any(c is None for c in clauses):
+        return None
+    return or_(*clauses)
+
+
+def _reads_message(rulesets: List[RuleSet]) -> bool:
+    return any(cond.field.lower() == "message" for rs in rulesets for cond in rs.rules)
+
+
+def emails_query(rulesets: List[RuleSet]):
+    """`select(Email)`, also loading compressed bodies if a rule reads them."""
+    query = select(Email)
+    if _reads_message(rulesets):
+        query = query.options(undefer(Email.body_z))
+    return query
+
+
+def unreadable_bodies(session, rulesets: List[RuleSet]) -> Tuple[bool, bool]:
+    """Whether any stored row has an unfetched or a compressed body.
+
+    `Message` clauses only need to keep such rows when some exist, and a
+    clause without them can use the body's search index. Each check stops
+    at the first such row; without a `Message` rule nothing is queried.
+    """
+    if not _reads_message(rulesets):
+        return False, False
+    unfetched = exists().where(Email.body.is_(None), Email.body_z.is_(None))
+    compressed = exists().where(Email.body_z.isnot(None))
+    row = session.execute(select(unfetched, compressed)).one()
+    return bool(row[0]), bool(row[1])
+
+
+def folds_unicode_case(session, rulesets: List[RuleSet]) -> bool:
+    """Whether the database lowercases non-ASCII text as Python does.
+
+    PostgreSQL's `lower()` and `ILIKE` follow the database's `LC_CTYPE`:
+    under the `C` locale `Ä` is not folded to `ä`, and pushed-down
+    conditions would drop rows the Python matchers accept. Only asked when
+    a string condition has a non-ASCII target.
+    """
+    if all(
+        str(cond.value).isascii()
+        for rs in rulesets
+        for cond in rs.rules
+        if cond.predicate in STRING_PREDICATES
+    ):
+        return True
+    return bool(session.scalar(select(func.lower("ÄÉÖ") == "äéö")))
+
+
+def pushdown_flags(session, rulesets: List[RuleSet]) -> Tuple[bool, bool, bool]:
+    """`candidates_query`'s flags for this database, probed once per run."""
+    return (
+        *unreadable_bodies(session, rulesets),
+        folds_unicode_case(session, rulesets),
+    )
+
+
+def candidates_query(
+    rulesets: List[RuleSet],
+    now: Optional[datetime] = None,
+    unfetched_bodies: bool = True,
+    compressed_bodies: bool = True,
+    unicode_case: bool = False,
+):
+    """`select(Email)` restricted to rows at least one ruleset could match.
+
+    Falls back to a full scan as soon as one ruleset cannot be filtered.
+    Rows whose body only Python can read stay candidates for `Message`
+    conditions, and non-ASCII targets are matched in Python; pass
+    `pushdown_flags` to push down what this database can answer.
+    """
+    now = now or datetime.utcnow()
+    clauses = []
+    for rs in rulesets:
+        clause = ruleset_clause(
+            rs, now, unfetched_bodies, compressed_bodies, unicode_case
+        )
+        if clause is None:
+            return emails_query(rulesets)
+        clauses.append(clause)
+    return emails_query(rulesets).where(or_(*clauses) if clauses else false())
+
+
+@dataclass
+class RulePlan:
+    ruleset: RuleSet
+    pushed: int  # conditions translated to SQL
+    access: str  # "index", "seq scan" or "python" (nothing to push down)
+    indexes: List[str] = field(default_factory=list)
+    plan: List[str] = field(default_factory=list)
+
+
+def explain_rulesets(
+    session, rulesets: List[RuleSet], now: Optional[datetime] = None
+) -> List[RulePlan]:
+    """Run EXPLAIN on each ruleset's pushed-down filter.
+
+    Reports whether the database answers it from an index or falls back to
+    a sequential scan of `emails` (on SQLite, `EXPLAIN QUERY PLAN`, where a
+    `SCAN` reads every row of the table or of an index).
+    """
+    now = now or datetime.utcnow()
+    flags = pushdown_flags(session, rulesets)
+    conn = session.connection()
+    sqlite = conn.dialect.name == "sqlite"
+    plans = []
+    for rs in rulesets:
+        pushed = sum(
+            condition_clause(c, now, unicode_case=flags[2]) is not None
+            for c in rs.rules
+        )
+        clause = ruleset_clause(rs, now, *flags)
+        if clause is None:
+            plans.append(RulePlan(rs, pushed, "python"))
+            continue
+        compiled = select(Email.id).where(clause).compile(dialect=conn.dialect)
+        explain = "EXPLAIN QUERY PLAN" if sqlite else "EXPLAIN"
+        params = compiled.params
+        if compiled.positional:
+            params = tuple(params[name] for name in compiled.positiontup)
+        rows = conn.exec_driver_sql(f"{explain} {compiled}", params)
+        # SQLite rows are (id, parent, notused, detail)
+        lines = [row[-1] if sqlite else row[0] for row in rows]
+        if sqlite:
+            indexes = [
+                m.group(1) for line in lines for m in _SQLITE_INDEX.finditer(line)
+            ]
+            seq_scan = any(line.startswith("SCAN ") for line in lines)
+        else:
+            indexes = [m.group(1) for line in lines for m in _INDEX_NODE.finditer(line)]
+            seq_scan = any("Seq Scan" in line for line in lines)
+        access = "index" if indexes and not seq_scan else "seq scan"
+        plans.append(RulePlan(rs, pushed, access, indexes, lines))
+    return plans
@@ -0,0 +1,231 @@
+from __future__ import annotations
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlparse
+import base64
+import binascii
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+from .config import settings
+from .fetch_emails import FetchStats, choose_format, sync_incremental
+from .gmail_client import watch_mailbox
+from .process_rules import process_rules
+from .rules_engine import RuleSet, load_rules
+
+log = logging.getLogger(__name__)
+
+PUSH_PATH = "/gmail/push"
+# Gmail watches expire after 7 days; renew well before
+RENEW_BEFORE_SECONDS = 24 * 3600
+
+
+def push_envelope(email_address: str, history_id: str, message_id: str = "1") -> Dict:
+    """A Pub/Sub push request body carrying a Gmail change notification."""
+    data = json.dumps({"emailAddress": email_address, "historyId": history_id})
+    return {
+        "message": {
+            "data": base64.b64encode(data.encode()).decode(),
+            "messageId": message_id,
+        },
+        "subscription": "projects/local/subscriptions/mail-helper",
+    }
+
+
+def parse_push(body: bytes) -> Dict:
+    """The Gmail notification (`emailAddress`, `historyId`) in a push body.
+
+    Raises ValueError for anything that is not a Pub/Sub push envelope.
+    """
+    try:
+        envelope = json.loads(body)
+        data = base64.b64decode(envelope["message"]["data"])
+        note = json.loads(data)
+    except (KeyError, TypeError, binascii.Error, UnicodeDecodeError) as exc:
+        raise ValueError(f"not a Pub/Sub push message: {exc}") from exc
+    if not isinstance(note, dict) or "historyId" not in note:
+        raise ValueError("notification has no historyId")
+    return note
+
+
+class Watcher:
+    """Incremental sync plus rule processing, woken by push notifications.
+
+    One thread runs `run()`: it syncs at start, then after every
+    `notify()`, and at least every `poll_interval` seconds. Notifications
+    arriving during a sync are coalesced into the next one, since every
+    sync catches up to Gmail's current historyId. Only messages added since
+    the last checkpoint are processed (everything after a full resync).
+    Rules are reloaded when the rules file changes; the Gmail client and
+    database pool stay open between syncs.
+    """
+
+    def __init__(
+        self,
+        rules_path: str,
+        label_ids: Optional[Sequence[str]] = ("INBOX",),
+        fmt: str = "auto",
+        engine: str = "compiled",
+        stop_after_first_match: bool | None = None,
+        use_cache: bool = False,
+        topic: Optional[str] = None,
+        poll_interval: Optional[float] = None,
+    ):
+        self.rules_path = rules_path
+        self.label_ids = label_ids
+        self.fmt = fmt
+        self.engine = engine
+        self.stop_after_first_match = stop_after_first_match
+        self.use_cache = use_cache
+        self.topic = topic if topic is not None else settings.GMAIL_PUBSUB_TOPIC
+        self.poll_interval = poll_interval or settings.WATCH_POLL_SECONDS
+        self.rulesets: List[RuleSet] = []
+        self.runs = 0
+        self.notifications = 0
+        self.watch_expires: Optional[float] = None
+        self._rules_mtime: Optional[float] = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        # Guards the counters and the wake flag: notify() and status() run
+        # on the push server's handler threads
+        self._lock = threading.Lock()
+
+    def notify(self) -> None:
+        with self._lock:
+            self.notifications += 1
+            self._wake.set()
+
+    def status(self) -> Dict[str, int]:
+        """Sync and notification counts, safe to read from any thread."""
+        with self._lock:
+            return {"runs": self.runs, "notifications": self.notifications}
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def _load_rules(self) -> None:
+        mtime = os.stat(self.rules_path).st_mtime
+        if mtime != self._rules_mtime:
+            self.rulesets = load_rules(self.rules_path)
+            self._rules_mtime = mtime
+            log.info("Loaded %d rulesets from %s", len(self.rulesets), self.rules_path)
+
+    def renew_watch(self) -> None:
+        """Call users.watch on start and whenever the watch nears expiry."""
+        if not self.topic:
+            return
+        if self.watch_expires is not None:
+            if self.watch_expires - time.time() > RENEW_BEFORE_SECONDS:
+                return
+        res = watch_mailbox(self.topic, self.label_ids)
+        self.watch_expires = int(res["expiration"]) / 1000
+        log.info("Watching mailbox via %s", self.topic)
+
+    def sync_once(self) -> Tuple[FetchStats, int]:
+        self._load_rules()
+        fmt = choose_format(self.rulesets) if self.fmt == "auto" else self.fmt
+        stats = sync_incremental(label_ids=self.label_ids, fmt=fmt)
+        ids = None if stats.full_resync else stats.new_ids
+        matched = 0
+        if ids is None or ids:
+            matched = process_rules(
+                self.rulesets,
+                stop_after_first_match=self.stop_after_first_match,
+                engine=self.engine,
+                use_cache=self.use_cache,
+                email_ids=ids,
+            )
+        with self._lock:
+            self.runs += 1
+        return stats, matched
+
+    def run(self) -> None:
+        """Sync until `stop()`; failures are logged and retried on the next wake."""
+        while not self._stop.is_set():
+            try:
+                self.renew_watch()
+                stats, matched = self.sync_once()
+                log.info(
+                    "Synced %d fetched, %d relabelled, %d deleted; %d rule matches",
+                    stats.fetched,
+                    stats.relabelled,
+                    stats.deleted,
+                    matched,
+                )
+            except Exception:
+                log.exception("Sync failed; retrying on the next notification or poll")
+            self._wake.wait(self.poll_interval)
+            with self._lock:
+                # notifications until here are covered by the coming sync
+                self._wake.clear()
+
+
+def make_server(
+    watcher: Watcher, host: str, port: int, token: Optional[str] = None
+) -> ThreadingHTTPServer:
+    """HTTP endpoint for Pub/Sub push subscriptions (POST `PUSH_PATH`).
+
+    With `token`, requests must carry it as `?token=` in the push URL.
+    Every valid notification is acknowledged (204) right away and wakes
+    the watcher; `GET /healthz` reports sync counts.
+    """
+    token = token if token is not None else settings.WATCH_PUSH_TOKEN
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, payload: Optional[Dict] = None) -> None:
+            data = b"" if payload is None else json.dumps(payload).encode()
+            self.send_response(status)
+            if payload is not None:
+                self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != PUSH_PATH:
+                return self._reply(404)
+            given = parse_qs(url.query).get("token", [""])[0]
+            if token and not hmac.compare_digest(given, token):
+                return self._reply(403)
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                note = parse_push(self.rfile.read(length))
+            except ValueError as exc:
+                log.warning("Rejected push: %s", exc)
+                return self._reply(400)
+            log.debug("Notification for historyId %s", note["historyId"])
+            watcher.notify()
+            self._reply(204)
+
+        def do_GET(self):
+            if urlparse(self.path).path != "/healthz":
+                return self._reply(404)
+            self._reply(200, watcher.status())
+
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve(watcher: Watcher, host: str, port: Optional[int]) -> None:
+    """Run `watcher` in this thread, with the push endpoint unless `port` is None."""
+    server = None
+    if port is not None:
+        server = make_server(watcher, host, port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        log.info("Listening for push notifications on %s:%d%s", host, port, PUSH_PATH)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
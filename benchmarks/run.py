@@ -0,0 +1,329 @@
+"""Time the hot paths on synthetic mailboxes and compare runs across commits.
+
+    python -m benchmarks.run run --emails 1000 --emails 100000 --rules 10 --rules 1000
+    python -m benchmarks.run run --database-url sqlite:///bench.db \
+        --database-url postgresql+psycopg2://.../bench
+    python -m benchmarks.run compare baseline.json current.json
+    python -m benchmarks.run startup --budget-ms 300
+"""
+
+from __future__ import annotations
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Sequence
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import typer
+from sqlalchemy.orm import sessionmaker
+
+from app import db, gmail_client, ratelimit
+from app.fetch_emails import fetch_and_store, parse_message
+from app.gmail_client import extract_plain_text
+from app.models import Email
+from app.columnar import ColumnarMatcher
+from app.multimatch import IndexedMatcher
+from app.planner import ColumnStats, PlannedMatcher
+from app.process_rules import process_rules
+from app.ratelimit import QuotaScheduler
+from app.rules_engine import email_matches, load_rules
+
+from .stub_gmail import StubGmailService
+from .synthetic import make_messages, make_rules
+
+app = typer.Typer(help="Mail Helper benchmarks")
+
+DB_STAGES = ("fetch_and_store", "process_rules")
+
+# Packages the CLI must not import until a command needs them
+HEAVY_MODULES = ("googleapiclient", "google_auth_oauthlib", "sqlalchemy", "httpx")
+
+_IMPORT_PROBE = """
+import json, sys
+import app.cli
+loaded = {name.split(".")[0] for name in sys.modules}
+print(json.dumps(sorted(loaded & set(sys.argv[1:]))))
+"""
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def time_stage(fn: Callable[[], object], items: int, repeats: int, setup=None) -> Dict:
+    """Best and mean wall time of `fn` over `repeats` runs."""
+    runs = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    best = min(runs)
+    return {
+        "best_s": best,
+        "mean_s": sum(runs) / len(runs),
+        "items": items,
+        "per_item_us": best / items * 1e6 if items else None,
+        "items_per_s": items / best if best else None,
+    }
+
+
+def _use_database(url: str):
+    engine = db.create_db_engine(url)
+    db.engine = engine
+    db.SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+    return engine
+
+
+def _reset_tables(engine) -> None:
+    # in dependency order, so rule_evaluations' foreign key never blocks it
+    db.Base.metadata.drop_all(engine)
+    db.Base.metadata.create_all(engine)
+
+
+def run_benchmarks(
+    emails: int,
+    rules: int,
+    repeats: int = 3,
+    seed: int = 0,
+    database_urls: Sequence[str] = (),
+) -> Dict:
+    """Time every stage for one mailbox size and ruleset size.
+
+    Database stages run once per URL, named after its backend, e.g.
+    `fetch_and_store[sqlite]`, so backends can be compared in one run.
+    """
+    messages = make_messages(emails, seed=seed)
+    rule_data = make_rules(rules, seed=seed)
+    stages: Dict[str, Dict] = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rules_path = os.path.join(tmp, "rules.json")
+        with open(rules_path, "w", encoding="utf-8") as f:
+            json.dump(rule_data, f)
+        stages["load_rules"] = time_stage(
+            lambda: load_rules(rules_path), rules, repeats
+        )
+        rulesets = load_rules(rules_path)
+
+    payloads = [m["payload"] for m in messages]
+    stages["extract_plain_text"] = time_stage(
+        lambda: [extract_plain_text(p) for p in payloads], emails, repeats
+    )
+    stages["parse_message"] = time_stage(
+        lambda: [parse_message(m) for m in messages], emails, repeats
+    )
+
+    rows = [Email(**parse_message(m)) for m in messages]
+
+    def match_all():
+        for e in rows:
+            for rs in rulesets:
+                email_matches(e, rs)
+
+    stages["email_matches"] = time_stage(match_all, emails * rules, repeats)
+    indexed = IndexedMatcher(rulesets)
+    stages["match_indexed"] = time_stage(
+        lambda: [list(indexed.iter_matches(e)) for e in rows], emails, repeats
+    )
+    planned = PlannedMatcher(
+        rulesets, stats=ColumnStats.from_sample(len(rows), rows[:2000])
+    )
+    stages["match_planned"] = time_stage(
+        lambda: [list(planned.iter_matches(e)) for e in rows], emails, repeats
+    )
+    columnar = ColumnarMatcher(rulesets)
+    stages["match_columnar"] = time_stage(
+        lambda: columnar.match_batch(rows, stop_flag=False), emails, repeats
+    )
+
+    if not database_urls:
+        for name in DB_STAGES:
+            stages[name] = {"skipped": "no --database-url"}
+    for url in database_urls:
+        engine = _use_database(url)
+        backend = engine.dialect.name
+        service = StubGmailService(messages)
+        # The stub has no quota to protect
+        scheduler = QuotaScheduler(units_per_second=1e12)
+        with (
+            mock.patch.object(gmail_client, "get_service", lambda: service),
+            mock.patch.object(ratelimit, "_scheduler", scheduler),
+        ):
+            stages[f"fetch_and_store[{backend}]"] = time_stage(
+                lambda: fetch_and_store(max_results=None, label_ids=None),
+                emails,
+                repeats,
+                setup=lambda: _reset_tables(engine),
+            )
+            stages[f"process_rules[{backend}]"] = time_stage(
+                lambda: process_rules(rulesets, stop_after_first_match=False),
+                emails,
+                repeats,
+            )
+        engine.dispose()
+
+    return {"emails": emails, "rules": rules, "stages": stages}
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float) -> List[Dict]:
+    """Per-stage ratios of current to baseline best time, for matching runs."""
+    base_runs = {(r["emails"], r["rules"]): r for r in baseline["runs"]}
+    rows = []
+    for run in current["runs"]:
+        base = base_runs.get((run["emails"], run["rules"]))
+        if base is None:
+            continue
+        for name, stage in run["stages"].items():
+            old = base["stages"].get(name, {})
+            if "best_s" not in stage or "best_s" not in old:
+                continue
+            ratio = stage["best_s"] / old["best_s"] if old["best_s"] else 1.0
+            rows.append(
+                {
+                    "emails": run["emails"],
+                    "rules": run["rules"],
+                    "stage": name,
+                    "baseline_s": old["best_s"],
+                    "current_s": stage["best_s"],
+                    "ratio": ratio,
+                    "regressed": ratio > 1 + threshold,
+                }
+            )
+    return rows
+
+
+def measure_startup(repeats: int, rules_path: str = "rules/rules.json") -> Dict:
+    """Wall time of CLI commands in new processes, and heavy imports of `app.cli`."""
+    commands = {
+        "cli --help": ["--help"],
+        "rules validate": ["rules", "validate", rules_path],
+    }
+    stages = {}
+    for name, args in commands.items():
+        command = [sys.executable, "-m", "app.cli", *args]
+        stages[name] = time_stage(
+            lambda: subprocess.run(command, capture_output=True, check=True),
+            items=1,
+            repeats=repeats,
+        )
+    out = subprocess.run(
+        [sys.executable, "-c", _IMPORT_PROBE, *HEAVY_MODULES],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return {"stages": stages, "heavy_imports": json.loads(out.stdout)}
+
+
+@app.command()
+def run(
+    emails: List[int] = typer.Option([1000], help="Mailbox sizes (repeatable)"),
+    rules: List[int] = typer.Option([10], help="Ruleset sizes (repeatable)"),
+    repeats: int = typer.Option(3, min=1, help="Runs per stage; the best is kept"),
+    seed: int = typer.Option(0, help="Seed for the synthetic data"),
+    database_urls: List[str] = typer.Option(
+        [],
+        "--database-url",
+        help="Scratch database for fetch/process stages, repeatable to compare "
+        "backends (its emails table is recreated)",
+    ),
+    output: Optional[str] = typer.Option(None, "-o", "--output", help="JSON file"),
+):
+    """Run the benchmark matrix and write JSON results."""
+    results = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "repeats": repeats,
+            "seed": seed,
+            "databases": [url.split(":", 1)[0] for url in database_urls],
+        },
+        "runs": [],
+    }
+    for n_emails in emails:
+        for n_rules in rules:
+            result = run_benchmarks(n_emails, n_rules, repeats, seed, database_urls)
+            results["runs"].append(result)
+            for name, stage in result["stages"].items():
+                timing = (
+                    f"{stage['best_s'] * 1000:10.1f} ms"
+                    if "best_s" in stage
+                    else f"  skipped ({stage['skipped']})"
+                )
+                typer.echo(
+                    f"{n_emails:>8} emails {n_rules:>5} rules  {name:<28}{timing}"
+                )
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        typer.echo(text)
+
+
+@app.command()
+def compare(
+    baseline: str = typer.Argument(..., help="Earlier results JSON"),
+    current: str = typer.Argument(..., help="Newer results JSON"),
+    threshold: float = typer.Option(
+        0.1, help="Allowed slowdown before a stage counts as a regression"
+    ),
+):
+    """Compare two result files; exits with status 1 on a regression."""
+    with open(baseline, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(current, encoding="utf-8") as f:
+        new = json.load(f)
+    rows = compare_results(old, new, threshold)
+    for row in rows:
+        flag = "  REGRESSION" if row["regressed"] else ""
+        typer.echo(
+            f"{row['emails']:>8} emails {row['rules']:>5} rules  {row['stage']:<28}"
+            f"{row['baseline_s'] * 1000:10.1f} ms -> {row['current_s'] * 1000:10.1f} ms"
+            f"  x{row['ratio']:.2f}{flag}"
+        )
+    if any(row["regressed"] for row in rows):
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def startup(
+    repeats: int = typer.Option(5, min=1, help="Runs per command; the best is kept"),
+    budget_ms: float = typer.Option(
+        300, help="Slowest allowed command, best of the runs"
+    ),
+    rules_path: str = typer.Option("rules/rules.json", help="Rules to validate"),
+):
+    """Time CLI startup; exits with status 1 over budget or on heavy imports."""
+    result = measure_startup(repeats, rules_path)
+    over = False
+    for name, stage in result["stages"].items():
+        ms = stage["best_s"] * 1000
+        flag = "  OVER BUDGET" if ms > budget_ms else ""
+        over = over or bool(flag)
+        typer.echo(f"{name:<20}{ms:10.1f} ms{flag}")
+    if result["heavy_imports"]:
+        typer.echo(f"import app.cli loads: {', '.join(result['heavy_imports'])}")
+    if over or result["heavy_imports"]:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,89 @@
+"""In-memory stand-in for the Gmail API service object (no network)."""
+
+from __future__ import annotations
+from typing import Dict, List
+
+
+class _Request:
+    def __init__(self, respond, kwargs):
+        self._respond = respond
+        self._kwargs = kwargs
+
+    def execute(self):
+        return self._respond(**self._kwargs)
+
+
+class _Batch:
+    def __init__(self, callback):
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self._requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self._requests:
+            self._callback(request_id, request.execute(), None)
+
+
+class StubGmailService:
+    """Serves `messages` through the calls `gmail_client` makes."""
+
+    def __init__(self, messages: List[Dict]):
+        self.messages_by_id = {m["id"]: m for m in messages}
+        self.ids = list(self.messages_by_id)
+        self.label_ids = {"INBOX": "INBOX", "UNREAD": "UNREAD"}
+        self.modified = 0
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def list(self, **kwargs):
+        # labels.list is the only list call without maxResults
+        if "maxResults" not in kwargs:
+            return _Request(self._list_labels, {})
+        return _Request(self._list_messages, kwargs)
+
+    def get(self, **kwargs):
+        return _Request(self._get, kwargs)
+
+    def batchModify(self, **kwargs):
+        return _Request(self._batch_modify, kwargs)
+
+    def create(self, **kwargs):
+        return _Request(self._create_label, kwargs)
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(callback)
+
+    def close(self):
+        pass
+
+    def _list_messages(self, maxResults, pageToken=None, **_):
+        start = int(pageToken or 0)
+        end = start + maxResults
+        page = {"messages": [{"id": mid} for mid in self.ids[start:end]]}
+        if end < len(self.ids):
+            page["nextPageToken"] = str(end)
+        return page
+
+    def _get(self, id, **_):
+        return self.messages_by_id[id]
+
+    def _batch_modify(self, body, **_):
+        self.modified += len(body["ids"])
+        return {}
+
+    def _list_labels(self, **_):
+        labels = [{"name": n, "id": i} for n, i in self.label_ids.items()]
+        return {"labels": labels}
+
+    def _create_label(self, body, **_):
+        self.label_ids[body["name"]] = f"Label_{len(self.label_ids)}"
+        return {"id": self.label_ids[body["name"]]}
@@ -0,0 +1,151 @@
+"""Deterministic synthetic Gmail messages and rulesets for the benchmarks."""
+
+from __future__ import annotations
+from datetime import datetime, timedelta
+from email.utils import format_datetime
+from typing import Dict, List, Optional
+import base64
+import random
+
+WORDS = (
+    "invoice payment receipt order shipped delivery account security alert "
+    "password reset meeting agenda project update report weekly monthly "
+    "newsletter offer discount sale limited today tomorrow urgent action "
+    "required review approve request access team welcome hello thanks "
+    "regards please confirm schedule call notes summary draft final budget "
+    "forecast quarter release deploy build failed passed ticket support "
+    "customer feedback survey event webinar invitation reminder due overdue "
+    "statement balance transfer subscription renewal trial expired upgrade "
+    "plan travel booking flight hotel itinerary confirmation code verify "
+    "login device new sign unusual activity policy terms privacy changes"
+).split()
+NAMES = (
+    "alice bob carol dave erin frank grace heidi ivan judy mallory "
+    "niaj olivia peggy rupert sybil trent victor walter noreply billing "
+    "support alerts news team hr it security"
+).split()
+# Few senders' domains account for most mail
+DOMAINS = [
+    "gmail.com",
+    "example.com",
+    "github.com",
+    "amazon.com",
+    "bank.example",
+    "news.example",
+    "corp.example",
+    "travel.example",
+]
+DOMAIN_WEIGHTS = [30, 20, 12, 10, 8, 8, 8, 4]
+FIELD_WEIGHTS = {"From": 30, "To": 10, "Subject": 35, "Message": 15, "Received": 10}
+MAX_BODY_CHARS = 200_000
+
+
+def _text(rng: random.Random, n_chars: int) -> str:
+    words: List[str] = []
+    size = 0
+    while size < n_chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:n_chars]
+
+
+def _b64(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def _address(rng: random.Random) -> str:
+    domain = rng.choices(DOMAINS, weights=DOMAIN_WEIGHTS)[0]
+    return f"{rng.choice(NAMES)}@{domain}"
+
+
+def make_message(rng: random.Random, index: int, now: datetime) -> Dict:
+    """One Gmail `messages.get` (format=full) resource.
+
+    Subjects run 10-120 characters and bodies follow a log-normal size
+    distribution (median about 1 KB, capped at 200 KB); most messages are
+    multipart/alternative and some carry an attachment.
+    """
+    body = _text(rng, min(int(rng.lognormvariate(7.0, 1.0)), MAX_BODY_CHARS))
+    received = now - timedelta(seconds=rng.randint(0, 730 * 86400))
+    headers = [
+        {"name": "Delivered-To", "value": "me@corp.example"},
+        {"name": "Received", "value": f"from mx{index % 7}.example by mx.google.com"},
+        {"name": "From", "value": _address(rng)},
+        {
+            "name": "To",
+            "value": ", ".join(_address(rng) for _ in range(rng.randint(1, 3))),
+        },
+        {"name": "Subject", "value": _text(rng, int(rng.triangular(10, 120, 40)))},
+        {"name": "Date", "value": format_datetime(received)},
+        {"name": "Message-ID", "value": f"<{index}.{rng.getrandbits(32)}@example.com>"},
+        {"name": "MIME-Version", "value": "1.0"},
+    ]
+    plain = {"mimeType": "text/plain", "body": {"data": _b64(body)}}
+    if rng.random() < 0.7:
+        html = {"mimeType": "text/html", "body": {"data": _b64(f"<p>{body}</p>")}}
+        payload = {"mimeType": "multipart/alternative", "parts": [plain, html]}
+    else:
+        payload = plain
+    if rng.random() < 0.1:
+        attachment = {
+            "mimeType": "application/pdf",
+            "filename": "document.pdf",
+            "body": {"attachmentId": f"att-{index}", "size": 120_000},
+        }
+        payload = {"mimeType": "multipart/mixed", "parts": [payload, attachment]}
+    payload["headers"] = headers
+
+    labels = ["INBOX"] + (["UNREAD"] if rng.random() < 0.4 else [])
+    return {
+        "id": f"{index:012x}",
+        "threadId": f"{index // 3:012x}",
+        "labelIds": labels,
+        "snippet": body[:200],
+        "payload": payload,
+    }
+
+
+def make_messages(
+    count: int, seed: int = 0, now: Optional[datetime] = None
+) -> List[Dict]:
+    rng = random.Random(seed)
+    now = now or datetime.utcnow()
+    return [make_message(rng, i, now) for i in range(count)]
+
+
+def _condition(rng: random.Random) -> Dict:
+    field = rng.choices(list(FIELD_WEIGHTS), weights=list(FIELD_WEIGHTS.values()))[0]
+    if field == "Received":
+        predicate = rng.choice(
+            ["LessThanDays", "GreaterThanDays", "LessThanMonths", "GreaterThanMonths"]
+        )
+        value = rng.randint(1, 24) if "Months" in predicate else rng.randint(1, 365)
+        return {"field": field, "predicate": predicate, "value": value}
+    predicate = rng.choices(
+        ["Contains", "DoesNotContain", "Equals", "DoesNotEqual"],
+        weights=[60, 25, 10, 5],
+    )[0]
+    if field in ("From", "To"):
+        value = rng.choice(NAMES + DOMAINS)
+    else:
+        value = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 2)))
+    return {"field": field, "predicate": predicate, "value": value}
+
+
+def make_rules(count: int, seed: int = 0) -> List[Dict]:
+    """`count` rulesets in rules.json form, 1-4 conditions each."""
+    rng = random.Random(seed)
+    rules = []
+    for i in range(count):
+        actions = [{"type": "mark_as_read"}]
+        if rng.random() < 0.5:
+            actions.append({"type": "move_message", "label": f"Bench/{i % 10}"})
+        rules.append(
+            {
+                "predicate": rng.choice(["All", "Any"]),
+                "rules": [_condition(rng) for _ in range(rng.randint(1, 4))],
+                "actions": actions,
+            }
+        )
+    return rules
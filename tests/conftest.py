@@ -0,0 +1,137 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from app import actions as actions_module
+from app import db, ratelimit
+from app.models import Email
+
+
+# -----------------------------
+# Fake session for mocking DB
+# -----------------------------
+class FakeSession:
+    def __init__(self):
+        self.storage = {}
+
+    def add(self, obj):
+        self.storage[obj.id] = obj
+
+    def commit(self):
+        # Ensure that the objects in storage reflect their updated state
+        for key, obj in self.storage.items():
+            self.storage[key] = obj
+
+    def close(self):
+        pass
+
+    def get(self, model, pk):
+        return self.storage.get(pk)
+
+    def scalars(self, stmt):
+        class FakeResult:
+            def __init__(self, values):
+                self._values = values
+
+            def all(self):
+                return self._values
+
+        return FakeResult(list(self.storage.values()))
+
+
+# -----------------------------
+# Fixtures
+# -----------------------------
+@pytest.fixture
+def fake_session(monkeypatch):
+    fs = FakeSession()
+    monkeypatch.setattr("app.db.get_session", lambda: fs)
+    return fs
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """A real (file-backed, so shareable with worker processes) database."""
+    engine = db.create_db_engine(f"sqlite:///{tmp_path / 'mail.db'}")
+    db.Base.metadata.create_all(engine)
+    monkeypatch.setattr(db, "engine", engine)
+    monkeypatch.setattr(db, "SessionLocal", sessionmaker(bind=engine, autoflush=False))
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(autouse=True)
+def fresh_scheduler(monkeypatch):
+    """Give every test its own Gmail quota scheduler."""
+    monkeypatch.setattr(ratelimit, "_scheduler", None)
+
+
+@pytest.fixture(autouse=True)
+def mock_gmail(monkeypatch):
+    """Mock Gmail API calls so tests don't hit network."""
+    monkeypatch.setattr("app.actions.batch_modify_messages", lambda *a, **kw: None)
+    monkeypatch.setattr(
+        "app.actions.get_labels_map",
+        lambda: {"UNREAD": "lbl_unread", "INBOX": "lbl_inbox"},
+    )
+    monkeypatch.setattr(
+        "app.actions.ensure_label",
+        lambda name, labels_map=None: f"lbl_{name.lower()}",
+    )
+
+
+@pytest.fixture
+def gmail_calls(monkeypatch):
+    calls = {"labels_list": 0, "batch_modify": []}
+
+    def fake_labels_map():
+        calls["labels_list"] += 1
+        return {"UNREAD": "UNREAD", "INBOX": "INBOX"}
+
+    def fake_ensure_label(name, labels_map=None):
+        if name not in labels_map:
+            calls.setdefault("created", []).append(name)
+            labels_map[name] = f"Label_{name}"
+        return labels_map[name]
+
+    def fake_batch_modify(ids, add_labels=None, remove_labels=None):
+        calls["batch_modify"].append((list(ids), add_labels, remove_labels))
+
+    monkeypatch.setattr(actions_module, "get_labels_map", fake_labels_map)
+    monkeypatch.setattr(actions_module, "ensure_label", fake_ensure_label)
+    monkeypatch.setattr(actions_module, "batch_modify_messages", fake_batch_modify)
+    return calls
+
+
+# -----------------------------
+# Database helpers
+# -----------------------------
+def _store(emails):
+    session = db.get_session()
+    for e in emails:
+        session.add(
+            Email(
+                id=e.id,
+                thread_id=e.thread_id,
+                from_email=e.from_email,
+                to_email=e.to_email,
+                subject=e.subject,
+                snippet=e.snippet,
+                body=e.body,
+                received_at=e.received_at,
+                is_read=e.is_read,
+                labels={"ids": ["INBOX", "UNREAD"]},
+            )
+        )
+    session.commit()
+    session.close()
+
+
+def _labels():
+    session = db.get_session()
+    try:
+        return {
+            e.id: (e.labels["ids"], e.is_read) for e in session.scalars(select(Email))
+        }
+    finally:
+        session.close()
@@ -0,0 +1,302 @@
+import pytest
+from sqlalchemy import event, inspect, select
+
+from app import actions as actions_module
+from app import db, gmail_client
+from app import process_rules as process_module
+from app.actions import ActionBatch
+from app.config import settings
+from app.models import Email
+from app.process_rules import id_ranges, process_rules
+from app.sql_rules import rule_columns
+from app.rules_engine import RuleCondition, RuleSet, apply_actions
+from tests.conftest import _labels, _store
+from tests.test_rules import make_email
+
+
+class RecordingSession:
+    def __init__(self):
+        self.commits = 0
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_action_batch_groups_identical_changes(gmail_calls):
+    batch = ActionBatch(chunk_size=2)
+    emails = [make_email(id=f"m{i}") for i in range(5)]
+    for e in emails[:3]:
+        batch.add(e, [{"type": "mark_as_read"}])
+    for e in emails[3:]:
+        batch.add(e, [{"type": "move_message", "label": "Receipts"}])
+
+    session = RecordingSession()
+    assert batch.flush(session) == 5
+
+    assert gmail_calls["labels_list"] == 1
+    assert gmail_calls["created"] == ["Receipts"]
+    assert gmail_calls["batch_modify"] == [
+        (["m0", "m1"], [], ["UNREAD"]),
+        (["m2"], [], ["UNREAD"]),
+        (["m3", "m4"], ["Label_Receipts"], ["INBOX"]),
+    ]
+    assert session.commits == 3
+    assert all(e.is_read for e in emails[:3])
+    assert emails[3].labels == {"ids": ["Label_Receipts"]}
+    assert len(batch) == 0
+
+
+def test_action_batch_merges_rulesets_in_order(gmail_calls):
+    batch = ActionBatch()
+    e = make_email(id="m1")
+    e.labels = {"ids": ["INBOX", "UNREAD"]}
+    batch.add(e, [{"type": "mark_as_read"}])
+    batch.add(e, [{"type": "mark_as_unread"}, {"type": "move_message"}])
+
+    batch.flush(RecordingSession())
+
+    ((ids, add, remove),) = gmail_calls["batch_modify"]
+    assert ids == ["m1"]
+    assert add == sorted(["UNREAD", "Label_Processed"])
+    assert remove == ["INBOX"]
+    assert e.is_read is False
+    assert e.labels == {"ids": ["Label_Processed", "UNREAD"]}
+
+
+def test_action_batch_commits_only_confirmed_chunks(gmail_calls, monkeypatch):
+    def failing_batch_modify(ids, add_labels=None, remove_labels=None):
+        if "m2" in ids:
+            raise RuntimeError("quota")
+        gmail_calls["batch_modify"].append(ids)
+
+    monkeypatch.setattr(actions_module, "batch_modify_messages", failing_batch_modify)
+    batch = ActionBatch(chunk_size=2)
+    emails = [make_email(id=f"m{i}") for i in range(4)]
+    for e in emails:
+        batch.add(e, [{"type": "mark_as_read"}])
+
+    session = RecordingSession()
+    with pytest.raises(RuntimeError):
+        batch.flush(session)
+
+    assert session.commits == 1
+    assert [e.is_read for e in emails] == [True, True, False, False]
+
+
+def test_action_batch_does_not_reload_emails_between_chunks(sqlite_db, gmail_calls):
+    _store([make_email(id=f"m{i}") for i in range(30)])
+    session = db.get_session()
+    batch = ActionBatch(chunk_size=10)
+    for e in session.scalars(select(Email)).all():
+        batch.add(e, [{"type": "mark_as_read"}, {"type": "move_message"}])
+    selects = []
+    event.listen(
+        sqlite_db,
+        "before_cursor_execute",
+        lambda conn, cursor, sql, *args: (
+            selects.append(sql) if sql.startswith("SELECT") else None
+        ),
+    )
+
+    assert batch.flush(session) == 30
+    session.close()
+
+    assert len(gmail_calls["batch_modify"]) == 3
+    assert selects == []
+    assert _labels()["m29"] == (["Label_Processed"], True)
+
+
+def test_action_batch_rejects_unknown_action(gmail_calls):
+    with pytest.raises(ValueError, match="Unknown action type"):
+        ActionBatch().add(make_email(), [{"type": "delete"}])
+
+
+def test_process_rules_sends_one_batch_per_label_change(gmail_calls, fake_session):
+    for i in range(4):
+        fake_session.add(make_email(id=f"m{i}", subject="Invoice" if i % 2 else "Hi"))
+    rulesets = [
+        RuleSet("All", [RuleCondition("Subject", "Contains", "invoice")], []),
+        RuleSet("Any", [RuleCondition("From", "Contains", "a@")], []),
+    ]
+    rulesets[0].actions = [{"type": "move_message", "label": "Bills"}]
+    rulesets[1].actions = [{"type": "mark_as_read"}]
+
+    assert process_rules(rulesets, stop_after_first_match=True) == 4
+
+    assert gmail_calls["labels_list"] == 1
+    assert sorted(gmail_calls["batch_modify"]) == [
+        (["m0", "m2"], [], ["UNREAD"]),
+        (["m1", "m3"], ["Label_Bills"], ["INBOX"]),
+    ]
+
+
+def test_id_ranges_partition_the_table(sqlite_db):
+    _store([make_email(id=f"m{i:03d}") for i in range(25)])
+    session = db.get_session()
+    ranges = id_ranges(session, 10)
+    session.close()
+
+    assert ranges == [(None, "m009"), ("m009", "m019"), ("m019", None)]
+
+
+@pytest.mark.parametrize("stop", [False, True])
+def test_workers_match_serial_run(sqlite_db, gmail_calls, monkeypatch, stop):
+    monkeypatch.setattr(settings, "PROCESS_CHUNK_SIZE", 7)
+    emails = [
+        make_email(
+            id=f"m{i:03d}",
+            subject="invoice" if i % 2 else "hello",
+            sender="billing@x.com" if i % 3 == 0 else "a@y.com",
+        )
+        for i in range(30)
+    ]
+    rulesets = [
+        RuleSet(
+            "All",
+            [RuleCondition("Subject", "Contains", "invoice")],
+            [{"type": "move_message", "label": "Bills"}],
+        ),
+        RuleSet(
+            "Any",
+            [RuleCondition("From", "Contains", "billing")],
+            [{"type": "mark_as_read"}],
+        ),
+    ]
+
+    _store(emails)
+    serial = process_rules(rulesets, stop_after_first_match=stop)
+    serial_labels = _labels()
+    serial_calls = list(gmail_calls["batch_modify"])
+
+    db.Base.metadata.drop_all(sqlite_db)
+    db.Base.metadata.create_all(sqlite_db)
+    gmail_calls["batch_modify"].clear()
+    _store(emails)
+    parallel = process_rules(rulesets, stop_after_first_match=stop, workers=3)
+
+    assert parallel == serial
+    assert _labels() == serial_labels
+    assert gmail_calls["batch_modify"] == serial_calls
+
+
+def test_rule_columns_defer_body_without_message_rule():
+    subject_only = [RuleSet("All", [RuleCondition("Subject", "Contains", "x")], [])]
+    message = [RuleSet("All", [RuleCondition("Message", "Contains", "x")], [])]
+
+    assert Email.body not in rule_columns(subject_only)
+    assert {Email.id, Email.labels, Email.subject} <= set(rule_columns(subject_only))
+    assert {Email.body, Email.snippet} <= set(rule_columns(message))
+
+
+def test_streaming_matches_serial_run(sqlite_db, gmail_calls, monkeypatch):
+    monkeypatch.setattr(settings, "PROCESS_CHUNK_SIZE", 4)
+    emails = [
+        make_email(id=f"m{i:03d}", subject="invoice" if i % 2 else "hello")
+        for i in range(15)
+    ]
+    rulesets = [
+        RuleSet(
+            "All",
+            [RuleCondition("Subject", "Contains", "invoice")],
+            [{"type": "move_message", "label": "Bills"}, {"type": "mark_as_read"}],
+        )
+    ]
+    seen = []
+    matcher_cls = process_module.MATCH_ENGINES["compiled"]
+
+    class SpyMatcher(matcher_cls):
+        def iter_matches(self, email):
+            seen.append("body" in inspect(email).unloaded)
+            return super().iter_matches(email)
+
+    monkeypatch.setitem(process_module.MATCH_ENGINES, "compiled", SpyMatcher)
+    _store(emails)
+    serial = process_rules(rulesets)
+    serial_labels = _labels()
+
+    db.Base.metadata.drop_all(sqlite_db)
+    db.Base.metadata.create_all(sqlite_db)
+    gmail_calls["batch_modify"].clear()
+    seen.clear()
+    _store(emails)
+    streamed = process_rules(rulesets, stream=True)
+
+    assert streamed == serial == 7
+    assert _labels() == serial_labels
+    # pushdown loads only the 7 candidates, none with a body
+    assert all(seen) and len(seen) == 7
+    # one batchModify per streamed chunk of 4 candidates
+    assert [ids for ids, _, _ in gmail_calls["batch_modify"]] == [
+        ["m001", "m003", "m005", "m007"],
+        ["m009", "m011", "m013"],
+    ]
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_bodies_are_fetched_only_when_a_message_rule_needs_them(
+    sqlite_db, gmail_calls, monkeypatch, stream
+):
+    emails = [
+        make_email(id="m1", subject="invoice"),
+        make_email(id="m2", subject="hello"),
+        make_email(id="m3", subject="invoice", body="already paid"),
+    ]
+    emails[0].body = emails[1].body = None
+    _store(emails)
+    fetched = []
+
+    def fake_fetch_body(message_id):
+        fetched.append(message_id)
+        return "Paid in full"
+
+    monkeypatch.setattr(gmail_client, "fetch_body", fake_fetch_body)
+    rulesets = [
+        RuleSet(
+            "All",
+            [
+                RuleCondition("Subject", "Contains", "invoice"),
+                RuleCondition("Message", "Contains", "paid"),
+            ],
+            [{"type": "mark_as_read"}],
+        )
+    ]
+
+    assert process_rules(rulesets, stream=stream) == 2
+
+    # m2 fails the Subject condition first, so its body is never needed
+    assert fetched == ["m1"]
+    session = db.get_session()
+    assert session.get(Email, "m1").body == "Paid in full"
+    assert session.get(Email, "m2").body is None
+    session.close()
+
+
+def test_process_rules_limited_to_email_ids(sqlite_db, gmail_calls):
+    _store([make_email(id=f"m{i}", subject="invoice") for i in range(3)])
+    rulesets = [
+        RuleSet(
+            "All",
+            [RuleCondition("Subject", "Contains", "invoice")],
+            [{"type": "mark_as_read"}],
+        )
+    ]
+
+    assert process_rules(rulesets, email_ids=["m0", "m2"]) == 2
+
+    assert gmail_calls["batch_modify"] == [(["m0", "m2"], [], ["UNREAD"])]
+
+
+def test_apply_actions_sends_one_email_right_away(gmail_calls):
+    e = make_email(id="m1")
+    e.labels = {"ids": ["INBOX", "UNREAD"]}
+
+    updates = apply_actions(
+        e, [{"type": "mark_as_read"}, {"type": "move_message", "label": "Bills"}]
+    )
+
+    assert gmail_calls["batch_modify"] == [
+        (["m1"], ["Label_Bills"], ["INBOX", "UNREAD"])
+    ]
+    assert updates == {"is_read": True, "labels": {"ids": ["Label_Bills"]}}
+    # left for the caller to set and commit, as before
+    assert e.is_read is False
@@ -0,0 +1,310 @@
+import asyncio
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+from app import actions, async_gmail, db, fetch_emails, gmail_client  # noqa: E402
+from app import ratelimit  # noqa: E402
+from app.async_gmail import AsyncGmailClient, GmailAPIError  # noqa: E402
+from app.config import settings  # noqa: E402
+from app.models import Email  # noqa: E402
+from app.process_rules import process_rules_async  # noqa: E402
+from app.rules_engine import RuleCondition, RuleSet  # noqa: E402
+from tests.conftest import _labels, _store  # noqa: E402
+from tests.test_rules import make_email  # noqa: E402
+
+PREFIX = "/gmail/v1/users/me"
+DEFAULT_TOKEN = async_gmail._default_token
+
+
+class FakeGmail:
+    """In-memory Gmail REST API state behind a local HTTP server."""
+
+    def __init__(self, messages, page_size=2):
+        self.messages = {m["id"]: m for m in messages}
+        self.page_size = page_size
+        self.labels = {"INBOX": "INBOX", "UNREAD": "UNREAD"}
+        self.flaky = set()  # ids answering 429 once
+        self.batch_modify = []
+        self.created = []
+        self.tokens = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def handle(self, method, path, query, body, token):
+        self.tokens.append(token)
+        if token != "tok":
+            return 401, {"error": "invalid token"}
+        path = path[len(PREFIX) :]
+        if method == "GET" and path == "/messages":
+            ids = sorted(self.messages)
+            start = int(query.get("pageToken", ["0"])[0])
+            size = min(self.page_size, int(query["maxResults"][0]))
+            page = {"messages": [{"id": mid} for mid in ids[start : start + size]]}
+            if start + size < len(ids):
+                page["nextPageToken"] = str(start + size)
+            return 200, page
+        if method == "GET" and path.startswith("/messages/"):
+            mid = path.rsplit("/", 1)[1]
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            time.sleep(0.02)
+            with self.lock:
+                self.in_flight -= 1
+            if mid in self.flaky:
+                self.flaky.discard(mid)
+                return 429, {"error": "rate limited"}
+            if mid not in self.messages:
+                return 404, {"error": "not found"}
+            return 200, self.messages[mid]
+        if method == "POST" and path == "/messages/batchModify":
+            self.batch_modify.append(body)
+            return 204, None
+        if method == "GET" and path == "/labels":
+            return 200, {
+                "labels": [{"name": n, "id": i} for n, i in self.labels.items()]
+            }
+        if method == "POST" and path == "/labels":
+            self.created.append(body["name"])
+            self.labels[body["name"]] = f"Label_{body['name']}"
+            return 200, {"id": self.labels[body["name"]]}
+        return 404, {"error": path}
+
+
+@pytest.fixture
+def gmail_server(monkeypatch):
+    gmail = FakeGmail([raw_message(f"m{i}") for i in range(5)])
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _serve(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+            status, payload = gmail.handle(
+                self.command, url.path, parse_qs(url.query), body, token
+            )
+            data = b"" if payload is None else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = _serve
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(
+        settings, "GMAIL_API_URL", f"http://127.0.0.1:{server.server_port}/gmail/v1"
+    )
+    monkeypatch.setattr(async_gmail, "_default_token", lambda: "tok")
+    monkeypatch.setattr(ratelimit.random, "uniform", lambda a, b: 0)
+    yield gmail
+    server.shutdown()
+    server.server_close()
+
+
+def raw_message(mid, subject="hello"):
+    return {
+        "id": mid,
+        "threadId": f"t-{mid}",
+        "labelIds": ["INBOX", "UNREAD"],
+        "snippet": f"snippet {mid}",
+        "payload": {
+            "headers": [
+                {"name": "From", "value": "a@example.com"},
+                {"name": "Subject", "value": subject},
+                {"name": "Date", "value": "Mon, 01 Jan 2024 10:00:00 +0000"},
+            ]
+        },
+    }
+
+
+def test_fetch_and_store_async(gmail_server, monkeypatch):
+    gmail_server.flaky = {"m3"}
+    written = []
+
+    class Session:
+        def commit(self):
+            pass
+
+        def close(self):
+            pass
+
+    def fake_upsert(session, rows):
+        # off the event loop, so the next chunk is fetched meanwhile
+        assert threading.current_thread() is not threading.main_thread()
+        written.append([row["id"] for row in rows])
+        return len(rows), 0
+
+    monkeypatch.setattr(fetch_emails, "get_session", Session)
+    monkeypatch.setattr(fetch_emails, "upsert_emails", fake_upsert)
+    monkeypatch.setattr(settings, "UPSERT_CHUNK_SIZE", 2)
+
+    stats = asyncio.run(fetch_emails.fetch_and_store_async(max_results=None))
+
+    assert written == [["m0", "m1"], ["m2", "m3"], ["m4"]]
+    assert (stats.fetched, stats.inserted) == (5, 5)
+
+
+def test_requests_are_bounded_by_concurrency(gmail_server):
+    gmail_server.messages = {f"x{i}": raw_message(f"x{i}") for i in range(12)}
+
+    async def run():
+        async with AsyncGmailClient(concurrency=3) as client:
+            return await client.get_messages(sorted(gmail_server.messages))
+
+    msgs = asyncio.run(run())
+
+    assert [m["id"] for m in msgs] == sorted(gmail_server.messages)
+    assert 1 < gmail_server.max_in_flight <= 3
+
+
+def test_expired_token_is_refreshed_once(gmail_server):
+    tokens = iter(["stale", "tok"])
+
+    async def run():
+        async with AsyncGmailClient(token_provider=lambda: next(tokens)) as client:
+            return await client.labels_map()
+
+    assert asyncio.run(run())["INBOX"] == "INBOX"
+    assert gmail_server.tokens == ["stale", "tok"]
+
+
+def test_rejected_token_is_force_refreshed(gmail_server, monkeypatch):
+    class Creds:
+        # still looks valid locally, but the API has revoked it
+        valid, token, refresh_token = True, "stale", "refresh"
+
+        def refresh(self, request):
+            self.token = "tok"
+
+    monkeypatch.setattr(gmail_client, "_credentials", Creds())
+    monkeypatch.setattr(gmail_client, "_save_token", lambda creds: None)
+    monkeypatch.setattr(async_gmail, "_default_token", DEFAULT_TOKEN)
+
+    async def run():
+        async with AsyncGmailClient() as client:
+            return await client.labels_map()
+
+    assert asyncio.run(run())["INBOX"] == "INBOX"
+    assert gmail_server.tokens == ["stale", "tok"]
+
+
+def test_dropped_connections_are_retried(gmail_server):
+    scheduler = ratelimit.QuotaScheduler(units_per_second=1e9)
+    calls = []
+
+    async def run(failures):
+        async with AsyncGmailClient(scheduler=scheduler, max_retries=2) as client:
+            request = client._http.request
+
+            async def flaky(*args, **kwargs):
+                calls.append(args)
+                if len(calls) <= failures:
+                    raise httpx.ConnectError("connection reset")
+                return await request(*args, **kwargs)
+
+            client._http.request = flaky
+            return await client.labels_map()
+
+    assert asyncio.run(run(2))["INBOX"] == "INBOX"
+    assert len(calls) == 3
+    assert scheduler.stats.retries == 2 and scheduler.stats.throttled == 0
+    calls.clear()
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(run(3))
+
+
+def test_missing_message_raises_unless_missing_ok(gmail_server):
+    async def run(missing_ok):
+        async with AsyncGmailClient() as client:
+            return await client.get_messages(["m0", "gone"], missing_ok=missing_ok)
+
+    assert [m["id"] for m in asyncio.run(run(True))] == ["m0"]
+    with pytest.raises(GmailAPIError) as exc:
+        asyncio.run(run(False))
+    assert exc.value.status == 404
+
+
+def test_process_rules_async(gmail_server, sqlite_db, monkeypatch):
+    # labels are resolved up front, so the sync helper never reaches Gmail
+    monkeypatch.setattr(actions, "ensure_label", gmail_client.ensure_label)
+    _store(
+        [
+            make_email(id="m1", subject="invoice"),
+            make_email(id="m2", subject="hello"),
+            make_email(id="m3", subject="invoice"),
+        ]
+    )
+    rulesets = [
+        RuleSet(
+            "All",
+            [RuleCondition("Subject", "Contains", "invoice")],
+            [{"type": "move_message", "label": "Bills"}],
+        )
+    ]
+
+    matched = asyncio.run(process_rules_async(rulesets))
+
+    assert matched == 2
+    assert gmail_server.created == ["Bills"]
+    assert gmail_server.batch_modify == [
+        {
+            "ids": ["m1", "m3"],
+            "addLabelIds": ["Label_Bills"],
+            "removeLabelIds": ["INBOX"],
+        }
+    ]
+    assert _labels()["m1"] == (["Label_Bills", "UNREAD"], False)
+
+
+def test_process_rules_async_prefetches_bodies_concurrently(
+    gmail_server, sqlite_db, monkeypatch
+):
+    bodies = {"m1": "pay now", "m2": "hello", "m3": "pay later", "m4": "pay"}
+    for mid, text in bodies.items():
+        msg = gmail_server.messages.setdefault(mid, raw_message(mid))
+        msg["payload"]["mimeType"] = "text/plain"
+        data = base64.urlsafe_b64encode(text.encode()).decode()
+        msg["payload"]["body"] = {"data": data}
+    # metadata-only rows, and one already stored
+    _store([make_email(id=mid) for mid in bodies])
+    session = db.get_session()
+    for mid in ("m1", "m2", "m3"):
+        session.get(Email, mid).body = None
+    session.commit()
+    session.close()
+    monkeypatch.setattr(
+        gmail_client, "fetch_body", lambda mid: pytest.fail("blocking download")
+    )
+    rulesets = [
+        RuleSet(
+            "All",
+            [RuleCondition("Message", "Contains", "pay")],
+            [{"type": "mark_as_read"}],
+        )
+    ]
+
+    assert asyncio.run(process_rules_async(rulesets, pushdown=False)) == 2
+    assert gmail_server.max_in_flight > 1
+    assert [b["ids"] for b in gmail_server.batch_modify] == [["m1", "m3"]]
+    session = db.get_session()
+    assert session.get(Email, "m2").body == "hello"
+    session.close()
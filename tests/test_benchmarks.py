@@ -0,0 +1,67 @@
+import json
+
+from typer.testing import CliRunner
+
+from app import db, gmail_client, ratelimit
+from benchmarks.run import app, compare_results, measure_startup, run_benchmarks
+
+runner = CliRunner()
+
+
+def test_run_benchmarks_times_in_memory_stages():
+    result = run_benchmarks(emails=30, rules=5, repeats=1)
+
+    stages = result["stages"]
+    assert stages["email_matches"]["items"] == 150
+    assert stages["parse_message"]["best_s"] > 0
+    assert stages["fetch_and_store"] == {"skipped": "no --database-url"}
+
+
+def test_run_benchmarks_times_database_stages_on_sqlite(tmp_path, monkeypatch):
+    # run_benchmarks points these at its scratch database and Gmail stand-in
+    for name in ("engine", "SessionLocal"):
+        monkeypatch.setattr(db, name, None)
+    get_service, scheduler = gmail_client.get_service, ratelimit._scheduler
+    url = f"sqlite:///{tmp_path / 'bench.db'}"
+
+    result = run_benchmarks(emails=30, rules=5, repeats=2, database_urls=[url])
+
+    stages = result["stages"]
+    assert stages["fetch_and_store[sqlite]"]["items"] == 30
+    assert stages["process_rules[sqlite]"]["items_per_s"] > 0
+    assert "fetch_and_store" not in stages
+    # the Gmail stand-in is only patched in while the stages run
+    assert gmail_client.get_service is get_service
+    assert ratelimit._scheduler is scheduler
+
+
+def test_compare_flags_regressions(tmp_path):
+    def results(parse_s):
+        stages = {
+            "parse_message": {"best_s": parse_s},
+            "load_rules": {"best_s": 0.01},
+            "fetch_and_store": {"skipped": "no --database-url"},
+        }
+        return {"runs": [{"emails": 10, "rules": 2, "stages": stages}]}
+
+    rows = compare_results(results(1.0), results(1.5), threshold=0.2)
+    assert [(r["stage"], r["regressed"]) for r in rows] == [
+        ("parse_message", True),
+        ("load_rules", False),
+    ]
+
+    old, new = tmp_path / "old.json", tmp_path / "new.json"
+    old.write_text(json.dumps(results(1.0)))
+    new.write_text(json.dumps(results(1.05)))
+    assert runner.invoke(app, ["compare", str(old), str(new)]).exit_code == 0
+    new.write_text(json.dumps(results(2.0)))
+    out = runner.invoke(app, ["compare", str(old), str(new)])
+    assert out.exit_code == 1
+    assert "REGRESSION" in out.output
+
+
+def test_measure_startup_finds_no_heavy_imports():
+    result = measure_startup(repeats=1)
+
+    assert result["heavy_imports"] == []
+    assert set(result["stages"]) == {"cli --help", "rules validate"}
@@ -0,0 +1,148 @@
+import base64
+
+import pytest
+
+from app import bodies, db, fetch_emails, gmail_client, metrics
+from app.bodies import compress_body, decompress_body, html_to_text, prepare_body
+from app.config import settings
+from app.gmail_client import extract_plain_text
+from app.models import Email
+from app.process_rules import process_rules
+from app.rules_engine import RuleCondition, RuleSet
+from tests.conftest import _store
+from tests.test_fetch import make_message
+from tests.test_rules import make_email
+
+
+def _part(mime, text):
+    return {
+        "mimeType": mime,
+        "body": {"data": base64.urlsafe_b64encode(text.encode()).decode()},
+    }
+
+
+def test_html_to_text_drops_markup_and_keeps_blocks():
+    html = (
+        "<html><head><style>p {color: red}</style><title>T</title></head>"
+        "<body><p>Your&nbsp;invoice &amp; receipt</p>"
+        "<script>track()</script><div>Total: <b>42</b></div></body></html>"
+    )
+
+    assert html_to_text(html) == "Your invoice & receipt\n\nTotal: 42"
+
+
+def test_extract_plain_text_prefers_plain_then_falls_back_to_html(monkeypatch):
+    both = {
+        "mimeType": "multipart/alternative",
+        "parts": [_part("text/html", "<p>rich</p>"), _part("text/plain", "plain")],
+    }
+    html_only = {"mimeType": "multipart/alternative", "parts": [both["parts"][0]]}
+
+    assert extract_plain_text(both) == "plain"
+    assert extract_plain_text(html_only) == "rich"
+    monkeypatch.setattr(settings, "BODY_HTML_FALLBACK", False)
+    assert extract_plain_text(html_only) == ""
+
+
+def test_prepare_body_caps_and_compresses(monkeypatch):
+    monkeypatch.setattr(settings, "BODY_MAX_CHARS", 5)
+    assert prepare_body("hello world") == ("hello", "hello", None)
+
+    monkeypatch.setattr(settings, "BODY_COMPRESSION", "zlib")
+    text, body, body_z = prepare_body("hello world")
+    assert (text, body) == ("hello", None)
+    assert decompress_body(body_z) == "hello"
+
+
+def test_unknown_codecs_are_rejected():
+    with pytest.raises(ValueError):
+        compress_body("x", "lz4")
+    with pytest.raises(ValueError):
+        decompress_body(b"?data")
+
+
+def test_settings_reject_unknown_codecs(monkeypatch):
+    monkeypatch.setattr(settings, "BODY_COMPRESSION", "lz4")
+
+    with pytest.raises(ValueError, match="choose from none, zlib, zstd"):
+        settings.validate()
+
+
+def test_zstd_round_trip():
+    pytest.importorskip("zstandard")
+    data = compress_body("ünïcode " * 100, "zstd")
+
+    assert decompress_body(data) == "ünïcode " * 100
+    assert len(data) < 100
+
+
+def test_zstd_without_the_package_fails_clearly(monkeypatch):
+    monkeypatch.setattr(bodies, "zstandard", None)
+
+    with pytest.raises(RuntimeError, match="zstandard"):
+        compress_body("x", "zstd")
+
+
+def test_parse_message_stores_compressed_body(monkeypatch):
+    plain = fetch_emails.parse_message(make_message("m1", body="Paid in full"))
+    monkeypatch.setattr(settings, "BODY_COMPRESSION", "zlib")
+    row = fetch_emails.parse_message(make_message("m1", body="Paid in full"))
+
+    assert row["body"] is None
+    assert decompress_body(row["body_z"]) == "Paid in full"
+    # the same text seen, so the same hash whichever way it is stored
+    assert row["content_hash"] == plain["content_hash"]
+
+
+def test_parse_messages_in_a_pool_matches_serial(monkeypatch):
+    monkeypatch.setattr(settings, "BODY_COMPRESSION", "zlib")
+    msgs = [make_message(f"m{i}", body=f"body {i}") for i in range(25)]
+
+    with fetch_emails.parse_pool(2) as pool:
+        assert pool is not None
+        pooled = fetch_emails.parse_messages(msgs, True, pool)
+
+    assert pooled == fetch_emails.parse_messages(msgs, True)
+
+
+@pytest.mark.parametrize("pushdown", [False, True])
+@pytest.mark.parametrize("engine", ["compiled", "columnar"])
+def test_message_rules_read_compressed_bodies(
+    sqlite_db, gmail_calls, monkeypatch, engine, pushdown
+):
+    emails = [
+        make_email(id="m1", subject="invoice"),
+        make_email(id="m2", subject="invoice"),
+    ]
+    _store(emails)
+    session = db.get_session()
+    session.get(Email, "m1").body = None
+    session.get(Email, "m1").body_z = compress_body("Paid in full", "zlib")
+    session.get(Email, "m2").body = None
+    session.get(Email, "m2").body_z = compress_body("Overdue", "zlib")
+    session.commit()
+    session.close()
+    monkeypatch.setattr(
+        gmail_client, "fetch_body", lambda mid: pytest.fail("body downloaded")
+    )
+    rulesets = [
+        RuleSet(
+            "All",
+            [RuleCondition("Message", "Contains", "paid")],
+            [{"type": "mark_as_read"}],
+        )
+    ]
+
+    metrics.enable()
+    try:
+        assert process_rules(rulesets, engine=engine, pushdown=pushdown) == 1
+        assert metrics.counter("bodies_decompressed") == 2
+    finally:
+        metrics.enable(False)
+        metrics.reset()
+
+    assert gmail_calls["batch_modify"] == [(["m1"], [], ["UNREAD"])]
+    session = db.get_session()
+    # decompressed in memory only
+    assert session.get(Email, "m1").body is None
+    session.close()
@@ -0,0 +1,107 @@
+import json
+
+from typer.testing import CliRunner
+
+from app import config
+from app.cli import app
+from app.config import settings
+
+runner = CliRunner()
+
+RULES = [
+    {
+        "predicate": "All",
+        "rules": [{"field": "From", "predicate": "Contains", "value": "noreply@"}],
+        "actions": [{"type": "mark_as_read"}],
+    },
+    {
+        "predicate": "Any",
+        "rules": [
+            {"field": "Subject", "predicate": "Contains", "value": "urgent"},
+            {"field": "Received", "predicate": "GreaterThanDays", "value": 30},
+        ],
+        "actions": [{"type": "move_message", "label": "Important"}],
+    },
+]
+
+
+def _write(path, data):
+    path.write_text(json.dumps(data))
+    return str(path)
+
+
+def test_rules_validate(tmp_path):
+    ok = _write(tmp_path / "ok.json", RULES)
+    result = runner.invoke(app, ["rules", "validate", ok])
+    assert result.exit_code == 0
+    assert "OK: 2 rulesets, 3 conditions" in result.output
+
+    bad_action = [{**RULES[0], "actions": [{"type": "archive"}]}]
+    result = runner.invoke(
+        app, ["rules", "validate", _write(tmp_path / "a.json", bad_action)]
+    )
+    assert result.exit_code == 1
+    assert "unknown action type 'archive'" in result.output
+
+    bad_rule = [{**RULES[0], "rules": [{"field": "cc", "predicate": "Contains"}]}]
+    result = runner.invoke(
+        app, ["rules", "validate", _write(tmp_path / "r.json", bad_rule)]
+    )
+    assert result.exit_code == 1
+    assert "Invalid rules" in result.output
+
+
+def test_rules_test_shows_matching_rulesets(tmp_path):
+    rules = _write(tmp_path / "rules.json", RULES)
+    emails = _write(
+        tmp_path / "emails.json",
+        [
+            {"from": "noreply@example.com", "subject": "Hi"},
+            {"from": "boss@example.com", "received": "2024-01-01T09:00:00Z"},
+        ],
+    )
+    args = ["rules", "test", "--email-json", emails, "--rules-path", rules]
+
+    result = runner.invoke(app, [*args, "--now", "2024-03-01T00:00:00"])
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[0] == "Email 1 ('Hi'): 1 matching rulesets"
+    assert lines[1] == "  #1 All: mark_as_read"
+    assert lines[3] == "  #2 Any: move_message Important"
+
+    # Not yet 30 days old at --now
+    result = runner.invoke(app, [*args, "--now", "2024-01-15T00:00:00"])
+    assert "Email 2 (''): 0 matching rulesets" in result.output
+
+
+def test_rules_test_rejects_unknown_email_fields(tmp_path):
+    rules = _write(tmp_path / "rules.json", RULES)
+    emails = _write(tmp_path / "emails.json", {"cc": "x@example.com"})
+    result = runner.invoke(
+        app, ["rules", "test", "--email-json", emails, "--rules-path", rules]
+    )
+    assert result.exit_code == 2
+    assert "Unknown email field(s): cc" in result.output
+
+
+def test_fetch_rejects_batch_size_with_async():
+    result = runner.invoke(
+        app, ["fetch", "--async", "--batch-size", "10", "--format", "full"]
+    )
+
+    assert result.exit_code == 2
+    assert "--batch-size" in result.output
+
+
+def test_zstd_without_the_package_is_rejected_at_startup(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "BODY_COMPRESSION", "zstd")
+    find_spec = config.importlib.util.find_spec
+    monkeypatch.setattr(
+        config.importlib.util,
+        "find_spec",
+        lambda name, *args: None if name == "zstandard" else find_spec(name, *args),
+    )
+    result = runner.invoke(app, ["rules", "validate", _write(tmp_path / "r", RULES)])
+
+    assert result.exit_code == 1
+    assert "requires zstandard (uv sync --extra zstd)" in result.output
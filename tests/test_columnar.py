@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+import json
+import random
+
+import pytest
+
+from app.columnar import ColumnarMatcher, EmailColumns
+from app.fetch_emails import parse_message
+from app.models import Email
+from app.process_rules import process_rules
+from app.rules_engine import (
+    CompiledMatcher,
+    RuleCondition,
+    RuleSet,
+    date_cutoff,
+    lazy_bodies,
+    load_rules,
+)
+from benchmarks.synthetic import make_messages, make_rules
+from tests.test_rules import SAMPLE_CONDITIONS, SAMPLE_EMAILS, make_email
+
+NOW = datetime(2024, 6, 1, 12, 0)
+
+
+def _expected(rulesets, emails, stop_flag):
+    compiled = CompiledMatcher(rulesets, NOW)
+    results = []
+    for e in emails:
+        found = list(compiled.iter_matches(e))
+        results.append(found[:1] if stop_flag else found)
+    return results
+
+
+@pytest.mark.parametrize("stop_flag", [False, True])
+def test_columnar_matcher_agrees_with_compiled(tmp_path, stop_flag):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps(make_rules(200, seed=4)))
+    rulesets = load_rules(str(rules_file))
+    emails = [Email(**parse_message(m)) for m in make_messages(300, 4, now=NOW)]
+    emails += SAMPLE_EMAILS
+    # exactly on a cutoff, and without a date at all
+    emails.append(make_email(id="edge", received=date_cutoff("LessThanDays", 7, NOW)))
+    emails.append(make_email(id="undated"))
+    emails[-1].received_at = None
+
+    matcher = ColumnarMatcher(rulesets, NOW)
+    assert matcher.match_batch(emails, stop_flag) == _expected(
+        rulesets, emails, stop_flag
+    )
+
+
+@pytest.mark.parametrize("predicate", ["All", "Any"])
+def test_columnar_matcher_agrees_on_sample_conditions(predicate):
+    rng = random.Random(5)
+    rulesets = [
+        RuleSet(predicate, rng.sample(SAMPLE_CONDITIONS, rng.randint(0, 4)), [])
+        for _ in range(40)
+    ]
+    matcher = ColumnarMatcher(rulesets, NOW)
+    assert matcher.match_batch(SAMPLE_EMAILS, False) == _expected(
+        rulesets, SAMPLE_EMAILS, False
+    )
+
+
+def test_email_columns_order_rows_by_received_at():
+    emails = [
+        make_email(id="b", received=NOW),
+        make_email(id="none"),
+        make_email(id="a", received=NOW - timedelta(days=1)),
+    ]
+    emails[1].received_at = None
+    cols = EmailColumns(emails)
+
+    assert [e.id for e in cols.rows] == ["a", "b", "none"]
+    assert list(cols.indexes(cols.range_mask(1, 3))) == [1, 2]
+    assert list(cols.indexes(cols.all ^ cols.range_mask(0, 1))) == [1, 2]
+
+
+def test_columnar_matcher_fetches_missing_bodies_only_when_needed():
+    rulesets = [
+        RuleSet("All", [RuleCondition("Subject", "Contains", "hello")], []),
+        RuleSet("Any", [RuleCondition("Message", "Contains", "asap")], []),
+    ]
+    emails = [
+        make_email(id="m1", subject="Hello", body="asap"),
+        make_email(id="m2", subject="Hello"),
+        make_email(id="m3", subject="Bye"),
+    ]
+    emails[1].body = emails[2].body = None
+    fetched = []
+
+    def loader(e):
+        fetched.append(e.id)
+        return "ASAP please"
+
+    matcher = ColumnarMatcher(rulesets, NOW)
+    with lazy_bodies(loader):
+        assert matcher.match_batch(emails, True) == [[0], [0], [1]]
+    # m2 stopped at its first match, before the Message condition
+    assert fetched == ["m3"]
+
+
+def test_process_rules_with_columnar_engine(fake_session):
+    rulesets = [
+        RuleSet(
+            "All",
+            [
+                RuleCondition("Subject", "Contains", "Hello"),
+                RuleCondition("From", "DoesNotContain", "spam"),
+            ],
+            [{"type": "mark_as_read"}],
+        )
+    ]
+    fake_session.add(make_email(id="msg1", subject="Hello World"))
+    fake_session.add(make_email(id="msg2", subject="Hello", sender="spam@x.com"))
+
+    assert process_rules(rulesets, engine="columnar") == 1
+    assert fake_session.get(Email, "msg1").is_read is True
+    assert fake_session.get(Email, "msg2").is_read is False
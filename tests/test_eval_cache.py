@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from app import db, metrics
+from app.eval_cache import EvaluationCache, email_hash, rule_fingerprint
+from app.fetch_emails import parse_message
+from app.models import Email, RuleEvaluation
+from app.process_rules import process_rules
+from app.rules_engine import RuleCondition, RuleSet, date_flip_time
+from tests.conftest import _store
+from tests.test_rules import make_email
+
+NOW = datetime(2024, 6, 15, 12, 0)
+
+
+def _rules(value="invoice", label="Bills"):
+    return [
+        RuleSet(
+            "All",
+            [RuleCondition("Subject", "Contains", value)],
+            [{"type": "move_message", "label": label}],
+        )
+    ]
+
+
+def _evaluations():
+    session = db.get_session()
+    try:
+        return session.scalars(select(RuleEvaluation)).all()
+    finally:
+        session.close()
+
+
+def test_date_flip_times():
+    received = NOW - timedelta(days=3, hours=2)
+
+    def flip(predicate, value):
+        return date_flip_time(
+            RuleCondition("Received", predicate, value), received, NOW
+        )
+
+    # holds until received + 5 days, then never again
+    assert flip("LessThanDays", 5) == received + timedelta(days=5)
+    assert flip("LessThanDays", 2) is None
+    # (now - received).days > 5 from received + 6 days on
+    assert flip("GreaterThanDays", 5) == received + timedelta(days=6)
+    assert flip("GreaterThanDays", 2) is None
+    assert flip("LessThanMonths", 1) == datetime(2024, 7, 12, 10, 0)
+    assert flip("GreaterThanMonths", 1) == datetime(2024, 7, 12, 10, 0)
+
+
+def test_unfetched_body_changes_the_hash():
+    date = {"name": "Date", "value": "Mon, 01 Jan 2024 10:00:00 +0000"}
+    msg = {"id": "m1", "snippet": "s", "payload": {"headers": [date]}}
+    full = parse_message(msg)
+    metadata = parse_message(msg, with_body=False)
+    assert full["content_hash"] != metadata["content_hash"]
+    assert full["content_hash"] == parse_message(msg)["content_hash"]
+
+
+def test_second_run_only_evaluates_the_delta(sqlite_db, gmail_calls):
+    _store(
+        [
+            make_email(id="m1", subject="invoice 1"),
+            make_email(id="m2", subject="hello"),
+        ]
+    )
+    metrics.enable()
+    try:
+        assert process_rules(_rules(), pushdown=False, use_cache=True) == 1
+        assert len(_evaluations()) == 2
+
+        metrics.reset()
+        assert process_rules(_rules(), pushdown=False, use_cache=True) == 0
+        assert metrics.counter("eval_cache_misses") == 0
+        assert metrics.counter("eval_cache_hits") == 0
+        assert len(gmail_calls["batch_modify"]) == 1
+
+        # a new email is the only one evaluated
+        _store([make_email(id="m3", subject="invoice 3")])
+        metrics.reset()
+        assert process_rules(_rules(), pushdown=False, use_cache=True) == 1
+        assert metrics.counter("eval_cache_misses") == 1
+        assert gmail_calls["batch_modify"][-1][0] == ["m3"]
+
+        # an edited rule is a new fingerprint
+        metrics.reset()
+        process_rules(_rules(value="hello"), pushdown=False, use_cache=True)
+        assert metrics.counter("eval_cache_misses") == 3
+        assert gmail_calls["batch_modify"][-1][0] == ["m2"]
+    finally:
+        metrics.enable(False)
+        metrics.reset()
+
+
+def test_shadowed_match_is_applied_once_allowed(sqlite_db, gmail_calls):
+    _store([make_email(id="m1", subject="invoice")])
+    rulesets = _rules() + _rules(label="Other")
+
+    process_rules(rulesets, stop_after_first_match=True, use_cache=True)
+    assert [add for _, add, _ in gmail_calls["batch_modify"]] == [["Label_Bills"]]
+
+    process_rules(rulesets, stop_after_first_match=True, use_cache=True)
+    assert len(gmail_calls["batch_modify"]) == 1
+
+    process_rules(rulesets, stop_after_first_match=False, use_cache=True)
+    assert [add for _, add, _ in gmail_calls["batch_modify"]][-1] == ["Label_Other"]
+
+
+def test_shadowed_match_does_not_keep_the_email_stale(sqlite_db, gmail_calls):
+    _store([make_email(id="m1", subject="invoice"), make_email(id="m2")])
+    rulesets = _rules() + _rules(label="Other")
+    process_rules(rulesets, stop_after_first_match=True, use_cache=True)
+
+    metrics.enable()
+    try:
+        assert process_rules(rulesets, stop_after_first_match=True, use_cache=True) == 0
+        # no email was loaded, so none was looked up in the cache
+        assert metrics.counter("eval_cache_hits") == 0
+        assert metrics.counter("eval_cache_misses") == 0
+    finally:
+        metrics.enable(False)
+        metrics.reset()
+    assert len(gmail_calls["batch_modify"]) == 1
+
+
+def test_date_results_expire(sqlite_db):
+    email = make_email(id="m1", received=NOW - timedelta(days=2))
+    email.content_hash = email_hash(email)
+    _store([email])
+    rulesets = [RuleSet("All", [RuleCondition("Received", "LessThanDays", 7)], [])]
+    session = db.get_session()
+    try:
+        cache = EvaluationCache(rulesets, now=NOW)
+        (stored,) = session.scalars(select(Email).where(cache.stale_clause())).all()
+        cache.load(session, [stored])
+        cache.select(stored, _Always(), stop_flag=False)
+        cache.write(session)
+        session.commit()
+
+        (row,) = _evaluations()
+        assert row.rule_fingerprint == rule_fingerprint(rulesets[0])
+        assert row.valid_until == NOW - timedelta(days=2) + timedelta(days=7)
+
+        def stale(now):
+            clause = EvaluationCache(rulesets, now=now).stale_clause()
+            return session.scalars(select(Email.id).where(clause)).all()
+
+        assert stale(NOW + timedelta(days=4)) == []
+        assert stale(NOW + timedelta(days=5)) == ["m1"]
+    finally:
+        session.close()
+
+
+class _Always:
+    def iter_matches(self, email):
+        yield 0
@@ -0,0 +1,441 @@
+import base64
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+
+from app import db, fetch_emails, gmail_client, ratelimit
+from app.rules_engine import RuleCondition, RuleSet
+from app.models import Email, SyncState
+from tests.conftest import FakeSession
+
+
+# Compiles statements for PostgreSQL; never connects
+postgresql_engine = create_engine("postgresql+psycopg2://")
+
+
+class SyncFakeSession(FakeSession):
+    def __init__(self):
+        super().__init__()
+        self.sync_state = {}
+
+    def add(self, obj):
+        if isinstance(obj, SyncState):
+            self.sync_state[obj.user_id] = obj
+        else:
+            super().add(obj)
+
+    def get(self, model, pk):
+        if model is SyncState:
+            return self.sync_state.get(pk)
+        return super().get(model, pk)
+
+    def delete(self, obj):
+        self.storage.pop(obj.id, None)
+
+
+# -----------------------------
+# Fake Gmail service
+# -----------------------------
+def make_message(id, subject="Hello", body="hi there", labels=("INBOX", "UNREAD")):
+    return {
+        "id": id,
+        "threadId": f"t-{id}",
+        "labelIds": list(labels),
+        "snippet": body[:20],
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": [
+                {"name": "From", "value": "a@b.com"},
+                {"name": "To", "value": "me@x.com"},
+                {"name": "Subject", "value": subject},
+                {"name": "Date", "value": "Mon, 1 Sep 2025 10:00:00 +0000"},
+            ],
+            "body": {"data": base64.urlsafe_b64encode(body.encode()).decode()},
+        },
+    }
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({"status": status}), b"error")
+
+
+class FakeRequest:
+    def __init__(self, service, method, kwargs):
+        self.service = service
+        self.method = method
+        self.kwargs = kwargs
+
+    def execute(self):
+        return self.service.respond(self.method, self.kwargs)
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.batches.append([rid for rid, _ in self.requests])
+        if self.service.batch_failures:
+            raise http_error(self.service.batch_failures.pop(0))
+        for rid, req in self.requests:
+            try:
+                self.callback(rid, req.execute(), None)
+            except HttpError as exc:
+                self.callback(rid, None, exc)
+
+
+class FakeGmailService:
+    def __init__(self, messages):
+        self.messages_by_id = {m["id"]: m for m in messages}
+        self.batches = []
+        self.list_calls = []
+        self.history_id = "100"
+        self.history_pages = []
+        self.history_expired = False
+        self.failures = {}  # message id -> list of statuses to fail with first
+        self.batch_failures = []  # statuses failing whole batch calls first
+        self.get_calls = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, **kwargs):
+        return FakeRequest(self, "messages.get", kwargs)
+
+    def list(self, **kwargs):
+        return FakeRequest(self, "messages.list", kwargs)
+
+    def getProfile(self, **kwargs):
+        return FakeRequest(self, "getProfile", kwargs)
+
+    def history(self):
+        service = self
+
+        class History:
+            def list(self, **kwargs):
+                return FakeRequest(service, "history.list", kwargs)
+
+        return History()
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def respond(self, method, kwargs):
+        if method == "getProfile":
+            return {"historyId": self.history_id}
+        if method == "history.list":
+            if self.history_expired:
+                raise http_error(404)
+            index = int(kwargs.get("pageToken", 0))
+            page = dict(self.history_pages[index], historyId=self.history_id)
+            if index + 1 < len(self.history_pages):
+                page["nextPageToken"] = str(index + 1)
+            return page
+        if method == "messages.list":
+            self.list_calls.append(kwargs)
+            start = int(kwargs.get("pageToken", 0))
+            end = start + kwargs["maxResults"]
+            ids = list(self.messages_by_id)[start:end]
+            res = {"messages": [{"id": i} for i in ids]}
+            if end < len(self.messages_by_id):
+                res["nextPageToken"] = str(end)
+            return res
+        self.get_calls.append(kwargs)
+        pending = self.failures.get(kwargs["id"])
+        if pending:
+            raise http_error(pending.pop(0))
+        if kwargs["id"] not in self.messages_by_id:
+            raise http_error(404)
+        return self.messages_by_id[kwargs["id"]]
+
+
+# -----------------------------
+# Fixtures
+# -----------------------------
+@pytest.fixture
+def fake_service(monkeypatch):
+    service = FakeGmailService([make_message(f"m{i}") for i in range(7)])
+    monkeypatch.setattr(gmail_client, "get_service", lambda: service)
+    monkeypatch.setattr(gmail_client, "_wait", lambda seconds: None)
+    return service
+
+
+@pytest.fixture
+def fake_session(monkeypatch):
+    fs = SyncFakeSession()
+
+    def fake_upsert(session, rows):
+        inserted = sum(1 for row in rows if row["id"] not in session.storage)
+        for row in rows:
+            session.add(Email(**row))
+        return inserted, len(rows) - inserted
+
+    monkeypatch.setattr(fetch_emails, "get_session", lambda: fs)
+    monkeypatch.setattr(fetch_emails, "upsert_emails", fake_upsert)
+    return fs
+
+
+# -----------------------------
+# Tests
+# -----------------------------
+def test_iter_message_batches_chunks_and_preserves_order(fake_service):
+    ids = [f"m{i}" for i in range(7)]
+    batches = list(gmail_client.iter_message_batches(ids, batch_size=3))
+
+    assert [len(b) for b in batches] == [3, 3, 1]
+    assert [m["id"] for b in batches for m in b] == ids
+    assert fake_service.batches == [["m0", "m1", "m2"], ["m3", "m4", "m5"], ["m6"]]
+
+
+def test_iter_message_batches_retries_only_failed_items(fake_service):
+    fake_service.failures = {"m1": [429, 503]}
+    batches = list(gmail_client.iter_message_batches(["m0", "m1", "m2"], batch_size=3))
+
+    assert [m["id"] for m in batches[0]] == ["m0", "m1", "m2"]
+    assert fake_service.batches == [["m0", "m1", "m2"], ["m1"], ["m1"]]
+
+
+def test_iter_message_batches_retries_a_refused_batch(fake_service):
+    fake_service.batch_failures = [429]
+    scheduler = ratelimit.get_scheduler()
+
+    batches = list(gmail_client.iter_message_batches(["m0", "m1"], batch_size=3))
+
+    assert [m["id"] for m in batches[0]] == ["m0", "m1"]
+    assert fake_service.batches == [["m0", "m1"], ["m0", "m1"]]
+    assert scheduler.stats.throttled == 1
+    assert scheduler.rate < scheduler.max_rate
+
+
+def test_iter_message_batches_raises_non_retryable(fake_service):
+    fake_service.failures = {"m0": [404]}
+    with pytest.raises(HttpError):
+        list(gmail_client.iter_message_batches(["m0"], batch_size=3))
+
+
+def test_iter_message_batches_gives_up_after_max_retries(fake_service):
+    fake_service.failures = {"m0": [500, 500, 500]}
+    with pytest.raises(HttpError):
+        list(gmail_client.iter_message_batches(["m0"], batch_size=3, max_retries=2))
+
+
+def test_fetch_and_store_commits_per_chunk(fake_service, fake_session, monkeypatch):
+    monkeypatch.setattr(fetch_emails.settings, "UPSERT_CHUNK_SIZE", 2)
+    commits = []
+    monkeypatch.setattr(
+        fake_session, "commit", lambda: commits.append(len(fake_session.storage))
+    )
+
+    stats = fetch_emails.fetch_and_store(max_results=5, batch_size=2)
+
+    assert (stats.fetched, stats.inserted, stats.updated) == (5, 5, 0)
+    assert commits == [2, 4, 5]
+    stored = fake_session.get(Email, "m0")
+    assert stored.subject == "Hello"
+    assert stored.body == "hi there"
+    assert stored.is_read is False
+
+
+def test_iter_messages_follows_page_tokens(fake_service):
+    ids = [
+        m["id"]
+        for m in gmail_client.iter_messages(
+            label_ids=["INBOX"], query="is:unread", page_size=3
+        )
+    ]
+
+    assert ids == [f"m{i}" for i in range(7)]
+    assert [c.get("pageToken") for c in fake_service.list_calls] == [None, "3", "6"]
+    assert all(c["q"] == "is:unread" for c in fake_service.list_calls)
+    assert all(c["labelIds"] == ["INBOX"] for c in fake_service.list_calls)
+
+
+def test_iter_messages_stops_at_max_results(fake_service):
+    ids = [m["id"] for m in gmail_client.iter_messages(max_results=4, page_size=3)]
+
+    assert ids == ["m0", "m1", "m2", "m3"]
+    assert [c["maxResults"] for c in fake_service.list_calls] == [3, 1]
+    assert "labelIds" in fake_service.list_calls[0]
+
+
+def test_fetch_and_store_all_pages(fake_service, fake_session):
+    stats = fetch_emails.fetch_and_store(max_results=None, batch_size=3, label_ids=None)
+
+    assert stats.fetched == 7
+    assert len(fake_session.storage) == 7
+    assert "labelIds" not in fake_service.list_calls[0]
+
+
+def test_fetch_and_store_propagates_fetch_errors(
+    fake_service, fake_session, monkeypatch
+):
+    monkeypatch.setattr(fetch_emails.settings, "UPSERT_CHUNK_SIZE", 2)
+    fake_service.failures = {"m4": [404]}
+    with pytest.raises(HttpError):
+        fetch_emails.fetch_and_store(max_results=None, batch_size=2)
+
+    # Batches before the failing one were committed
+    assert sorted(fake_session.storage) == ["m0", "m1", "m2", "m3"]
+
+
+def history_message(id, labels):
+    return {"message": {"id": id, "labelIds": labels}}
+
+
+def test_sync_incremental_without_checkpoint_does_full_resync(
+    fake_service, fake_session
+):
+    stats = fetch_emails.sync_incremental(batch_size=3)
+
+    assert stats.full_resync is True
+    assert stats.fetched == 7
+    assert fake_session.sync_state["me"].history_id == "100"
+
+
+def test_sync_incremental_applies_history(fake_service, fake_session):
+    fetch_emails.sync_incremental(batch_size=3)
+    fake_service.batches.clear()
+    fake_service.messages_by_id["new1"] = make_message("new1", subject="Fresh")
+    fake_service.history_id = "150"
+    fake_service.history_pages = [
+        {"history": [{"messagesAdded": [history_message("new1", ["INBOX"])]}]},
+        {
+            "history": [
+                {"messagesAdded": [history_message("sent1", ["SENT"])]},
+                {"labelsRemoved": [history_message("m0", ["INBOX"])]},
+                {"messagesDeleted": [history_message("m1", [])]},
+                {"messagesAdded": [history_message("gone", ["INBOX"])]},
+            ]
+        },
+    ]
+
+    stats = fetch_emails.sync_incremental(batch_size=3)
+
+    assert stats.full_resync is False
+    assert (stats.fetched, stats.relabelled, stats.deleted) == (1, 1, 1)
+    assert stats.new_ids == ["new1", "gone"]
+    # Only the added INBOX messages were fetched; "gone" 404s and is skipped
+    assert fake_service.batches == [["new1", "gone"]]
+    assert fake_session.get(Email, "new1").subject == "Fresh"
+    assert fake_session.get(Email, "m0").is_read is True
+    assert fake_session.get(Email, "m1") is None
+    assert fake_session.sync_state["me"].history_id == "150"
+
+
+def test_sync_incremental_falls_back_when_history_expired(fake_service, fake_session):
+    fake_session.add(SyncState(user_id="me", history_id="1"))
+    fake_service.history_expired = True
+
+    stats = fetch_emails.sync_incremental(batch_size=3)
+
+    assert stats.full_resync is True
+    assert stats.fetched == 7
+    assert fake_session.sync_state["me"].history_id == "100"
+
+
+def test_fetch_and_store_reports_inserted_and_updated(fake_service, fake_session):
+    fetch_emails.fetch_and_store(max_results=3, batch_size=3)
+    stats = fetch_emails.fetch_and_store(max_results=5, batch_size=3)
+
+    assert (stats.fetched, stats.inserted, stats.updated) == (5, 2, 3)
+
+
+class CapturingSession:
+    def __init__(self, flags):
+        self.flags = flags
+        self.statements = []
+
+    def get_bind(self):
+        return postgresql_engine
+
+    def execute(self, stmt):
+        self.statements.append(stmt)
+        flags = self.flags
+
+        class Result:
+            def scalars(self):
+                return self
+
+            def all(self):
+                return flags
+
+        return Result()
+
+
+def test_upsert_emails_issues_one_on_conflict_statement():
+    rows = [fetch_emails.parse_message(make_message(f"m{i}")) for i in range(3)]
+    rows.append(dict(rows[0], subject="Changed"))
+    session = CapturingSession([True, False, True])
+
+    assert fetch_emails.upsert_emails(session, rows) == (2, 1)
+
+    assert len(session.statements) == 1
+    sql = str(session.statements[0].compile(dialect=postgresql.dialect()))
+    assert "ON CONFLICT (id) DO UPDATE SET" in sql
+    assert "RETURNING xmax = 0" in sql
+    # a metadata-only refetch (NULL body) keeps the stored body
+    fetched = "excluded.body IS NOT NULL OR excluded.body_z IS NOT NULL"
+    assert f"body = CASE WHEN ({fetched}) THEN excluded.body ELSE emails.body" in sql
+    assert f"body_z = CASE WHEN ({fetched}) THEN excluded.body_z" in sql
+    # Duplicate ids are collapsed, keeping the last version
+    params = session.statements[0].compile(dialect=postgresql.dialect()).params
+    assert params["subject_m0"] == "Changed"
+    assert "id_m3" not in params
+
+
+def test_upsert_emails_on_sqlite(sqlite_db):
+    session = db.get_session()
+    rows = [fetch_emails.parse_message(make_message(f"m{i}")) for i in range(2)]
+    assert fetch_emails.upsert_emails(session, rows) == (2, 0)
+    session.commit()
+
+    refetched = fetch_emails.parse_message(make_message("m0"), with_body=False)
+    new = fetch_emails.parse_message(make_message("m2", subject="New"))
+    assert fetch_emails.upsert_emails(session, [refetched, new]) == (1, 1)
+    session.commit()
+
+    stored = session.get(Email, "m0")
+    assert stored.body == "hi there"
+    assert stored.content_hash == rows[0]["content_hash"]
+    assert stored.labels == {"ids": ["INBOX", "UNREAD"]}
+    session.close()
+
+
+def test_upsert_emails_skips_empty_chunk():
+    session = CapturingSession([])
+    assert fetch_emails.upsert_emails(session, []) == (0, 0)
+    assert session.statements == []
+
+
+def test_choose_format_needs_body_only_for_message_rules():
+    headers_only = [RuleSet("All", [RuleCondition("From", "Contains", "a")], [])]
+    with_body = headers_only + [
+        RuleSet("Any", [RuleCondition("message", "Contains", "b")], [])
+    ]
+
+    assert fetch_emails.choose_format(headers_only) == "metadata"
+    assert fetch_emails.choose_format(with_body) == "full"
+
+
+def test_fetch_metadata_format_skips_bodies(fake_service, fake_session):
+    stats = fetch_emails.fetch_and_store(max_results=3, batch_size=3, fmt="metadata")
+
+    assert stats.fetched == 3
+    call = fake_service.get_calls[0]
+    assert call["format"] == "metadata"
+    assert call["metadataHeaders"] == ["From", "To", "Subject", "Date"]
+    assert "payload/headers" in call["fields"]
+    stored = fake_session.get(Email, "m0")
+    assert stored.subject == "Hello"
+    assert stored.body is None
@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+
+from app import gmail_client
+
+
+class FakeCredentials:
+    def __init__(self):
+        self.valid = True
+        self.refresh_token = "refresh"
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.valid = True
+
+    def to_json(self):
+        return "{}"
+
+
+class FakeService:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    loads = []
+    creds = FakeCredentials()
+
+    def fake_get_credentials():
+        loads.append(1)
+        return creds
+
+    monkeypatch.setattr(gmail_client, "get_credentials", fake_get_credentials)
+    monkeypatch.setattr(gmail_client, "build", lambda *a, **kw: FakeService())
+    monkeypatch.setattr(
+        gmail_client.settings, "GMAIL_TOKEN_PATH", str(tmp_path / "token.json")
+    )
+    gmail_client.close_client()
+    yield creds, loads
+    gmail_client.close_client()
+
+
+def test_service_is_built_once_per_thread(client):
+    creds, loads = client
+    first = gmail_client.get_service()
+
+    assert gmail_client.get_service() is first
+    assert len(loads) == 1
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(gmail_client.get_service()))
+    t.start()
+    t.join()
+
+    assert other[0] is not first
+    # Credentials are shared across threads
+    assert len(loads) == 1
+
+
+def test_expired_credentials_are_refreshed_not_reloaded(client):
+    creds, loads = client
+    gmail_client.get_service()
+    creds.valid = False
+
+    gmail_client.get_service()
+
+    assert creds.refreshes == 1
+    assert len(loads) == 1
+
+
+def test_client_session_closes_services(client):
+    creds, loads = client
+    with gmail_client.client_session() as service:
+        assert gmail_client.get_service() is service
+
+    assert service.closed is True
+    assert gmail_client.get_service() is not service
+    assert len(loads) == 2
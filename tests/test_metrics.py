@@ -0,0 +1,108 @@
+import pytest
+
+from app import gmail_client, metrics
+from app.config import settings
+from app.process_rules import process_rules
+from app.rules_engine import RuleCondition, RuleSet
+from tests.conftest import _store
+from tests.test_rules import make_email
+
+
+@pytest.fixture
+def profiling():
+    metrics.reset()
+    metrics.enable()
+    yield
+    metrics.enable(False)
+    metrics.reset()
+
+
+def test_disabled_metrics_record_nothing():
+    metrics.reset()
+    metrics.incr("emails_scanned", 3)
+    with metrics.span("process.match"):
+        pass
+    assert metrics.snapshot() == {"counters": {}, "spans": {}}
+
+
+def test_counters_spans_and_merge(profiling):
+    metrics.incr("gmail_api_calls", method="messages.get")
+    metrics.incr("gmail_api_calls", 2, method="messages.get")
+    with metrics.span("db.upsert"):
+        pass
+    worker = {
+        "counters": {("gmail_api_calls", (("method", "messages.get"),)): 4},
+        "spans": {"db.upsert": [2, 0.5]},
+    }
+    metrics.merge(worker)
+
+    assert metrics.counter("gmail_api_calls", method="messages.get") == 7
+    calls, seconds = metrics.snapshot()["spans"]["db.upsert"]
+    assert calls == 3 and seconds >= 0.5
+    assert any(line.startswith("db.upsert") for line in metrics.report())
+
+
+def test_prometheus_textfile(profiling, tmp_path):
+    metrics.incr("emails_upserted", 5, result="inserted")
+    metrics.incr("rule_matches", ruleset='say "hi"')
+    with metrics.span("fetch.parse"):
+        pass
+    path = tmp_path / "mailhelper.prom"
+
+    metrics.write_textfile(str(path))
+
+    text = path.read_text()
+    assert "# TYPE mailhelper_emails_upserted_total counter" in text
+    assert 'mailhelper_emails_upserted_total{result="inserted"} 5' in text
+    assert 'mailhelper_rule_matches_total{ruleset="say \\"hi\\""} 1' in text
+    assert 'mailhelper_stage_calls_total{stage="fetch.parse"} 1' in text
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_execute_counts_calls(profiling):
+    class Request:
+        def execute(self):
+            return {}
+
+    gmail_client.execute(Request(), "labels.list")
+
+    assert metrics.counter("gmail_api_calls", method="labels.list") == 1
+    assert metrics.snapshot()["spans"]["gmail.http"][0] == 1
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_process_rules_counts_matches(profiling, sqlite_db, monkeypatch, workers):
+    monkeypatch.setattr(settings, "PROCESS_CHUNK_SIZE", 2)
+    _store(
+        [
+            make_email(id="m1", subject="invoice", sender="a@bank.com"),
+            make_email(id="m2", subject="invoice", sender="b@shop.com"),
+            make_email(id="m3", subject="hello", sender="a@bank.com"),
+        ]
+    )
+    rulesets = [
+        RuleSet(
+            "All",
+            [
+                RuleCondition("Subject", "Contains", "invoice"),
+                RuleCondition("From", "Contains", "bank"),
+            ],
+            [{"type": "mark_as_read"}],
+        ),
+        RuleSet(
+            "Any",
+            [RuleCondition("From", "Contains", "bank")],
+            [{"type": "mark_as_read"}],
+        ),
+    ]
+
+    process_rules(
+        rulesets, stop_after_first_match=False, pushdown=False, workers=workers
+    )
+
+    assert metrics.counter("emails_scanned") == 3
+    assert metrics.counter("rule_matches", ruleset="1") == 1
+    assert metrics.counter("rule_matches", ruleset="2") == 2
+    # ruleset 1: 2 + 2 + 1 (short-circuit on m3), ruleset 2: 3
+    assert metrics.counter("rule_conditions_evaluated") == 8
+    assert "actions.apply" in metrics.snapshot()["spans"]
@@ -0,0 +1,112 @@
+import random
+
+import pytest
+
+from app import multimatch
+from app.multimatch import AhoCorasick, IndexedMatcher, SubstringScan, field_scanner
+from app.process_rules import process_rules
+from app.rules_engine import CompiledMatcher, RuleCondition, RuleSet, load_rules
+from app.models import Email
+from tests.test_rules import SAMPLE_CONDITIONS, SAMPLE_EMAILS, make_email
+
+
+def test_aho_corasick_finds_overlapping_patterns():
+    ac = AhoCorasick(["he", "she", "his", "hers", "", "xyz", "he"])
+    found = {ac.patterns[i] for i in ac.find_all("ushers")}
+
+    assert found == {"he", "she", "hers", ""}
+    assert len(ac.patterns) == 6  # duplicates share one id
+
+
+def test_aho_corasick_agrees_with_substring_search():
+    rng = random.Random(7)
+    patterns = ["".join(rng.choices("abc", k=rng.randint(1, 4))) for _ in range(40)]
+    ac = AhoCorasick(patterns)
+    for _ in range(200):
+        text = "".join(rng.choices("abcd", k=rng.randint(0, 30)))
+        expected = {p for p in patterns if p in text}
+        assert {ac.patterns[i] for i in ac.find_all(text)} == expected
+
+
+def test_few_patterns_are_scanned_without_the_automaton(monkeypatch):
+    monkeypatch.setattr(multimatch, "DEFAULT_AUTOMATON_MIN_PATTERNS", 4)
+    monkeypatch.setattr(multimatch, "AUTOMATON_MIN_PATTERNS", {"message": 5})
+    few = field_scanner("subject", ["he", "she", "he", ""])
+
+    assert isinstance(few, SubstringScan)
+    assert {few.patterns[i] for i in few.find_all("ushers")} == {"he", "she", ""}
+    assert few.pattern_id("he") == 0 and len(few.patterns) == 3
+    assert isinstance(field_scanner("subject", list("abcd")), AhoCorasick)
+    assert isinstance(field_scanner("message", list("abcd")), SubstringScan)
+
+
+@pytest.mark.parametrize("automaton", [False, True])
+@pytest.mark.parametrize("predicate", ["All", "Any"])
+def test_indexed_matcher_agrees_with_compiled(predicate, automaton, monkeypatch):
+    if automaton:
+        monkeypatch.setattr(multimatch, "DEFAULT_AUTOMATON_MIN_PATTERNS", 0)
+        monkeypatch.setattr(multimatch, "AUTOMATON_MIN_PATTERNS", {})
+    rng = random.Random(3)
+    rulesets = [
+        RuleSet(
+            predicate=predicate,
+            rules=rng.sample(SAMPLE_CONDITIONS, rng.randint(1, 4))
+            + [RuleCondition("Subject", "Contains", "")],
+            actions=[],
+        )
+        for _ in range(30)
+    ]
+    indexed = IndexedMatcher(rulesets)
+    compiled = CompiledMatcher(rulesets)
+    for e in SAMPLE_EMAILS:
+        assert list(indexed.iter_matches(e)) == list(compiled.iter_matches(e))
+    scanner = AhoCorasick if automaton else SubstringScan
+    assert all(isinstance(a, scanner) for a in indexed.automata.values())
+
+
+def test_indexed_matcher_scans_each_field_once(monkeypatch):
+    rulesets = [
+        RuleSet("All", [RuleCondition("Subject", "Contains", t)], [])
+        for t in ["hel", "llo", "bye", "HELLO"]
+    ]
+    matcher = IndexedMatcher(rulesets)
+    scans = []
+    automaton = matcher.automata["subject"]
+    original = automaton.find_all
+    monkeypatch.setattr(
+        automaton, "find_all", lambda text: scans.append(text) or original(text)
+    )
+
+    assert list(matcher.iter_matches(make_email(subject="Hello"))) == [0, 1, 3]
+    assert scans == ["hello"]
+
+
+def test_process_rules_with_indexed_engine(tmp_path, fake_session):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(
+        """
+    [
+      {
+        "predicate": "All",
+        "rules": [
+          { "field": "Subject", "predicate": "Contains", "value": "Hello" },
+          { "field": "From", "predicate": "DoesNotContain", "value": "spam" }
+        ],
+        "actions": [{ "type": "mark_as_read" }]
+      }
+    ]
+    """
+    )
+    fake_session.add(make_email(id="msg1", subject="Hello World"))
+    fake_session.add(make_email(id="msg2", subject="Hello", sender="spam@x.com"))
+
+    matched = process_rules(load_rules(str(rules_file)), engine="indexed")
+
+    assert matched == 1
+    assert fake_session.get(Email, "msg1").is_read is True
+    assert fake_session.get(Email, "msg2").is_read is False
+
+
+def test_process_rules_rejects_unknown_engine():
+    with pytest.raises(ValueError, match="Unknown match engine"):
+        process_rules([], engine="regex")
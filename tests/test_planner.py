@@ -0,0 +1,185 @@
+from datetime import datetime, timedelta
+import random
+
+import pytest
+from typer.testing import CliRunner
+
+from app import db
+from app.cli import app
+from app.planner import ColumnStats, PlannedMatcher, gather_stats, plan_rulesets
+from app.rules_engine import CompiledMatcher, RuleCondition, RuleSet
+from tests.test_rules import SAMPLE_CONDITIONS, SAMPLE_EMAILS, make_email
+
+NOW = datetime(2024, 6, 1, 12, 0)
+
+
+def _mailbox(n=60):
+    rng = random.Random(2)
+    senders = ["billing@bank.com"] * 5 + ["alice@x.com", "bob@y.com", "noreply@z.com"]
+    return [
+        make_email(
+            id=f"m{i}",
+            subject=rng.choice(["invoice", "hello", "urgent: pay", ""]),
+            body=rng.choice(["pay asap", "weekly digest " * 50, ""]),
+            sender=rng.choice(senders),
+            received=NOW - timedelta(days=rng.randint(0, 200)),
+        )
+        for i in range(n)
+    ]
+
+
+def _store(emails):
+    session = db.get_session()
+    session.add_all(emails)
+    session.commit()
+    session.close()
+
+
+def test_gather_stats(sqlite_db):
+    _store(_mailbox())
+    session = db.get_session()
+    try:
+        stats = gather_stats(session, sample_size=40)
+    finally:
+        session.close()
+
+    assert stats.rows == 60
+    assert len(stats.sample) == 40
+    frm = stats.fields["from"]
+    assert frm.n_distinct == 4
+    assert max(frm.mcv, key=frm.mcv.get) == "billing@bank.com"
+    assert stats.fields["message"].avg_length > stats.fields["subject"].avg_length
+
+
+def test_conditions_ordered_by_cost_and_selectivity():
+    emails = _mailbox()
+    stats = ColumnStats.from_sample(len(emails), emails)
+    rs = RuleSet(
+        "All",
+        [
+            RuleCondition("Message", "Contains", "digest"),
+            RuleCondition("Subject", "Contains", "invoice"),
+            RuleCondition("Received", "LessThanDays", 30),
+        ],
+        [],
+    )
+
+    (plan,) = plan_rulesets([rs], stats, NOW)
+    order = [c.cond.field for c in plan.conditions]
+    assert order == ["Received", "Subject", "Message"]
+
+
+def test_equals_hash_index_skips_other_rulesets():
+    rulesets = [
+        RuleSet(
+            "All",
+            [
+                RuleCondition("Message", "Contains", "asap"),
+                RuleCondition("From", "Equals", "Billing@Bank.com"),
+            ],
+            [],
+        ),
+        RuleSet(
+            "Any",
+            [
+                RuleCondition("From", "Equals", "alice@x.com"),
+                RuleCondition("Subject", "Equals", "hello"),
+            ],
+            [],
+        ),
+        RuleSet("Any", [RuleCondition("Subject", "Contains", "urgent")], []),
+    ]
+    matcher = PlannedMatcher(rulesets, NOW)
+
+    assert matcher.plans[0].index_keys == [("from", "billing@bank.com")]
+    assert matcher.plans[1].index_keys == [
+        ("from", "alice@x.com"),
+        ("subject", "hello"),
+    ]
+    assert matcher.always == [2]
+    assert matcher.candidates(make_email(sender="bob@y.com", subject="x")) == [2]
+    assert matcher.candidates(make_email(sender="billing@bank.com", subject="x")) == [
+        0,
+        2,
+    ]
+    assert matcher.candidates(make_email(sender="x", subject="Hello")) == [1, 2]
+
+
+def test_message_is_never_an_index_key():
+    rulesets = [
+        RuleSet(
+            "All",
+            [
+                RuleCondition("Message", "Equals", "pay asap"),
+                RuleCondition("Subject", "Equals", "invoice"),
+            ],
+            [],
+        ),
+        RuleSet(
+            "All",
+            [
+                RuleCondition("Message", "Equals", "pay asap"),
+                RuleCondition("Received", "LessThanDays", 7),
+            ],
+            [],
+        ),
+        RuleSet(
+            "Any",
+            [
+                RuleCondition("Message", "Equals", "pay asap"),
+                RuleCondition("From", "Equals", "alice@x.com"),
+            ],
+            [],
+        ),
+    ]
+    matcher = PlannedMatcher(rulesets, NOW)
+
+    assert matcher.plans[0].index_keys == [("subject", "invoice")]
+    assert matcher.always == [1, 2]
+    assert "message" not in matcher.index
+    assert [c.cond.field for c in matcher.plans[1].conditions] == [
+        "Received",
+        "Message",
+    ]
+
+
+@pytest.mark.parametrize("with_stats", [False, True])
+@pytest.mark.parametrize("predicate", ["All", "Any"])
+def test_planned_matcher_agrees_with_compiled(predicate, with_stats):
+    rng = random.Random(9)
+    conditions = SAMPLE_CONDITIONS + [
+        RuleCondition("From", "Equals", "billing@bank.com"),
+        RuleCondition("From", "Equals", "a@b.com"),
+        RuleCondition("Subject", "Equals", "hello"),
+    ]
+    rulesets = [
+        RuleSet(predicate, rng.sample(conditions, rng.randint(0, 4)), [])
+        for _ in range(60)
+    ]
+    emails = _mailbox() + SAMPLE_EMAILS
+    stats = ColumnStats.from_sample(len(emails), emails) if with_stats else None
+
+    planned = PlannedMatcher(rulesets, NOW, stats)
+    compiled = CompiledMatcher(rulesets, NOW)
+    for e in emails:
+        assert list(planned.iter_matches(e)) == list(compiled.iter_matches(e))
+
+
+def test_process_plan_dump(sqlite_db, tmp_path):
+    _store(_mailbox())
+    rules = tmp_path / "rules.json"
+    rules.write_text(
+        """[{"predicate": "All", "rules": [
+            {"field": "Message", "predicate": "Contains", "value": "asap"},
+            {"field": "From", "predicate": "Equals", "value": "billing@bank.com"}
+        ], "actions": []}]"""
+    )
+
+    result = CliRunner().invoke(app, ["process", "--rules-path", str(rules), "--plan"])
+
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[1] == "Statistics from 60 of 60 emails"
+    assert lines[2] == "#1 All: index probe from = 'billing@bank.com'"
+    assert lines[3].startswith("    From Equals 'billing@bank.com': selectivity 0.")
+    assert lines[4].startswith("    Message Contains 'asap'")
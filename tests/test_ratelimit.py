@@ -0,0 +1,115 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from app import gmail_client, ratelimit
+from app.ratelimit import QuotaScheduler, get_scheduler, retry_after_seconds
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(ratelimit.random, "uniform", lambda a, b: b)
+
+
+def test_reserve_paces_by_quota_units():
+    clock = Clock()
+    scheduler = QuotaScheduler(units_per_second=100, clock=clock)
+
+    waits = [scheduler.reserve("messages.batchModify") for _ in range(3)]
+
+    # one second of burst covers two batchModify calls (50 units each)
+    assert waits == [0.0, 0.0, 0.5]
+    clock.now = 2.0
+    assert scheduler.reserve("messages.get", count=10) == 0.0
+    assert scheduler.stats.units == 200
+    assert scheduler.stats.calls == {"messages.batchModify": 3, "messages.get": 10}
+    assert scheduler.stats.paced_seconds == 0.5
+
+
+def test_rate_limits_cut_rate_and_successes_restore_it(no_jitter):
+    scheduler = QuotaScheduler(units_per_second=100, min_rate=20, increase=10)
+
+    scheduler.retry_delay(0, 429)
+    assert scheduler.rate == 50
+    scheduler.retry_delay(1, 403, rate_limited=True)
+    scheduler.retry_delay(2, 429)
+    assert scheduler.rate == 20  # floor
+    for _ in range(10):
+        scheduler.on_success()
+    assert scheduler.rate == 100  # ceiling
+    assert (scheduler.stats.throttled, scheduler.stats.retries) == (3, 3)
+
+
+def test_retry_delay_backoff_and_retry_after(no_jitter):
+    scheduler = QuotaScheduler(backoff_base=1, backoff_cap=8)
+
+    assert [scheduler.retry_delay(n, 503) for n in range(5)] == [1, 2, 4, 8, 8]
+    assert scheduler.retry_delay(0, 429, retry_after=30) == 30
+    assert scheduler.retry_delay(0, 404) is None
+    assert scheduler.retry_delay(0, 403) is None
+    assert scheduler.rate == scheduler.max_rate / 2  # only the 429 throttled
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds("3") == 3.0
+    assert retry_after_seconds(None) is None
+    assert retry_after_seconds("soon") is None
+    assert retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+class FlakyRequest:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"ok": True}
+
+
+def http_error(status, content=b"error", headers=None):
+    return HttpError(httplib2.Response({"status": status, **(headers or {})}), content)
+
+
+@pytest.fixture
+def waits(monkeypatch, no_jitter):
+    waited = []
+    monkeypatch.setattr(gmail_client, "_wait", waited.append)
+    return waited
+
+
+def test_execute_retries_rate_limits_and_honors_retry_after(waits):
+    request = FlakyRequest(
+        http_error(429, headers={"retry-after": "7"}),
+        http_error(403, b'{"reason": "userRateLimitExceeded"}'),
+        http_error(503),
+    )
+
+    assert gmail_client.execute(request, "messages.get") == {"ok": True}
+
+    stats = get_scheduler().stats
+    assert request.calls == 4
+    # backoff waits alternate with pacing waits before each attempt
+    assert waits[1::2] == [7, 2, 4]
+    assert stats.backoff_seconds == 13
+    assert (stats.retries, stats.throttled) == (3, 2)
+    assert stats.calls == {"messages.get": 4}
+
+
+def test_execute_raises_non_retryable_and_exhausted_errors(waits):
+    with pytest.raises(HttpError):
+        gmail_client.execute(FlakyRequest(http_error(400)), "messages.modify")
+    request = FlakyRequest(*[http_error(500)] * 3)
+    with pytest.raises(HttpError):
+        gmail_client.execute(request, "messages.list", max_retries=2)
+    assert request.calls == 3
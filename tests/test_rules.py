@@ -1,65 +1,22 @@
 from datetime import datetime, timedelta
+import json
 import pytest
-from app.rules_engine import email_matches, RuleSet, RuleCondition, load_rules
+import typer
+from dateutil.relativedelta import relativedelta
+from app import rules_engine
+from app.cli import parse_now
+from app.rules_engine import (
+    STRING_PREDICATES,
+    CompiledMatcher,
+    email_matches,
+    RuleSet,
+    RuleCondition,
+    load_rules,
+)
 from app.process_rules import process_rules
 from app.models import Email
 
 
-# -----------------------------
-# Fake session for mocking DB
-# -----------------------------
-class FakeSession:
-    def __init__(self):
-        self.storage = {}
-
-    def add(self, obj):
-        self.storage[obj.id] = obj
-
-    def commit(self):
-        # Ensure that the objects in storage reflect their updated state
-        for key, obj in self.storage.items():
-            self.storage[key] = obj
-
-    def close(self):
-        pass
-
-    def get(self, model, pk):
-        return self.storage.get(pk)
-
-    def scalars(self, stmt):
-        class FakeResult:
-            def __init__(self, values):
-                self._values = values
-
-            def all(self):
-                return self._values
-
-        return FakeResult(list(self.storage.values()))
-
-
-# -----------------------------
-# Fixtures
-# -----------------------------
-@pytest.fixture
-def fake_session(monkeypatch):
-    fs = FakeSession()
-    monkeypatch.setattr("app.db.get_session", lambda: fs)
-    return fs
-
-
-@pytest.fixture(autouse=True)
-def mock_gmail(monkeypatch):
-    """Mock Gmail API calls so tests don't hit network."""
-    monkeypatch.setattr("app.rules_engine.modify_message", lambda *a, **kw: None)
-    monkeypatch.setattr(
-        "app.rules_engine.get_labels_map",
-        lambda: {"UNREAD": "lbl_unread", "INBOX": "lbl_inbox"},
-    )
-    monkeypatch.setattr(
-        "app.rules_engine.ensure_label", lambda name: f"lbl_{name.lower()}"
-    )
-
-
 # -----------------------------
 # Helpers
 # -----------------------------
@@ -244,3 +201,201 @@ def test_read_message_action_with_filters(tmp_path, fake_session):
     assert updated.is_read is False
     assert updated2.is_read is True
     assert updated3.is_read is False
+
+
+# -----------------------------
+# Compiled matcher
+# -----------------------------
+def reference_matches(email, rs):
+    """The original per-condition interpreter, kept as the semantic baseline."""
+
+    def field_value(field):
+        f = field.lower()
+        if f == "from":
+            return email.from_email or ""
+        if f == "to":
+            return email.to_email or ""
+        if f == "subject":
+            return email.subject or ""
+        if f == "message":
+            return email.body or email.snippet or ""
+        return email.received_at
+
+    def match_date(dt, predicate, amount):
+        now = datetime.utcnow()
+        if predicate == "LessThanDays":
+            return (now - dt).days < amount
+        if predicate == "GreaterThanDays":
+            return (now - dt).days > amount
+        if predicate == "LessThanMonths":
+            return (now - relativedelta(months=amount)) < dt
+        return (now - relativedelta(months=amount)) > dt
+
+    results = []
+    for cond in rs.rules:
+        val = field_value(cond.field)
+        if cond.predicate in STRING_PREDICATES:
+            v, t = str(val).lower(), str(cond.value).lower()
+            results.append(
+                {
+                    "Contains": t in v,
+                    "DoesNotContain": t not in v,
+                    "Equals": v == t,
+                    "DoesNotEqual": v != t,
+                }[cond.predicate]
+            )
+        elif isinstance(val, datetime):
+            results.append(match_date(val, cond.predicate, int(cond.value)))
+        else:
+            results.append(False)
+    return all(results) if rs.predicate == "All" else any(results)
+
+
+SAMPLE_EMAILS = [
+    make_email(id="s1", subject="URGENT: invoice", body="pay ASAP", sender="a@b.com"),
+    make_email(id="s2", subject="", body="", sender="Noreply@Medium.com"),
+    make_email(id="s3", subject="Hello", body="", sender="a@b.com"),
+    make_email(
+        id="s4",
+        subject="Old news",
+        body="weekly digest",
+        sender="news@letter.io",
+        received=datetime.utcnow() - timedelta(days=70),
+    ),
+]
+SAMPLE_EMAILS[2].snippet = "snippet only asap"
+SAMPLE_EMAILS[3].to_email = None
+
+SAMPLE_CONDITIONS = [
+    RuleCondition("Subject", "Contains", "urgent"),
+    RuleCondition("subject", "Equals", ""),
+    RuleCondition("Message", "Contains", "ASAP"),
+    RuleCondition("To", "DoesNotContain", "x.com"),
+    RuleCondition("From", "Equals", "noreply@medium.com"),
+    RuleCondition("From", "DoesNotEqual", "a@b.com"),
+    RuleCondition("Received", "LessThanDays", "7"),
+    RuleCondition("Received", "GreaterThanMonths", 1),
+    RuleCondition("Received", "LessThanMonths", 3),
+    RuleCondition("Received", "Contains", "20"),
+]
+
+
+@pytest.mark.parametrize("predicate", ["All", "Any"])
+@pytest.mark.parametrize("start", range(len(SAMPLE_CONDITIONS)))
+def test_compiled_matcher_agrees_with_reference(predicate, start):
+    conds = SAMPLE_CONDITIONS[start : start + 3]
+    rs = RuleSet(predicate=predicate, rules=conds, actions=[])
+    for e in SAMPLE_EMAILS:
+        assert email_matches(e, rs) is reference_matches(e, rs), (e.id, conds)
+
+
+def test_empty_rulesets_keep_all_any_semantics():
+    e = make_email()
+    assert email_matches(e, RuleSet(predicate="All", rules=[], actions=[])) is True
+    assert email_matches(e, RuleSet(predicate="Any", rules=[], actions=[])) is False
+
+
+def test_any_short_circuits():
+    rs = RuleSet(
+        predicate="Any",
+        rules=[
+            RuleCondition("Subject", "Contains", "Hel"),
+            RuleCondition("Message", "Contains", "x"),
+        ],
+        actions=[],
+    )
+
+    class NoBody:
+        subject = "Hello"
+
+        @property
+        def body(self):
+            raise AssertionError("body should not be read")
+
+    e = NoBody()
+    assert email_matches(e, rs) is True
+
+
+@pytest.mark.parametrize(
+    "rule, message",
+    [
+        ({"field": "Cc", "predicate": "Contains", "value": "x"}, "Unsupported field"),
+        (
+            {"field": "Subject", "predicate": "Does not Contain", "value": "x"},
+            "Unknown predicate",
+        ),
+        (
+            {"field": "Subject", "predicate": "LessThanDays", "value": 2},
+            "only applies to the Received field",
+        ),
+        (
+            {"field": "Received", "predicate": "LessThanDays", "value": "two"},
+            "needs a whole number",
+        ),
+    ],
+)
+def test_load_rules_rejects_invalid_conditions(tmp_path, rule, message):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps([{"predicate": "All", "rules": [rule]}]))
+
+    with pytest.raises(ValueError, match=message):
+        load_rules(str(rules_file))
+
+
+def test_load_rules_rejects_unknown_ruleset_predicate(tmp_path):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps([{"predicate": "Some", "rules": []}]))
+
+    with pytest.raises(ValueError, match="Ruleset #1"):
+        load_rules(str(rules_file))
+
+
+def test_matcher_uses_one_frozen_now():
+    rs = RuleSet("All", [RuleCondition("Received", "LessThanDays", 7)], [])
+    e = make_email(received=datetime(2024, 1, 1))
+
+    assert list(
+        CompiledMatcher([rs], now=datetime(2024, 1, 7, 23)).iter_matches(e)
+    ) == [0]
+    assert list(CompiledMatcher([rs], now=datetime(2024, 1, 8)).iter_matches(e)) == []
+
+
+def test_email_matches_keeps_date_cutoffs_current(tmp_path, monkeypatch):
+    class Clock(datetime):
+        current = datetime(2024, 1, 2)
+
+        @classmethod
+        def utcnow(cls):
+            return cls.current
+
+    monkeypatch.setattr(rules_engine, "datetime", Clock)
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(
+        json.dumps(
+            [
+                {
+                    "predicate": "All",
+                    "rules": [
+                        {"field": "Received", "predicate": "LessThanDays", "value": 1}
+                    ],
+                }
+            ]
+        )
+    )
+    (rs,) = load_rules(str(rules_file))
+    e = make_email(received=Clock(2024, 1, 1, 12))
+    assert email_matches(e, rs) is True
+
+    # two days later, for a caller still holding the loaded rules
+    Clock.current = datetime(2024, 1, 4)
+    assert email_matches(e, rs) is False
+    assert email_matches(e, rs, now=datetime(2024, 1, 2)) is True
+
+
+def test_parse_now_converts_to_naive_utc():
+    assert parse_now("2024-06-01T02:00:00+02:00") == datetime(2024, 6, 1)
+    assert parse_now("2024-06-01") == datetime(2024, 6, 1)
+    assert parse_now("2024-06-01T00:00:00Z") == datetime(2024, 6, 1)
+    assert parse_now(None) is None
+    with pytest.raises(typer.BadParameter):
+        parse_now("yesterday")
@@ -0,0 +1,373 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from app import db
+from app.bodies import compress_body
+from app.models import Email
+from app.rules_engine import CompiledMatcher, RuleCondition, RuleSet, email_matches
+from app.indexes import search_index_statements
+from app.sql_rules import (
+    candidates_query,
+    condition_clause,
+    date_cutoff,
+    explain_rulesets,
+    field_expr,
+    folds_unicode_case,
+    pushdown_flags,
+    ruleset_clause,
+    unreadable_bodies,
+)
+from tests.test_rules import SAMPLE_CONDITIONS, SAMPLE_EMAILS, make_email
+
+NOW = datetime.utcnow()
+
+EXTRA_EMAILS = [
+    make_email(id="e1", subject="50% off_today", body="", sender="shop@x.com"),
+    make_email(id="e2"),
+    make_email(
+        id="e3",
+        subject="Re: hello",
+        body="Body wins",
+        received=NOW - timedelta(days=3, hours=1),
+    ),
+]
+for attr in ("from_email", "to_email", "subject", "snippet", "body"):
+    setattr(EXTRA_EMAILS[1], attr, None)
+EMAILS = SAMPLE_EMAILS + EXTRA_EMAILS
+
+
+@pytest.fixture(scope="module")
+def conn():
+    """The emails table on SQLite, with the columns rules read."""
+    engine = create_engine("sqlite://")
+    with engine.connect() as c:
+        c.execute(
+            text(
+                "CREATE TABLE emails (id VARCHAR PRIMARY KEY, thread_id VARCHAR, "
+                "from_email VARCHAR, to_email TEXT, subject TEXT, snippet TEXT, "
+                "body TEXT, received_at DATETIME, is_read BOOLEAN, body_z BLOB)"
+            )
+        )
+        for e in EMAILS:
+            c.execute(
+                text(
+                    "INSERT INTO emails VALUES (:id, :thread_id, :from_email, "
+                    ":to_email, :subject, :snippet, :body, :received_at, :is_read, "
+                    "NULL)"
+                ),
+                {
+                    "id": e.id,
+                    "thread_id": e.thread_id,
+                    "from_email": e.from_email,
+                    "to_email": e.to_email,
+                    "subject": e.subject,
+                    "snippet": e.snippet,
+                    "body": e.body,
+                    "received_at": e.received_at.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                    "is_read": e.is_read,
+                },
+            )
+        yield c
+
+
+def sql_ids(conn, clause):
+    return set(conn.scalars(select(Email.id).where(clause)))
+
+
+CONDITIONS = SAMPLE_CONDITIONS + [
+    RuleCondition("Subject", "Contains", "50%"),
+    RuleCondition("Subject", "Contains", "f_t"),
+    RuleCondition("From", "DoesNotContain", "x.com"),
+    RuleCondition("Message", "Equals", "body wins"),
+    RuleCondition("Message", "DoesNotEqual", ""),
+    RuleCondition("To", "Equals", ""),
+    RuleCondition("Received", "GreaterThanDays", 2),
+    RuleCondition("Received", "LessThanDays", 3),
+]
+
+
+@pytest.mark.parametrize("cond", CONDITIONS, ids=repr)
+def test_condition_clause_matches_python(conn, cond):
+    clause = condition_clause(cond, NOW)
+    rs = RuleSet(predicate="All", rules=[cond], actions=[])
+    expected = {e.id for e in EMAILS if email_matches(e, rs)}
+
+    if cond.field == "Received" and cond.predicate == "Contains":
+        assert clause is None
+    else:
+        assert sql_ids(conn, clause) == expected
+
+
+def test_all_pushes_translatable_conditions_only():
+    rs = RuleSet(
+        predicate="All",
+        rules=[
+            RuleCondition("Received", "Contains", "20"),
+            RuleCondition("From", "Equals", "a@b.com"),
+        ],
+        actions=[],
+    )
+    sql = str(ruleset_clause(rs, NOW).compile(dialect=postgresql.dialect()))
+
+    assert "lower(coalesce(emails.from_email" in sql
+    assert "received_at" not in sql
+
+
+def test_any_with_untranslatable_condition_is_not_pushed():
+    rs = RuleSet(
+        predicate="Any",
+        rules=[
+            RuleCondition("Received", "Contains", "20"),
+            RuleCondition("From", "Equals", "a@b.com"),
+        ],
+        actions=[],
+    )
+    assert ruleset_clause(rs, NOW) is None
+    assert candidates_query([rs]).whereclause is None
+
+
+def test_candidates_query_is_a_superset(conn):
+    rulesets = [
+        RuleSet("All", [SAMPLE_CONDITIONS[0], SAMPLE_CONDITIONS[9]], []),
+        RuleSet("Any", [SAMPLE_CONDITIONS[4], SAMPLE_CONDITIONS[7]], []),
+    ]
+    query = candidates_query(rulesets, now=NOW)
+    candidates = set(conn.scalars(select(Email.id).where(query.whereclause)))
+    expected = {e.id for e in EMAILS if any(email_matches(e, rs) for rs in rulesets)}
+
+    assert expected <= candidates
+    assert len(candidates) < len(EMAILS)
+
+
+def test_search_index_expressions_match_pushed_down_sql():
+    statements = search_index_statements(fulltext=True)
+    assert statements[0] == "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+    for field, name in [
+        ("from", "from"),
+        ("Subject", "subject"),
+        ("Message", "message"),
+    ]:
+        expr = str(
+            field_expr(field).compile(
+                dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+            )
+        ).replace("emails.", "")
+        assert f"(({expr}) gin_trgm_ops)" in next(
+            s for s in statements if f"ix_emails_{name}_trgm" in s
+        )
+    assert any("tsvector" in s for s in statements)
+    assert not any("tsvector" in s for s in search_index_statements())
+
+
+class ExplainConnection:
+    dialect = postgresql.dialect()
+
+    def __init__(self, plans):
+        self.plans = plans
+        self.statements = []
+
+    def exec_driver_sql(self, sql, params):
+        self.statements.append((sql, params))
+        return [(line,) for line in self.plans.pop(0)]
+
+
+class ExplainSession:
+    def __init__(self, conn, bodies=(True, False)):
+        self.conn = conn
+        self.bodies = bodies
+
+    def connection(self):
+        return self.conn
+
+    def execute(self, statement):
+        # only the unreadable_bodies EXISTS probe goes through the session
+        return SimpleNamespace(one=lambda: self.bodies)
+
+
+def test_explain_rulesets_reports_index_usage():
+    rulesets = [
+        RuleSet("All", [RuleCondition("Subject", "Contains", "invoice")], []),
+        RuleSet("Any", [RuleCondition("Received", "Contains", "20")], []),
+        RuleSet(
+            "All",
+            [
+                RuleCondition("Message", "Contains", "asap"),
+                RuleCondition("Received", "Contains", "20"),
+            ],
+            [],
+        ),
+    ]
+    conn = ExplainConnection(
+        [
+            [
+                "Bitmap Heap Scan on emails  (cost=12.00..16.01 rows=1 width=32)",
+                "  ->  Bitmap Index Scan on ix_emails_subject_trgm  (cost=...)",
+            ],
+            ["Seq Scan on emails  (cost=0.00..1.01 rows=1 width=32)"],
+        ]
+    )
+
+    plans = explain_rulesets(ExplainSession(conn), rulesets, now=NOW)
+
+    assert [(p.access, p.pushed) for p in plans] == [
+        ("index", 1),
+        ("python", 0),
+        ("seq scan", 1),
+    ]
+    assert plans[0].indexes == ["ix_emails_subject_trgm"]
+    sql, params = conn.statements[0]
+    assert sql.startswith("EXPLAIN SELECT emails.id")
+    assert "%invoice%" in params.values()
+
+
+def test_explain_rulesets_on_sqlite():
+    engine = db.create_db_engine("sqlite://")
+    Email.__table__.create(engine)
+    rulesets = [
+        RuleSet("All", [RuleCondition("Received", "LessThanDays", 3)], []),
+        RuleSet("All", [RuleCondition("Subject", "Contains", "invoice")], []),
+    ]
+
+    with Session(engine) as session:
+        plans = explain_rulesets(session, rulesets, now=NOW)
+
+    assert [p.access for p in plans] == ["index", "seq scan"]
+    assert plans[0].indexes == ["ix_emails_received_at"]
+    assert plans[1].plan == ["SCAN emails"]
+
+
+def test_pushdown_folds_non_ascii_case_on_sqlite(sqlite_db):
+    emails = [
+        make_email(id="m1", body="RÉSUMÉ attached", sender="ÉCOLE@x.fr"),
+        make_email(id="m2", body="resume attached", sender="ecole@x.fr"),
+    ]
+    rulesets = [
+        RuleSet("All", [RuleCondition("Message", "Contains", "résumé")], []),
+        RuleSet("All", [RuleCondition("From", "Equals", "école@x.fr")], []),
+    ]
+
+    with Session(sqlite_db) as session:
+        session.add_all(emails)
+        session.commit()
+        for rs in rulesets:
+            flags = pushdown_flags(session, [rs])
+            assert flags[2]
+            found = session.scalars(candidates_query([rs], NOW, *flags)).all()
+            assert [e.id for e in found] == ["m1"]
+            assert [e.id for e in emails if email_matches(e, rs)] == ["m1"]
+
+
+def test_non_ascii_targets_stay_in_python_without_unicode_lower():
+    # SQLite's built-in lower() folds ASCII only, like PostgreSQL under C.
+    engine = create_engine("sqlite://")
+    Email.__table__.create(engine)
+    accented = RuleSet("All", [RuleCondition("From", "Equals", "école@x.fr")], [])
+    plain = RuleSet("All", [RuleCondition("From", "Equals", "ecole@x.fr")], [])
+
+    with Session(engine) as session:
+        session.add_all(
+            [
+                make_email(id="m1", sender="ÉCOLE@x.fr"),
+                make_email(id="m2", sender="ecole@x.fr"),
+            ]
+        )
+        session.commit()
+        assert not folds_unicode_case(session, [accented])
+        assert folds_unicode_case(session, [plain])
+
+        flags = pushdown_flags(session, [accented])
+        assert condition_clause(accented.rules[0], NOW, unicode_case=False) is None
+        found = session.scalars(candidates_query([accented], NOW, *flags)).all()
+        assert sorted(e.id for e in found) == ["m1", "m2"]
+
+        flags = pushdown_flags(session, [plain])
+        found = session.scalars(candidates_query([plain], NOW, *flags)).all()
+        assert [e.id for e in found] == ["m2"]
+
+
+def test_message_clause_keeps_unfetched_bodies(conn):
+    cond = RuleCondition("Message", "Contains", "no such text")
+    unfetched = {e.id for e in EMAILS if e.body is None}
+
+    assert unfetched and sql_ids(conn, condition_clause(cond, NOW)) == set()
+    assert sql_ids(conn, condition_clause(cond, NOW, unfetched_bodies=True)) == (
+        unfetched
+    )
+
+
+def test_message_clause_keeps_only_the_unreadable_bodies_that_exist():
+    engine = db.create_db_engine("sqlite://")
+    Email.__table__.create(engine)
+    rulesets = [RuleSet("All", [RuleCondition("Message", "Contains", "paid")], [])]
+    rows = [
+        make_email(id="fetched", body="overdue"),
+        make_email(id="compressed"),
+        make_email(id="unfetched"),
+    ]
+    rows[1].body, rows[1].body_z = None, compress_body("paid", "zlib")
+    rows[2].body = None
+
+    with Session(engine) as session:
+        session.add_all(rows[:2])
+        session.commit()
+        bodies = unreadable_bodies(session, rulesets)
+        ids = session.scalars(candidates_query(rulesets, NOW, *bodies)).all()
+        # a compressed body is not an unfetched one
+        assert bodies == (False, True)
+        assert [e.id for e in ids] == ["compressed"]
+
+        session.add(rows[2])
+        session.commit()
+        bodies = unreadable_bodies(session, rulesets)
+        ids = session.scalars(candidates_query(rulesets, NOW, *bodies)).all()
+        assert bodies == (True, True)
+        assert sorted(e.id for e in ids) == ["compressed", "unfetched"]
+
+        session.delete(session.get(Email, "compressed"))
+        session.delete(session.get(Email, "unfetched"))
+        session.commit()
+        query = candidates_query(rulesets, NOW, *unreadable_bodies(session, rulesets))
+        assert "IS NULL" not in str(query) and "IS NOT NULL" not in str(query)
+
+
+def test_frozen_now_agrees_at_the_cutoffs():
+    now = datetime(2024, 3, 31, 12, 0)
+    conds = [
+        RuleCondition("Received", "LessThanDays", 7),
+        RuleCondition("Received", "GreaterThanDays", 6),
+        RuleCondition("Received", "LessThanMonths", 1),
+        RuleCondition("Received", "GreaterThanMonths", 1),
+    ]
+    cutoffs = {date_cutoff(c.predicate, c.value, now) for c in conds}
+    tick = timedelta(microseconds=1)
+    emails = [
+        make_email(id=f"m{i}", received=at)
+        for i, at in enumerate(c + d for c in cutoffs for d in (-tick, 0 * tick, tick))
+    ]
+    engine = create_engine("sqlite://")
+    Email.__table__.create(engine)
+    with engine.begin() as c:
+        c.execute(
+            Email.__table__.insert(),
+            [
+                {
+                    "id": e.id,
+                    "thread_id": e.thread_id,
+                    "from_email": e.from_email,
+                    "to_email": e.to_email,
+                    "received_at": e.received_at,
+                }
+                for e in emails
+            ],
+        )
+        for cond in conds:
+            rs = RuleSet("All", [cond], [])
+            matcher = CompiledMatcher([rs], now)
+            expected = {e.id for e in emails if list(matcher.iter_matches(e))}
+            assert sql_ids(c, condition_clause(cond, now)) == expected, cond
+            assert 0 < len(expected) < len(emails)
@@ -0,0 +1,184 @@
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from app import watch
+from app.fetch_emails import FetchStats
+from app.watch import PUSH_PATH, Watcher, make_server, parse_push, push_envelope
+
+RULES = [
+    {
+        "predicate": "All",
+        "rules": [{"field": "Subject", "predicate": "Contains", "value": "invoice"}],
+        "actions": [{"type": "mark_as_read"}],
+    }
+]
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def post(url, payload):
+    """Stand-in for Pub/Sub delivering a push message; returns the status."""
+    data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+    request = urllib.request.Request(url, data=data, method="POST")
+    request.add_header("Content-Type", "application/json")
+    try:
+        with urllib.request.urlopen(request) as resp:
+            return resp.status
+    except urllib.error.HTTPError as exc:
+        return exc.code
+
+
+@pytest.fixture
+def synced(tmp_path, monkeypatch):
+    """Fake sync/process; `synced.results` queues what each sync returns."""
+    rules_path = tmp_path / "rules.json"
+    rules_path.write_text(json.dumps(RULES))
+
+    class Calls:
+        results = []
+        processed = []
+        syncs = 0
+        path = str(rules_path)
+
+    def fake_sync(label_ids, fmt):
+        Calls.syncs += 1
+        return Calls.results.pop(0) if Calls.results else FetchStats()
+
+    def fake_process(rulesets, email_ids=None, **kw):
+        Calls.processed.append(email_ids)
+        return len(email_ids or [])
+
+    monkeypatch.setattr(watch, "sync_incremental", fake_sync)
+    monkeypatch.setattr(watch, "process_rules", fake_process)
+    return Calls
+
+
+@pytest.fixture
+def running(synced):
+    watcher = Watcher(synced.path, topic="", poll_interval=60)
+    server = make_server(watcher, "127.0.0.1", 0, token="s3cret")
+    threads = [
+        threading.Thread(target=server.serve_forever, daemon=True),
+        threading.Thread(target=watcher.run, daemon=True),
+    ]
+    for t in threads:
+        t.start()
+    _wait_for(lambda: watcher.runs == 1)
+    url = f"http://127.0.0.1:{server.server_port}{PUSH_PATH}?token=s3cret"
+    yield watcher, url
+    watcher.stop()
+    server.shutdown()
+    server.server_close()
+    threads[1].join(timeout=5)
+
+
+def test_notification_processes_only_new_messages(running, synced):
+    watcher, url = running
+    synced.results.append(FetchStats(fetched=2, new_ids=["m1", "m2"]))
+
+    assert post(url, push_envelope("me@example.com", "1234")) == 204
+    _wait_for(lambda: watcher.runs == 2)
+
+    # first run: nothing new, so nothing processed
+    assert synced.processed == [["m1", "m2"]]
+    assert watcher.notifications == 1
+
+
+def test_push_requires_token_and_valid_body(running, synced):
+    watcher, url = running
+    bad_token = url.replace("s3cret", "nope")
+
+    assert post(bad_token, push_envelope("me@example.com", "1")) == 403
+    assert post(url, b"{not json") == 400
+    assert post(url, {"message": {"data": "!!"}}) == 400
+    assert watcher.notifications == 0
+    assert synced.syncs == 1
+
+
+def test_concurrent_pushes_are_all_counted(running):
+    watcher, url = running
+    senders = [
+        threading.Thread(
+            target=post, args=(url, push_envelope("me@example.com", str(i)))
+        )
+        for i in range(20)
+    ]
+    for t in senders:
+        t.start()
+    for t in senders:
+        t.join()
+
+    _wait_for(lambda: watcher.status()["notifications"] == 20)
+    health = url.replace(PUSH_PATH, "/healthz").split("?")[0]
+    with urllib.request.urlopen(health) as resp:
+        assert json.load(resp)["notifications"] == 20
+    # woken at least once more, however the pushes were coalesced
+    _wait_for(lambda: watcher.status()["runs"] >= 2)
+
+
+def test_full_resync_processes_everything(synced):
+    synced.results.append(FetchStats(fetched=5, full_resync=True))
+    watcher = Watcher(synced.path, topic="")
+
+    watcher.sync_once()
+
+    assert synced.processed == [None]
+
+
+def test_polling_without_notifications(synced):
+    watcher = Watcher(synced.path, topic="", poll_interval=0.05)
+    thread = threading.Thread(target=watcher.run, daemon=True)
+    thread.start()
+    _wait_for(lambda: watcher.runs >= 3)
+    watcher.stop()
+    thread.join(timeout=5)
+
+
+def test_watch_is_renewed_before_expiry(synced, monkeypatch):
+    calls = []
+    expires_in = [3600]
+
+    def fake_watch(topic, label_ids):
+        calls.append((topic, list(label_ids)))
+        return {"historyId": "1", "expiration": (time.time() + expires_in[0]) * 1000}
+
+    monkeypatch.setattr(watch, "watch_mailbox", fake_watch)
+    watcher = Watcher(synced.path, topic="projects/p/topics/gmail")
+
+    watcher.renew_watch()
+    watcher.renew_watch()
+    expires_in[0] = 7 * 86400
+    watcher.renew_watch()
+    watcher.renew_watch()
+
+    assert calls == [("projects/p/topics/gmail", ["INBOX"])] * 3
+
+
+def test_rules_are_reloaded_when_the_file_changes(synced):
+    watcher = Watcher(synced.path, topic="")
+    watcher.sync_once()
+    first = watcher.rulesets
+    watcher.sync_once()
+    assert watcher.rulesets is first
+
+    with open(synced.path, "w") as f:
+        json.dump(RULES * 2, f)
+    os.utime(synced.path, (time.time() + 10, time.time() + 10))
+    watcher.sync_once()
+    assert len(watcher.rulesets) == 2
+
+
+def test_parse_push_round_trip():
+    body = json.dumps(push_envelope("me@example.com", "42")).encode()
+    assert parse_push(body) == {"emailAddress": "me@example.com", "historyId": "42"}